@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rag_service.semantic_cache import bump_content_corpus_version, get_content_corpus_version
+
+
+class Command(BaseCommand):
+    help = "Invalidate the semantic answer cache of all the workers (run after the content corpus is updated)"
+
+    def handle(self, *args, **options):
+        if not bump_content_corpus_version():
+            raise CommandError(
+                "REDIS_URL is not configured, the answer caches of the workers can not be invalidated: "
+                "change CONTENT_CORPUS_VERSION or restart the workers instead"
+            )
+        self.stdout.write(self.style.SUCCESS(f"Content corpus version is now {get_content_corpus_version()}"))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from common.answer_bank import build_answer_bank, save_answer_bank
+from django_core.config import Config
+
+
+class Command(BaseCommand):
+    help = "Rebuild the exact-match answer bank from the answered messages (workers reload it automatically)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--min-occurrences", type=int, default=Config.ANSWER_BANK_MIN_OCCURRENCES)
+        parser.add_argument("--max-age", type=int, default=Config.ANSWER_BANK_MAX_AGE, help="in days")
+        parser.add_argument("--path", default=Config.ANSWER_BANK_PATH)
+
+    def handle(self, *args, **options):
+        answer_bank = build_answer_bank(options["min_occurrences"], options["max_age"])
+        save_answer_bank(answer_bank, options["path"])
+        self.stdout.write(self.style.SUCCESS(f"Answer bank with {len(answer_bank)} entries saved to {options['path']}"))
@@ -1,3 +1,200 @@
-from django.test import TestCase
+import asyncio, time
+from types import SimpleNamespace
 
-# Create your tests here.
+import httpx
+from django.test import SimpleTestCase
+
+from rag_service.concurrency_limiter import (
+    CONCURRENCY_OUTCOME_OVERLOAD,
+    CONCURRENCY_OUTCOME_SUCCESS,
+    AIMDConcurrencyLimiter,
+)
+from rag_service.rate_limiter import LocalRateLimitBucket, get_retry_after, parse_rate_limit_duration
+
+
+class AIMDConcurrencyLimiterTests(SimpleTestCase):
+    def test_limit_grows_additively_on_success(self):
+        limiter = AIMDConcurrencyLimiter(initial_limit=4, min_limit=1, max_limit=5)
+        limiter.release(CONCURRENCY_OUTCOME_SUCCESS, 0.1)
+        self.assertEqual(limiter.limit, 4.25)
+        # about one request per round of requests
+        for _ in range(3):
+            limiter.release(CONCURRENCY_OUTCOME_SUCCESS, 0.1)
+        self.assertTrue(4.9 < limiter.limit < 5)
+
+        for _ in range(100):
+            limiter.release(CONCURRENCY_OUTCOME_SUCCESS, 0.1)
+        self.assertEqual(limiter.limit, 5)
+
+    def test_limit_does_not_grow_on_slow_success(self):
+        limiter = AIMDConcurrencyLimiter(initial_limit=4, min_limit=1, max_limit=8, healthy_latency=1)
+        limiter.release(CONCURRENCY_OUTCOME_SUCCESS, 2)
+        self.assertEqual(limiter.limit, 4)
+
+    def test_limit_decreases_once_per_round(self):
+        limiter = AIMDConcurrencyLimiter(initial_limit=8, min_limit=1, max_limit=8)
+        start_time = time.monotonic()
+        for _ in range(3):
+            limiter.release(CONCURRENCY_OUTCOME_OVERLOAD, 0.1, start_time)
+        # the requests of the round were all sent at the higher limit
+        self.assertEqual(limiter.limit, 4)
+
+        limiter.release(CONCURRENCY_OUTCOME_OVERLOAD, 0.1, time.monotonic())
+        self.assertEqual(limiter.limit, 2)
+        for _ in range(3):
+            limiter.release(CONCURRENCY_OUTCOME_OVERLOAD, 0.1, time.monotonic())
+        self.assertEqual(limiter.limit, 1)
+
+    async def test_waiters_get_the_released_slots_in_order(self):
+        limiter = AIMDConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1)
+        self.assertTrue(await limiter.acquire())
+
+        acquired = []
+
+        async def acquire(name):
+            await limiter.acquire()
+            acquired.append(name)
+
+        tasks = [asyncio.create_task(acquire(name)) for name in ("first", "second", "third")]
+        await asyncio.sleep(0)
+        self.assertEqual(len(limiter.waiters), 3)
+
+        for _ in tasks:
+            limiter.release(CONCURRENCY_OUTCOME_SUCCESS)
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        self.assertEqual(acquired, ["first", "second", "third"])
+        self.assertEqual(limiter.in_flight, 1)
+
+    async def test_acquire_times_out(self):
+        limiter = AIMDConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1)
+        self.assertTrue(await limiter.acquire())
+
+        self.assertFalse(await limiter.acquire(0.01))
+        self.assertEqual(len(limiter.waiters), 0)
+        self.assertEqual(limiter.in_flight, 1)
+
+    async def test_cancelled_waiter_leaves_the_queue(self):
+        limiter = AIMDConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1)
+        self.assertTrue(await limiter.acquire())
+
+        task = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(len(limiter.waiters), 0)
+
+        limiter.release(CONCURRENCY_OUTCOME_SUCCESS)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_slot_handed_over_to_a_cancelled_waiter_is_not_lost(self):
+        limiter = AIMDConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1)
+        self.assertTrue(await limiter.acquire())
+
+        task = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        limiter.release(CONCURRENCY_OUTCOME_SUCCESS)
+        task.cancel()
+        try:
+            acquired = await task
+        except asyncio.CancelledError:
+            acquired = False
+        # the slot belongs to the waiter when it acquired it, it is released otherwise
+        self.assertEqual(limiter.in_flight, 1 if acquired else 0)
+        self.assertEqual(len(limiter.waiters), 0)
+
+
+class LocalRateLimitBucketTests(SimpleTestCase):
+    def test_reserve_waits_for_the_refill(self):
+        bucket = LocalRateLimitBucket(rpm=60, tpm=600)
+        self.assertEqual(bucket.reserve(600), 0)
+        # 60 tokens over the limit are refilled in 6 seconds
+        self.assertAlmostEqual(bucket.reserve(60), 6, places=2)
+
+        bucket.updated -= 6
+        self.assertAlmostEqual(bucket.reserve(0), 0, places=2)
+
+    def test_reserve_waits_for_the_requests(self):
+        bucket = LocalRateLimitBucket(rpm=2, tpm=1000)
+        self.assertEqual(bucket.reserve(1), 0)
+        self.assertEqual(bucket.reserve(1), 0)
+        self.assertAlmostEqual(bucket.reserve(1), 30, places=1)
+
+    def test_settle_gives_back_the_unused_capacity(self):
+        bucket = LocalRateLimitBucket(rpm=60, tpm=600)
+        bucket.reserve(500)
+        bucket.settle(500, 1)
+        self.assertAlmostEqual(bucket.tokens, 600, places=1)
+        self.assertAlmostEqual(bucket.requests, 60, places=1)
+
+        bucket.reserve(100)
+        bucket.settle(-200)
+        self.assertAlmostEqual(bucket.reserve(400), 10, places=1)
+
+    def test_block_delays_the_reservations(self):
+        bucket = LocalRateLimitBucket(rpm=60, tpm=600)
+        bucket.block(5)
+        self.assertAlmostEqual(bucket.reserve(1), 5, places=1)
+
+        bucket.block(1)
+        self.assertAlmostEqual(bucket.reserve(1), 5, places=1)
+
+
+def rate_limit_error(headers):
+    return SimpleNamespace(response=SimpleNamespace(headers=httpx.Headers(headers)))
+
+
+class RetryAfterTests(SimpleTestCase):
+    def test_parse_rate_limit_duration(self):
+        self.assertEqual(parse_rate_limit_duration("20"), 20)
+        self.assertEqual(parse_rate_limit_duration("1.5"), 1.5)
+        self.assertEqual(parse_rate_limit_duration("6m0s"), 360)
+        self.assertAlmostEqual(parse_rate_limit_duration("120ms"), 0.12)
+        self.assertAlmostEqual(parse_rate_limit_duration("1h2m3.5s"), 3723.5)
+        self.assertIsNone(parse_rate_limit_duration("soon"))
+        self.assertIsNone(parse_rate_limit_duration(None))
+
+    def test_retry_after_ms_header(self):
+        error = rate_limit_error({"retry-after-ms": "120", "retry-after": "1"})
+        self.assertAlmostEqual(get_retry_after(error), 0.12)
+
+    def test_retry_after_header(self):
+        self.assertEqual(get_retry_after(rate_limit_error({"retry-after": "20"})), 20)
+        self.assertEqual(get_retry_after(rate_limit_error({"retry-after": "6m0s"})), 360)
+
+    def test_rate_limit_reset_headers(self):
+        error = rate_limit_error(
+            {
+                "x-ratelimit-remaining-requests": "0",
+                "x-ratelimit-reset-requests": "6m0s",
+                "x-ratelimit-remaining-tokens": "100",
+                "x-ratelimit-reset-tokens": "120ms",
+            }
+        )
+        self.assertEqual(get_retry_after(error), 360)
+
+        error = rate_limit_error(
+            {
+                "x-ratelimit-remaining-requests": "10",
+                "x-ratelimit-reset-requests": "6m0s",
+                "x-ratelimit-remaining-tokens": "0",
+                "x-ratelimit-reset-tokens": "120ms",
+            }
+        )
+        self.assertAlmostEqual(get_retry_after(error), 0.12)
+
+        error = rate_limit_error(
+            {
+                "x-ratelimit-remaining-requests": "0",
+                "x-ratelimit-reset-requests": "1s",
+                "x-ratelimit-remaining-tokens": "0",
+                "x-ratelimit-reset-tokens": "6m0s",
+            }
+        )
+        self.assertEqual(get_retry_after(error), 360)
+
+    def test_no_retry_after(self):
+        self.assertIsNone(get_retry_after(rate_limit_error({})))
+        self.assertIsNone(get_retry_after(rate_limit_error({"retry-after": "later"})))
+        self.assertIsNone(get_retry_after(Exception("rate limited")))
@@ -2,11 +2,12 @@ from django.contrib import admin
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from api.views import ChatAPIViewSet, LanguageViewSet
+from api.views import ChatAPIViewSet, LanguageViewSet, MetricsViewSet
 
 router = DefaultRouter()
 router.register(r"chat", ChatAPIViewSet, basename="chat")
 router.register(r"language", LanguageViewSet, basename="language")
+router.register(r"metrics", MetricsViewSet, basename="metrics")
 
 urlpatterns = [
     path("", include(router.urls)),
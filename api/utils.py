@@ -1,6 +1,19 @@
-import asyncio, logging, json, datetime, os, uuid
-
+import asyncio, logging, json, datetime
+from django.core.files.uploadedfile import UploadedFile
+
+from common.chat_history import (
+    cache_conversation_memory,
+    format_chat_history,
+    get_cached_conversation_memory,
+    get_conversation_chat_history,
+    load_recent_turns,
+    schedule_conversation_memory_update,
+)
+from common.answer_bank import answer_from_answer_bank, get_answer_bank_entry
+from common.cache import make_cache_key
 from common.constants import Constants
+from common.metrics import increment_counter
+from common.singleflight import SingleFlight
 from common.utils import (
     decode_base64_to_binary,
     encode_binary_to_base64,
@@ -9,7 +22,9 @@ from common.utils import (
     get_or_create_latest_conversation,
     get_or_create_user_by_email,
     insert_message_record,
+    normalize_query,
     postprocess_and_translate_query_response,
+    replace_user_name,
     save_message_obj,
     send_request,
 )
@@ -20,11 +35,15 @@ from django_core.config import Config
 from rag_service.execute_rag import execute_rag_pipeline
 from language_service.translation import detect_language_and_translate_to_english, a_translate_to
 from language_service.asr import transcribe_and_translate
-from language_service.tts import synthesize_speech
+from language_service.tts import synthesize_speech_audio
+from rephrasing.rephrase import is_self_contained_query
 
 
 logger = logging.getLogger(__name__)
 
+# RAG pipeline runs shared by the concurrent identical queries
+rag_pipeline_flights = SingleFlight("rag_pipeline")
+
 
 def authenticate_user_based_on_email(email_id):
     authenticated_user = None
@@ -67,15 +86,45 @@ def preprocess_user_data(
             user_id = user_obj.id
             user_name = user_obj.first_name
 
-            conversation_obj = get_or_create_latest_conversation({"user_id": user_id, "title": original_query})
+            # latest conversation & its chat history from the conversation memory cache, from the db on a cache miss
+            conversation_memory = (
+                get_cached_conversation_memory(user_id) if Config.CONVERSATION_MEMORY_ENABLED else None
+            )
+            if conversation_memory:
+                conversation_id = conversation_memory.get("conversation_id")
+                chat_history = format_chat_history(
+                    conversation_memory.get("summary"), conversation_memory.get("recent_turns")
+                )
+            else:
+                # new conversations start with an empty conversation memory
+                conversation_obj = get_or_create_latest_conversation(
+                    {"user_id": user_id, "title": original_query, "recent_turns": "[]"}
+                )
+                conversation_id = conversation_obj.id
+                chat_history = (
+                    get_conversation_chat_history(conversation_obj) if Config.CONVERSATION_MEMORY_ENABLED else None
+                )
+                if chat_history is not None:
+                    cache_conversation_memory(
+                        user_id, conversation_id, conversation_obj.summary, load_recent_turns(conversation_obj)
+                    )
+
             message_obj = insert_message_record(
-                {"original_message": original_query, "conversation_id": conversation_obj}
+                {"original_message": original_query, "conversation_id": conversation_id}
             )
             message_id = message_obj.id
             message_data_to_insert_or_update["input_type"] = message_input_type
             message_data_to_insert_or_update["message_input_time"] = datetime.datetime.now()
 
-            user_data.update({"user_id": user_id, "user_name": user_name, "message_id": message_id})
+            user_data.update(
+                {
+                    "user_id": user_id,
+                    "user_name": user_name,
+                    "message_id": message_id,
+                    "conversation_id": conversation_id,
+                    "chat_history": chat_history,
+                }
+            )
 
     except Exception as error:
         logger.error(error, exc_info=True)
@@ -87,50 +136,150 @@ def preprocess_user_data(
     return user_data, message_obj
 
 
-def process_query(original_query, email_id, authenticated_user={}):
-    message_obj, chat_history = None, None
+def get_query_coalescing_key(query_in_english, input_language_detected, chat_history):
+    """
+    Key of the queries sharing a RAG pipeline run: the normalized translated query, its language & the chat history.
+    """
+    return make_cache_key(
+        normalize_query(query_in_english), input_language_detected, make_cache_key(chat_history or "")
+    )
+
+
+async def run_rag_pipeline(
+    query_in_english,
+    input_language_detected,
+    email_id,
+    user_name=None,
+    message_id=None,
+    chat_history=None,
+    stream_handler=None,
+    deadline=None,
+):
+    """
+    Run the RAG pipeline for the query, concurrent identical queries await the run of the first one (the leader).
+    The followers get a copy of the leader results for their own message, the RAG pipeline metrics are stored
+    for the message of the leader only.
+    """
+    pipeline_arguments = (query_in_english, input_language_detected, email_id)
+    pipeline_options = {
+        "user_name": user_name,
+        "message_id": message_id,
+        "chat_history": chat_history,
+        "stream_handler": stream_handler,
+        "deadline": deadline,
+    }
+    if not Config.REQUEST_COALESCING_ENABLED:
+        return await execute_rag_pipeline(*pipeline_arguments, **pipeline_options)
+
+    async def run_pipeline():
+        return user_name, await execute_rag_pipeline(*pipeline_arguments, **pipeline_options)
+
+    coalescing_key = get_query_coalescing_key(query_in_english, input_language_detected, chat_history)
+    (leader_user_name, (response_map, message_data)), is_leader = await rag_pipeline_flights.run(
+        coalescing_key, run_pipeline
+    )
+    if is_leader:
+        return response_map, message_data
+
+    generated_final_response = response_map.get("generated_final_response")
+    if generated_final_response and leader_user_name and user_name and leader_user_name != user_name:
+        generated_final_response = replace_user_name(generated_final_response, leader_user_name, user_name)
+    increment_counter("rag_pipeline_coalesced")
+
+    if stream_handler:
+        await stream_handler("rephrased_query", message_data.get("condensed_question"))
+        if generated_final_response:
+            await stream_handler("token", generated_final_response)
+
+    return {**response_map, "message_id": message_id, "generated_final_response": generated_final_response}, {
+        **message_data,
+        "message_id": message_id,
+    }
+
+
+async def process_query(original_query, email_id, authenticated_user={}, stream_handler=None, deadline=None):
+    message_obj, chat_history, chat_history_task = None, None, None
     response_map, message_data_to_insert_or_update, message_data_update_post_rag_pipeline = {}, {}, {}
 
     try:
-        user_data, message_obj = preprocess_user_data(original_query, email_id, authenticated_user)
-        # fetch user chat history
+        user_data, message_obj = await asyncio.to_thread(
+            preprocess_user_data, original_query, email_id, authenticated_user
+        )
+        # fetch user chat history while the original query is being translated
         user_id = user_data.get("user_id", None)
         user_name = user_data.get("user_name", None)
         message_id = user_data.get("message_id", None)
-        chat_history = get_user_chat_history(user_id) if user_id else None
+        if stream_handler:
+            await stream_handler("message_id", str(message_id) if message_id else None)
+
+        # chat history from the conversation memory, falls back to the message history of the conversation
+        chat_history = user_data.get("chat_history", None)
+        if user_id and chat_history is None:
+            chat_history_task = asyncio.create_task(asyncio.to_thread(get_user_chat_history, user_id))
 
         # begin translating original query to english
         message_data_to_insert_or_update["input_translation_start_time"] = datetime.datetime.now()
-        query_in_english, input_language_detected = asyncio.run(
-            detect_language_and_translate_to_english(original_query)
-        )
+        query_in_english, input_language_detected = await detect_language_and_translate_to_english(original_query)
         message_data_to_insert_or_update["translated_message"] = query_in_english
         message_data_to_insert_or_update["input_translation_end_time"] = datetime.datetime.now()
         message_data_to_insert_or_update["input_language_detected"] = input_language_detected
         # end of translating original query to english
 
-        response_map, message_data_update_post_rag_pipeline = execute_rag_pipeline(
-            query_in_english,
-            input_language_detected,
-            email_id,
-            user_name=user_name,
-            message_id=message_id,
-            chat_history=chat_history,
-        )
+        if chat_history_task:
+            chat_history = await chat_history_task
 
-        # translate back to the detected input language of the original query
-        # begin translating original response to input_language_detected
-        (
-            translated_response,
-            final_response,
-            follow_up_question_options,
-            follow_up_question_data_to_insert,
-        ) = asyncio.run(
-            postprocess_and_translate_query_response(
-                response_map.get("generated_final_response"), input_language_detected, str(message_id)
+        # frequent self-contained questions are answered from the answer bank, without the RAG pipeline
+        answer_bank_entry = None
+        if not chat_history or is_self_contained_query(query_in_english):
+            answer_bank_entry = await asyncio.to_thread(
+                get_answer_bank_entry, query_in_english, input_language_detected
             )
-        )
-        # begin translating original response to input_language_detected
+
+        if answer_bank_entry:
+            message_data_update_post_rag_pipeline["main_bot_logic_start_time"] = datetime.datetime.now()
+            translated_response, final_response, follow_up_question_options = await answer_from_answer_bank(
+                answer_bank_entry,
+                message_id,
+                input_language_detected,
+                user_name=user_name,
+                stream_handler=stream_handler,
+            )
+            response_map = {"message_id": message_id}
+            message_data_update_post_rag_pipeline.update(
+                {
+                    "main_bot_logic_end_time": datetime.datetime.now(),
+                    "message_response_time": datetime.datetime.now(),
+                    "response_source": Constants.RESPONSE_SOURCE_ANSWER_BANK,
+                }
+            )
+        else:
+            response_map, message_data_update_post_rag_pipeline = await run_rag_pipeline(
+                query_in_english,
+                input_language_detected,
+                email_id,
+                user_name=user_name,
+                message_id=message_id,
+                chat_history=chat_history,
+                stream_handler=stream_handler,
+                deadline=deadline,
+            )
+
+            # translate back to the detected input language of the original query
+            # begin translating original response to input_language_detected
+            (
+                translated_response,
+                final_response,
+                follow_up_question_options,
+                follow_up_question_data_to_insert,
+            ) = await postprocess_and_translate_query_response(
+                response_map.get("generated_final_response"),
+                input_language_detected,
+                str(message_id),
+                stream_handler=stream_handler,
+            )
+            # the answer bank rebuilds the follow-up questions block of the generated response for every request
+            message_data_update_post_rag_pipeline["generated_response"] = response_map.get("generated_final_response")
+            # begin translating original response to input_language_detected
 
         response_map.update(
             {
@@ -144,87 +293,121 @@ def process_query(original_query, email_id, authenticated_user={}):
         message_data_to_insert_or_update["message_translated_response"] = translated_response
         message_data_to_insert_or_update.update(message_data_update_post_rag_pipeline)
 
+        schedule_conversation_memory_update(
+            user_data.get("conversation_id", None), message_id, query_in_english, final_response
+        )
+
     except Exception as error:
         logger.error(error, exc_info=True)
 
     finally:
         if message_obj and message_id:
-            save_message_obj(message_id, message_data_to_insert_or_update)
+            await asyncio.to_thread(save_message_obj, message_id, message_data_to_insert_or_update)
 
     return response_map
 
 
-def process_input_audio_to_base64(
+async def stream_query(original_query, email_id, authenticated_user={}, deadline=None):
+    """
+    Run process_query in the background and yield its (event, data) pairs as each stage produces them:
+    message_id, rephrased_query, token(s), translation(s), follow_up_questions and finally done,
+    which carries the same answer as the non streaming response.
+    """
+    event_queue = asyncio.Queue()
+
+    async def stream_handler(event, data):
+        await event_queue.put((event, data))
+
+    async def run_query():
+        response_map = {}
+        try:
+            response_map = await process_query(
+                original_query, email_id, authenticated_user, stream_handler, deadline=deadline
+            )
+        finally:
+            message_id = response_map.get("message_id")
+            await event_queue.put(
+                (
+                    "done",
+                    {
+                        "message_id": str(message_id) if message_id else None,
+                        "response": response_map.get("translated_response"),
+                        "follow_up_questions": response_map.get("follow_up_questions"),
+                    },
+                )
+            )
+
+    query_task = asyncio.create_task(run_query())
+    event = None
+    while event != "done":
+        event, data = await event_queue.get()
+        yield event, data
+
+    await query_task
+
+
+def format_server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def process_input_audio_to_base64(
     original_text,
     message_id=None,
     language_code=Constants.LANGUAGE_SHORT_CODE_NATIVE,
     with_db_config=Config.WITH_DB_CONFIG,
 ):
-    input_audio, input_audio_file = None, None
+    input_audio = None
 
     try:
-        translated_text = asyncio.run(a_translate_to(original_text, language_code))
-        input_audio_file = asyncio.run(synthesize_speech(str(translated_text), language_code, message_id))
-        input_audio = encode_binary_to_base64(input_audio_file)
+        translated_text = await a_translate_to(original_text, language_code)
+        input_audio_content = await synthesize_speech_audio(str(translated_text), language_code)
+        input_audio = encode_binary_to_base64(input_audio_content)
 
     except Exception as error:
         logger.error(error, exc_info=True)
 
-    finally:
-        if input_audio_file:
-            os.remove(input_audio_file)
-
     return input_audio
 
 
-def process_output_audio(original_text, message_id=None, with_db_config=Config.WITH_DB_CONFIG):
-    response_audio, response_audio_file, message_obj = None, None, None
+async def process_output_audio(original_text, message_id=None, with_db_config=Config.WITH_DB_CONFIG):
+    response_audio, message_obj = None, None
     message_data_to_insert_or_update = {}
 
     try:
         if with_db_config and message_id:
-            message_obj = get_message_object_by_id(message_id)
+            message_obj = await asyncio.to_thread(get_message_object_by_id, message_id)
             input_language_detected = message_obj.input_language_detected
 
         else:
-            query_in_english, input_language_detected = asyncio.run(
-                detect_language_and_translate_to_english(original_text)
-            )
+            query_in_english, input_language_detected = await detect_language_and_translate_to_english(original_text)
 
         message_data_to_insert_or_update["response_text_to_speech_start_time"] = datetime.datetime.now()
-        response_audio_file = asyncio.run(synthesize_speech(str(original_text), input_language_detected, message_id))
+        response_audio_content = await synthesize_speech_audio(str(original_text), input_language_detected)
         message_data_to_insert_or_update["response_text_to_speech_end_time"] = datetime.datetime.now()
 
-        response_audio = encode_binary_to_base64(response_audio_file)
+        response_audio = encode_binary_to_base64(response_audio_content)
 
     except Exception as error:
         logger.error(error, exc_info=True)
 
     finally:
         if message_obj:
-            save_message_obj(message_id, message_data_to_insert_or_update)
-
-        if response_audio_file:
-            os.remove(response_audio_file)
+            await asyncio.to_thread(save_message_obj, message_id, message_data_to_insert_or_update)
 
     return response_audio
 
 
 def handle_input_query(input_query):
-    # if not Uploaded file, convert the base64 file string to a binary file
+    # uploaded audio files are read as they are, base64 audio strings are decoded to the audio bytes
+    if isinstance(input_query, UploadedFile):
+        input_query.seek(0)
+        return input_query.read()
 
-    input_query_file = decode_base64_to_binary(input_query)
+    return decode_base64_to_binary(input_query)
 
-    # store the input query file
-    file_name = f"{uuid.uuid4()}_audio_input.{Constants.MP3}"
-    with open(file_name, "wb") as output_file_buffer:
-        output_file_buffer.write(input_query_file)
 
-    return file_name
-
-
-def process_transcriptions(
-    voice_file,
+async def process_transcriptions(
+    voice_audio,
     email_id,
     authenticated_user={},
     language_code=Constants.LANGUAGE_BCP_CODE_NATIVE,
@@ -236,9 +419,7 @@ def process_transcriptions(
     try:
         message_data_to_insert_or_update["message_input_time"] = datetime.datetime.now()
         message_data_to_insert_or_update["input_speech_to_text_start_time"] = datetime.datetime.now()
-        transcriptions, detected_language, confidence_score = asyncio.run(
-            transcribe_and_translate(voice_file, language_code)
-        )
+        transcriptions, detected_language, confidence_score = await transcribe_and_translate(voice_audio, language_code)
 
         message_data_to_insert_or_update["input_speech_to_text_end_time"] = datetime.datetime.now()
         response_map["confidence_score"] = confidence_score
@@ -253,7 +434,9 @@ def process_transcriptions(
             message_data_to_insert_or_update["input_type"] = message_input_type
             response_map["transcriptions"] = could_not_understand_message
 
-        user_data, message_obj = preprocess_user_data(transcriptions, email_id, authenticated_user)
+        user_data, message_obj = await asyncio.to_thread(
+            preprocess_user_data, transcriptions, email_id, authenticated_user
+        )
         message_id = user_data.get("message_id", None)
         response_map["message_id"] = message_id
 
@@ -262,10 +445,7 @@ def process_transcriptions(
 
     finally:
         if message_obj and message_id:
-            save_message_obj(message_id, message_data_to_insert_or_update)
-
-        if voice_file:
-            os.remove(voice_file)
+            await asyncio.to_thread(save_message_obj, message_id, message_data_to_insert_or_update)
 
     return response_map
 
@@ -1,5 +1,6 @@
-import logging, asyncio, base64
-from django.core.files.uploadedfile import InMemoryUploadedFile
+import logging, asyncio
+from adrf.viewsets import ViewSet
+from django.http import StreamingHttpResponse
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.response import Response
@@ -7,7 +8,9 @@ from rest_framework.viewsets import GenericViewSet
 
 from api.utils import (
     authenticate_user_based_on_email,
+    format_server_sent_event,
     process_query,
+    stream_query,
     process_output_audio,
     process_transcriptions,
     handle_input_query,
@@ -16,17 +19,20 @@ from api.utils import (
     get_user_by_email,
 )
 from common.constants import Constants
+from common.deadline import new_request_deadline
+from common.metrics import get_metrics
 from language_service.utils import get_all_languages, get_language
 
 
 logger = logging.getLogger(__name__)
 
 
-class ChatAPIViewSet(GenericViewSet):
+class ChatAPIViewSet(ViewSet):
     authentication_classes = []
 
     @action(detail=False, methods=["post"])
-    def get_answer_for_text_query(self, request):
+    async def get_answer_for_text_query(self, request):
+        deadline = new_request_deadline()
         email_id = request.data.get("email_id")
         original_query = request.data.get("query")
         response_data = {"message": None, "query": original_query, "error": False, "data": []}
@@ -35,14 +41,14 @@ class ChatAPIViewSet(GenericViewSet):
 
         try:
             # check for authenticated user using email
-            authenticated_user = authenticate_user_based_on_email(email_id)
+            authenticated_user = await asyncio.to_thread(authenticate_user_based_on_email, email_id)
 
             # if is_authenticated == False:
             if not authenticated_user:
                 response_data["message"] = "Invalid Email ID"
                 return Response(response_data, status=status.HTTP_401_UNAUTHORIZED)
 
-            response_map = process_query(original_query, email_id, authenticated_user)
+            response_map = await process_query(original_query, email_id, authenticated_user, deadline=deadline)
 
             # update actual response body
             response_data["message"] = "Successful retrieval of answer for the above query."
@@ -57,13 +63,43 @@ class ChatAPIViewSet(GenericViewSet):
         return Response(response_data, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=["post"])
-    def synthesise_audio(self, request):
+    async def stream_answer_for_text_query(self, request):
+        deadline = new_request_deadline()
+        email_id = request.data.get("email_id")
+        original_query = request.data.get("query")
+        response_data = {"message": None, "query": original_query, "error": False}
+
+        try:
+            # check for authenticated user using email
+            authenticated_user = await asyncio.to_thread(authenticate_user_based_on_email, email_id)
+
+            # if is_authenticated == False:
+            if not authenticated_user:
+                response_data["message"] = "Invalid Email ID"
+                return Response(response_data, status=status.HTTP_401_UNAUTHORIZED)
+
+        except Exception as error:
+            logger.error(error, exc_info=True)
+            response_data.update({"message": "Something went wrong", "error": True})
+            return Response(response_data, status=status.HTTP_200_OK)
+
+        server_sent_events = (
+            format_server_sent_event(event, data)
+            async for event, data in stream_query(original_query, email_id, authenticated_user, deadline=deadline)
+        )
+        response = StreamingHttpResponse(server_sent_events, content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    @action(detail=False, methods=["post"])
+    async def synthesise_audio(self, request):
         original_text = request.data.get("text")
         message_id = request.data.get("message_id")
         response_data = {"message": None, "text": original_text, "error": False, "audio": None}
 
         try:
-            response_audio = process_output_audio(original_text, message_id)
+            response_audio = await process_output_audio(original_text, message_id)
             response_data.update({"audio": response_audio, "message": "Audio synthesis successful"})
 
         except Exception as error:
@@ -73,7 +109,7 @@ class ChatAPIViewSet(GenericViewSet):
         return Response(response_data, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=["post"])
-    def transcribe_audio(self, request):
+    async def transcribe_audio(self, request):
         email_id = request.data.get("email_id")
         original_query = request.data.get("query")
         query_language_code = request.data.get("query_language_code", Constants.LANGUAGE_BCP_CODE_NATIVE)
@@ -89,7 +125,7 @@ class ChatAPIViewSet(GenericViewSet):
 
         try:
             # check for authenticated user using email
-            authenticated_user = authenticate_user_based_on_email(email_id)
+            authenticated_user = await asyncio.to_thread(authenticate_user_based_on_email, email_id)
 
             # if is_authenticated == False:
             if not authenticated_user:
@@ -97,14 +133,11 @@ class ChatAPIViewSet(GenericViewSet):
                 return Response(response_data, status=status.HTTP_401_UNAUTHORIZED)
 
             input_query = request.FILES.get("query") if len(request.FILES) >= 1 else original_query
-            if isinstance(input_query, InMemoryUploadedFile):
-                input_query.seek(0)
-                file_content = input_query.read()
-                input_query = base64.b64encode(bytes(file_content))
-
-            input_query_file = handle_input_query(input_query)
+            input_query_audio = await asyncio.to_thread(handle_input_query, input_query)
 
-            response_map = process_transcriptions(input_query_file, email_id, authenticated_user, query_language_code)
+            response_map = await process_transcriptions(
+                input_query_audio, email_id, authenticated_user, query_language_code
+            )
             message_id = response_map.get("message_id")
             confidence_score = response_map.get("confidence_score")
             heard_input_query = response_map.get("transcriptions")
@@ -118,7 +151,9 @@ class ChatAPIViewSet(GenericViewSet):
             )
 
             if confidence_score > Constants.ASR_DEFAULT_CONFIDENCE_SCORE:
-                input_audio_base64 = process_input_audio_to_base64(heard_input_query, response_map.get("message_id"))
+                input_audio_base64 = await process_input_audio_to_base64(
+                    heard_input_query, response_map.get("message_id")
+                )
                 response_data.update(
                     {
                         "message": "Successful transcription for above input voice query.",
@@ -133,7 +168,7 @@ class ChatAPIViewSet(GenericViewSet):
         return Response(response_data, status=status.HTTP_200_OK)
 
     @action(detail=False, methods=["post"])
-    def get_answer_by_voice_query(self, request):
+    async def get_answer_by_voice_query(self, request):
         email_id = request.data.get("email_id", None)
         query = request.data.get("query", None)
         query_language_code = request.data.get("query_language_code", Constants.LANGUAGE_BCP_CODE_NATIVE)
@@ -146,14 +181,14 @@ class ChatAPIViewSet(GenericViewSet):
         }
 
         try:
-            transcribe_response = self.transcribe_audio(request)
+            transcribe_response = await self.transcribe_audio(request)
             transcribe_response_data = transcribe_response.data if transcribe_response.status_code == 200 else {}
             confidence_score = transcribe_response_data.get("confidence_score", None)
 
             if confidence_score and confidence_score > Constants.ASR_DEFAULT_CONFIDENCE_SCORE:
                 updated_request_obj = request
                 updated_request_obj.data.update({"query": transcribe_response_data.get("heard_input_query", None)})
-                get_answer_for_text_query_response = self.get_answer_for_text_query(updated_request_obj)
+                get_answer_for_text_query_response = await self.get_answer_for_text_query(updated_request_obj)
                 get_answer_for_text_query_response_data = (
                     get_answer_for_text_query_response.data
                     if get_answer_for_text_query_response.status_code == 200
@@ -260,3 +295,31 @@ class LanguageViewSet(GenericViewSet):
             response_data.update({"message": "Something went wrong", "error": True})
 
         return Response(response_data, status=status.HTTP_200_OK)
+
+
+class MetricsViewSet(GenericViewSet):
+    authentication_classes = []
+
+    @action(detail=False, methods=["get"])
+    def stats(self, request):
+        email_id = request.GET.get("email_id", None)
+        response_data = {"message": None, "error": False, "metrics": {}}
+
+        try:
+            # check for authenticated user using email
+            authenticated_user = authenticate_user_based_on_email(email_id)
+
+            # if is_authenticated == False:
+            if not authenticated_user:
+                response_data["message"] = "Invalid Email ID"
+                return Response(response_data, status=status.HTTP_401_UNAUTHORIZED)
+
+            response_data.update(
+                {"message": "Successful retrieval of the metrics of this worker process.", "metrics": get_metrics()}
+            )
+
+        except Exception as error:
+            logger.error(error, exc_info=True)
+            response_data.update({"message": "Something went wrong", "error": True})
+
+        return Response(response_data, status=status.HTTP_200_OK)
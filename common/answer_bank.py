@@ -0,0 +1,241 @@
+import datetime, json, logging, os, threading, time
+from collections import defaultdict
+
+from common.constants import Constants
+from common.metrics import increment_counter, register_metrics_provider
+from common.utils import (
+    canonicalize_query,
+    replace_user_name,
+    split_follow_up_questions,
+    translate_and_stream_response,
+    translate_response_and_follow_up_questions,
+)
+from database.database_config import db_conn
+from database.models import Conversation, Messages, User
+from django_core.config import Config
+from language_service.translation import a_translate_to
+from rag_service.semantic_cache import get_content_corpus_version, is_unanswered_response
+from rephrasing.rephrase import is_self_contained_query
+
+logger = logging.getLogger(__name__)
+
+# entries of the loaded answer bank: key -> (english answer, english follow-up questions, updated on timestamp)
+answer_bank_state = {"entries": {}, "corpus_version": None, "built_on": None, "mtime": None, "checked_at": None}
+answer_bank_lock = threading.Lock()
+
+
+def get_answer_bank_key(query_in_english, language) -> str:
+    return f"{language}\x1f{canonicalize_query(query_in_english)}"
+
+
+def build_answer_bank(min_occurrences=None, max_age=None) -> dict:
+    """
+    Build the answer bank entries from the answered messages of the last max_age days: self-contained questions asked
+    at least min_occurrences times in the same language (canonical query) keep the latest answer generated for them
+    (by the RAG pipeline). The english answer & follow-up questions are kept apart (the follow-up questions block is
+    rebuilt in the input language for every request) & the name of the user is replaced by a placeholder
+    (the translated answer can not be shared, the translation transliterates the name).
+    """
+    min_occurrences = min_occurrences or Config.ANSWER_BANK_MIN_OCCURRENCES
+    max_age = max_age or Config.ANSWER_BANK_MAX_AGE
+    answered_since = datetime.datetime.now() - datetime.timedelta(days=max_age)
+
+    occurrences = defaultdict(int)
+    latest_messages = {}
+    with db_conn:
+        messages = (
+            Messages.select(
+                Messages.id,
+                Messages.translated_message,
+                Messages.generated_response,
+                Messages.input_language_detected,
+                Messages.response_source,
+                Messages.created_on,
+                User.first_name,
+            )
+            .join(Conversation)
+            .join(User)
+            .where(
+                Messages.is_deleted == False,
+                Messages.created_on >= answered_since,
+                Messages.translated_message != None,
+                Messages.generated_response != None,
+            )
+            .order_by(Messages.created_on)
+            .dicts()
+        )
+        for message in messages.iterator():
+            if not is_self_contained_query(message.get("translated_message")):
+                continue
+            key = get_answer_bank_key(message.get("translated_message"), message.get("input_language_detected"))
+            occurrences[key] += 1
+            if message.get("response_source") not in (None, Constants.RESPONSE_SOURCE_RAG_PIPELINE):
+                continue
+            if is_unanswered_response(message.get("generated_response")):
+                continue
+            latest_messages[key] = message
+
+    answer_bank = {}
+    for key, message in latest_messages.items():
+        if occurrences[key] < min_occurrences:
+            continue
+        user_name = message.get("first_name")
+        response, follow_up_questions = split_follow_up_questions(message.get("generated_response"))
+        answer_bank[key] = {
+            "query": message.get("translated_message"),
+            "response": replace_user_name(response, user_name, Constants.USER_NAME_PLACEHOLDER),
+            "follow_up_questions": follow_up_questions,
+            "message_id": str(message.get("id")),
+            "occurrences": occurrences[key],
+            "updated_on": message.get("created_on").isoformat(),
+        }
+
+    return answer_bank
+
+
+def save_answer_bank(answer_bank: dict, path=None):
+    """
+    Write the answer bank file (atomically, the workers reload it when it changes).
+    """
+    path = path or Config.ANSWER_BANK_PATH
+    answer_bank_data = {
+        "built_on": datetime.datetime.now().isoformat(),
+        "corpus_version": get_content_corpus_version(),
+        "entries": answer_bank,
+    }
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as answer_bank_file:
+        json.dump(answer_bank_data, answer_bank_file, ensure_ascii=False)
+    os.replace(temporary_path, path)
+
+
+def load_answer_bank(path=None):
+    """
+    Load the answer bank file when it changed, checked at most every ANSWER_BANK_RELOAD_INTERVAL seconds.
+    """
+    path = path or Config.ANSWER_BANK_PATH
+    now = time.monotonic()
+    with answer_bank_lock:
+        if (
+            answer_bank_state["checked_at"] is not None
+            and now - answer_bank_state["checked_at"] < Config.ANSWER_BANK_RELOAD_INTERVAL
+        ):
+            return
+        answer_bank_state["checked_at"] = now
+
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            answer_bank_state.update({"entries": {}, "corpus_version": None, "built_on": None, "mtime": None})
+            return
+        if mtime == answer_bank_state["mtime"]:
+            return
+
+        try:
+            with open(path, encoding="utf-8") as answer_bank_file:
+                answer_bank_data = json.load(answer_bank_file)
+            entries = {
+                key: (
+                    entry.get("response"),
+                    tuple(entry.get("follow_up_questions")) if entry.get("follow_up_questions") is not None else None,
+                    datetime.datetime.fromisoformat(entry.get("updated_on")).timestamp(),
+                )
+                for key, entry in answer_bank_data.get("entries", {}).items()
+            }
+        except (OSError, ValueError, TypeError) as error:
+            logger.error(error, exc_info=True)
+            return
+
+        answer_bank_state.update(
+            {
+                "entries": entries,
+                "corpus_version": answer_bank_data.get("corpus_version"),
+                "built_on": answer_bank_data.get("built_on"),
+                "mtime": mtime,
+            }
+        )
+        increment_counter("answer_bank_reloads")
+
+
+def get_answer_bank_stats() -> dict:
+    return {
+        "entries": len(answer_bank_state["entries"]),
+        "built_on": answer_bank_state["built_on"],
+        "corpus_version": answer_bank_state["corpus_version"],
+    }
+
+
+register_metrics_provider("answer_bank", get_answer_bank_stats)
+
+
+def get_answer_bank_entry(query_in_english, language):
+    """
+    Answer bank entry of the query in the language ({"response", "follow_up_questions"}),
+    None when the query is not in the bank or its entry is stale (too old or built for another content corpus).
+    """
+    if not Config.ANSWER_BANK_ENABLED or not query_in_english:
+        return None
+
+    load_answer_bank()
+    entry = answer_bank_state["entries"].get(get_answer_bank_key(query_in_english, language))
+    if entry is None:
+        increment_counter("answer_bank_misses")
+        return None
+
+    response, follow_up_questions, updated_on = entry
+    if (
+        answer_bank_state["corpus_version"] != get_content_corpus_version()
+        or time.time() - updated_on > Config.ANSWER_BANK_MAX_AGE * 24 * 60 * 60
+    ):
+        increment_counter("answer_bank_stale")
+        return None
+
+    increment_counter("answer_bank_hits")
+    return {
+        "response": response,
+        "follow_up_questions": list(follow_up_questions) if follow_up_questions is not None else None,
+    }
+
+
+async def answer_from_answer_bank(
+    answer_bank_entry,
+    message_id,
+    input_language,
+    user_name=None,
+    stream_handler=None,
+    with_db_config=Config.WITH_DB_CONFIG,
+):
+    """
+    Answer the message with the answer bank entry (no generation), the english answer is translated to the input
+    language for the request & the follow-up questions block is rebuilt like for a generated answer (localized
+    header, questions stored for the message). Returns the (translated response, final response,
+    follow-up question options) triple.
+    """
+    final_response = replace_user_name(
+        answer_bank_entry.get("response"), Constants.USER_NAME_PLACEHOLDER, user_name or ""
+    )
+    follow_up_questions = answer_bank_entry.get("follow_up_questions")
+    if follow_up_questions is not None:
+        translated_response, final_response, follow_up_question_options, _ = (
+            await translate_response_and_follow_up_questions(
+                final_response,
+                follow_up_questions,
+                input_language,
+                str(message_id),
+                with_db_config=with_db_config,
+                stream_handler=stream_handler,
+            )
+        )
+        return translated_response, final_response, follow_up_question_options
+
+    output_language = input_language.split("-")[0] if "-" in input_language else input_language
+    if stream_handler:
+        translated_response = await translate_and_stream_response(
+            final_response, input_language, output_language, stream_handler
+        )
+    elif input_language != Constants.LANGUAGE_SHORT_CODE_ENG:
+        translated_response = await a_translate_to(final_response, output_language)
+    else:
+        translated_response = final_response
+
+    return translated_response, final_response, []
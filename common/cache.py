@@ -0,0 +1,219 @@
+import hashlib, json, logging, os, tempfile, threading
+import redis
+from cachetools import TTLCache
+
+from common.metrics import get_counter, increment_counter, register_metrics_provider
+from django_core.config import Config
+
+logger = logging.getLogger(__name__)
+
+shared_cache_client = None
+shared_cache_lock = threading.Lock()
+
+
+def get_shared_cache_client():
+    """
+    Return the redis client of the shared cache tier (None when REDIS_URL is not configured).
+    """
+    global shared_cache_client
+    if not Config.REDIS_URL:
+        return None
+
+    with shared_cache_lock:
+        if not shared_cache_client:
+            shared_cache_client = redis.Redis.from_url(
+                Config.REDIS_URL,
+                socket_timeout=Config.REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=Config.REDIS_SOCKET_TIMEOUT,
+            )
+
+    return shared_cache_client
+
+
+def make_cache_key(*parts) -> str:
+    return hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+class TwoTierCache:
+    """
+    In-process LRU cache (with TTL) in front of the shared redis store, so that entries written by one
+    worker process are visible to the others. Values must be json serialisable.
+    The shared tier is best effort, errors are logged and treated as cache misses.
+    local_ttl (default: ttl) bounds how long a worker may serve an entry updated by another worker.
+    """
+
+    def __init__(self, namespace: str, maxsize: int, ttl: float, local_ttl: float = None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local_cache = TTLCache(maxsize=maxsize, ttl=local_ttl or ttl)
+        self.lock = threading.Lock()
+        register_metrics_provider(f"{namespace}_cache", self.stats)
+
+    def shared_key(self, key) -> str:
+        return f"agridoc:{self.namespace}:{key}"
+
+    def get_many(self, keys) -> dict:
+        found, missing_keys = {}, []
+        with self.lock:
+            for key in keys:
+                if key in self.local_cache:
+                    found[key] = self.local_cache[key]
+                else:
+                    missing_keys.append(key)
+
+        local_hits = len(found)
+        shared_cache = get_shared_cache_client()
+        if missing_keys and shared_cache:
+            try:
+                shared_values = shared_cache.mget([self.shared_key(key) for key in missing_keys])
+                with self.lock:
+                    for key, value in zip(missing_keys, shared_values):
+                        if value is not None:
+                            found[key] = self.local_cache[key] = json.loads(value)
+            except Exception as error:
+                logger.error(error, exc_info=True)
+
+        increment_counter(f"{self.namespace}_cache_local_hits", local_hits)
+        increment_counter(f"{self.namespace}_cache_shared_hits", len(found) - local_hits)
+        increment_counter(f"{self.namespace}_cache_misses", len(keys) - len(found))
+        return found
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set_many(self, items: dict):
+        if not items:
+            return
+
+        with self.lock:
+            self.local_cache.update(items)
+
+        shared_cache = get_shared_cache_client()
+        if shared_cache:
+            try:
+                pipeline = shared_cache.pipeline(transaction=False)
+                for key, value in items.items():
+                    pipeline.set(self.shared_key(key), json.dumps(value), ex=int(self.ttl))
+                pipeline.execute()
+            except Exception as error:
+                logger.error(error, exc_info=True)
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def delete(self, key):
+        with self.lock:
+            self.local_cache.pop(key, None)
+
+        shared_cache = get_shared_cache_client()
+        if shared_cache:
+            try:
+                shared_cache.delete(self.shared_key(key))
+            except Exception as error:
+                logger.error(error, exc_info=True)
+
+    def stats(self) -> dict:
+        local_hits = get_counter(f"{self.namespace}_cache_local_hits")
+        shared_hits = get_counter(f"{self.namespace}_cache_shared_hits")
+        misses = get_counter(f"{self.namespace}_cache_misses")
+        lookups = local_hits + shared_hits + misses
+        return {
+            "size": len(self.local_cache),
+            "local_hits": local_hits,
+            "shared_hits": shared_hits,
+            "misses": misses,
+            "hit_rate": round((local_hits + shared_hits) / lookups, 4) if lookups else None,
+        }
+
+
+class DiskLRUCache:
+    """
+    Size bounded cache of binary values stored as files in a directory shared by the worker processes.
+    Reads refresh the modification time of a file, the least recently used files are evicted first
+    once the directory grows over max_bytes.
+    """
+
+    def __init__(self, namespace: str, directory: str, max_bytes: int):
+        self.namespace = namespace
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+        register_metrics_provider(f"{namespace}_cache", self.stats)
+
+    def file_path(self, key) -> str:
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def get(self, key):
+        value = None
+        try:
+            with open(self.file_path(key), "rb") as cached_file:
+                value = cached_file.read()
+        except FileNotFoundError:
+            increment_counter(f"{self.namespace}_cache_misses")
+            return None
+        except Exception as error:
+            logger.error(error, exc_info=True)
+            return None
+
+        increment_counter(f"{self.namespace}_cache_hits")
+        try:
+            os.utime(self.file_path(key))
+        except OSError:
+            # the file was evicted (or replaced) after it was read, the value read is still valid
+            pass
+
+        return value
+
+    def set(self, key, value: bytes):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # write to a temporary file first so that other processes never read a partially written value
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+            with os.fdopen(file_descriptor, "wb") as temporary_file:
+                temporary_file.write(value)
+            os.replace(temporary_path, self.file_path(key))
+
+            with self.lock:
+                self.bytes_written += len(value)
+                evict = self.bytes_written >= self.max_bytes // 20
+                if evict:
+                    self.bytes_written = 0
+
+            if evict:
+                self.evict()
+
+        except Exception as error:
+            logger.error(error, exc_info=True)
+
+    def evict(self):
+        cached_files = []
+        for directory_entry in os.scandir(self.directory):
+            if directory_entry.is_file() and not directory_entry.name.startswith(".tmp-"):
+                file_stat = directory_entry.stat()
+                cached_files.append((file_stat.st_mtime, file_stat.st_size, directory_entry.path))
+
+        total_bytes = sum(file_size for _, file_size, _ in cached_files)
+        if total_bytes <= self.max_bytes:
+            return
+
+        # evict down to 90% of the limit so that eviction does not run on every write
+        for _, file_size, file_path in sorted(cached_files):
+            if total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(file_path)
+                total_bytes -= file_size
+                increment_counter(f"{self.namespace}_cache_evictions")
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        hits = get_counter(f"{self.namespace}_cache_hits")
+        misses = get_counter(f"{self.namespace}_cache_misses")
+        return {
+            "hits": hits,
+            "misses": misses,
+            "evictions": get_counter(f"{self.namespace}_cache_evictions"),
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+        }
@@ -0,0 +1,284 @@
+import asyncio, datetime, json, logging, weakref
+
+from common.cache import TwoTierCache
+from common.metrics import increment_counter
+from common.tokens import count_tokens, trim_to_token_budget
+from database.database_config import db_conn
+from database.models import Conversation, Messages
+from django_core.config import Config
+from rag_service.openai_service import make_openai_request
+
+logger = logging.getLogger(__name__)
+
+# conversation memory (conversation id, summary & recent turns) of the latest conversation of each user
+chat_history_cache = TwoTierCache(
+    "chat_history",
+    maxsize=Config.CHAT_HISTORY_CACHE_MAXSIZE,
+    ttl=Config.CHAT_HISTORY_CACHE_TTL,
+    local_ttl=Config.CHAT_HISTORY_CACHE_LOCAL_TTL,
+)
+
+# serializes the memory updates of a conversation (within the process)
+conversation_memory_locks = weakref.WeakValueDictionary()
+# references to the running background memory updates (so that they are not garbage collected)
+conversation_memory_tasks = set()
+
+
+def format_turn(turn: dict) -> str:
+    return f"User : {turn.get('user')}\nAI Assistant : {turn.get('assistant')}"
+
+
+def load_recent_turns(conversation: Conversation):
+    """
+    Recent (question, answer) turns kept on the conversation, None for conversations without memory yet.
+    """
+    if conversation is None or conversation.recent_turns is None:
+        return None
+    try:
+        return json.loads(conversation.recent_turns)
+    except ValueError as error:
+        logger.error(error, exc_info=True)
+        return []
+
+
+def split_recent_turns(recent_turns: list, token_budget=None):
+    """
+    Split the turns into the (older turns exceeding the token budget, most recent turns within it) pair,
+    the latest turn is always kept.
+    """
+    token_budget = token_budget or Config.CHAT_HISTORY_RECENT_TURNS_TOKENS
+    kept_tokens = 0
+    kept_from = len(recent_turns)
+    for index in range(len(recent_turns) - 1, -1, -1):
+        kept_tokens += count_tokens(format_turn(recent_turns[index]))
+        if kept_tokens > token_budget and index < len(recent_turns) - 1:
+            break
+        kept_from = index
+
+    return recent_turns[:kept_from], recent_turns[kept_from:]
+
+
+def format_chat_history(summary, recent_turns: list) -> str:
+    """
+    Chat history for the rephrase prompt, the conversation summary followed by the most recent turns.
+    """
+    _, recent_turns = split_recent_turns(recent_turns or [])
+    chat_history = f"\n\nSummary of the earlier conversation : {summary}" if summary else ""
+    for turn in recent_turns:
+        chat_history = chat_history + "\n\n" + format_turn(turn)
+
+    return chat_history
+
+
+def get_conversation_chat_history(conversation: Conversation):
+    """
+    Chat history from the conversation memory (no message history query), None for conversations without memory.
+    """
+    recent_turns = load_recent_turns(conversation)
+    if recent_turns is None:
+        return None
+    return format_chat_history(conversation.summary, recent_turns)
+
+
+def get_cached_conversation_memory(user_id):
+    """
+    Cached memory of the latest conversation of the user: {"conversation_id", "summary", "recent_turns"} or None.
+    """
+    if not Config.CHAT_HISTORY_CACHE_ENABLED or not user_id:
+        return None
+    return chat_history_cache.get(str(user_id))
+
+
+def cache_conversation_memory(user_id, conversation_id, summary, recent_turns):
+    if not Config.CHAT_HISTORY_CACHE_ENABLED or not user_id or recent_turns is None:
+        return
+    _, recent_turns = split_recent_turns(recent_turns)
+    chat_history_cache.set(
+        str(user_id), {"conversation_id": str(conversation_id), "summary": summary, "recent_turns": recent_turns}
+    )
+
+
+def invalidate_user_chat_history(user_id):
+    if Config.CHAT_HISTORY_CACHE_ENABLED and user_id:
+        chat_history_cache.delete(str(user_id))
+
+
+def get_latest_turns_from_messages(conversation_id, exclude_message_id=None, window=Config.CHAT_HISTORY_WINDOW):
+    """
+    Seed the memory of a conversation started before the conversation memory, from its latest messages.
+    """
+    with db_conn:
+        messages = (
+            Messages.select()
+            .where(
+                Messages.conversation_id == conversation_id,
+                Messages.id != exclude_message_id,
+                Messages.is_deleted == False,
+                Messages.translated_message != None,
+                Messages.message_response != None,
+            )
+            .order_by(Messages.created_on.desc())
+            .limit(int(window))
+        )
+        return [new_turn(message.translated_message, message.message_response) for message in reversed(messages)]
+
+
+def new_turn(user_message, assistant_message) -> dict:
+    assistant_message, _ = trim_to_token_budget(assistant_message or "", Config.CHAT_HISTORY_ANSWER_MAX_TOKENS)
+    return {"user": user_message, "assistant": assistant_message}
+
+
+async def summarize_turns(summary, folded_turns):
+    """
+    Fold the turns into the conversation summary with openAI, returns None when the request fails.
+    """
+    summary_prompt = Config.CONVERSATION_SUMMARY_PROMPT.format(
+        summary=summary or "-",
+        turns="\n\n".join(format_turn(turn) for turn in folded_turns),
+        max_words=Config.CONVERSATION_SUMMARY_MAX_WORDS,
+    )
+    summary_response, summary_exception, _ = await make_openai_request(summary_prompt)
+    if not summary_response:
+        logger.error(f"Conversation summary failed: {summary_exception}")
+        return None
+
+    return summary_response.choices[0].message.content.strip()
+
+
+def dump_recent_turns(recent_turns: list):
+    """
+    JSON of the recent turns within the length of the recent_turns column, returns the (JSON, turns kept) pair.
+    The oldest turns are dropped to fit, the text of a single over-long turn is cut.
+    """
+    max_length = Conversation.recent_turns.max_length
+    recent_turns = list(recent_turns)
+    recent_turns_json = json.dumps(recent_turns, ensure_ascii=False)
+    while len(recent_turns_json) > max_length and len(recent_turns) > 1:
+        recent_turns.pop(0)
+        recent_turns_json = json.dumps(recent_turns, ensure_ascii=False)
+
+    while len(recent_turns_json) > max_length:
+        turn = {key: value or "" for key, value in recent_turns[-1].items()}
+        longest_key = max(turn, key=lambda key: len(turn[key]))
+        turn[longest_key] = turn[longest_key][: max(0, len(turn[longest_key]) - (len(recent_turns_json) - max_length))]
+        recent_turns[-1] = turn
+        recent_turns_json = json.dumps(recent_turns, ensure_ascii=False)
+
+    return recent_turns_json, recent_turns
+
+
+def get_conversation_for_update(conversation_id):
+    # locks the conversation row until the end of the transaction, memory updates of other processes wait for it
+    return Conversation.select().where(Conversation.id == conversation_id).for_update().first()
+
+
+def append_conversation_turn(conversation_id, message_id, turn: dict):
+    """
+    Append the turn to the recent turns stored on the conversation (in a transaction holding the conversation row),
+    returns the updated conversation or None when it does not exist.
+    """
+    with db_conn:
+        conversation = get_conversation_for_update(conversation_id)
+        if conversation is None:
+            return None
+
+        recent_turns = load_recent_turns(conversation)
+        if recent_turns is None:
+            recent_turns = get_latest_turns_from_messages(conversation_id, message_id)
+        recent_turns.append(turn)
+        # ring buffer, turns that could not be folded into the summary are dropped past the limit
+        conversation.recent_turns, _ = dump_recent_turns(recent_turns[-Config.CHAT_HISTORY_MAX_TURNS :])
+        conversation.memory_updated_on = datetime.datetime.now()
+        conversation.save(only=[Conversation.recent_turns, Conversation.memory_updated_on])
+
+    return conversation
+
+
+def fold_conversation_turns(conversation_id, previous_summary, folded_turns: list, summary):
+    """
+    Replace the folded turns (the oldest recent turns) by the new summary, the turns appended since the folded turns
+    were read are kept. Nothing is written when another update folded the turns in the meantime (the summary
+    changed or the folded turns are no longer the oldest turns), returns the updated conversation or None.
+    """
+    with db_conn:
+        conversation = get_conversation_for_update(conversation_id)
+        if conversation is None or conversation.summary != previous_summary:
+            return None
+
+        recent_turns = load_recent_turns(conversation) or []
+        if recent_turns[: len(folded_turns)] != folded_turns:
+            return None
+
+        conversation.summary = summary[: Conversation.summary.max_length]
+        conversation.recent_turns, _ = dump_recent_turns(recent_turns[len(folded_turns) :])
+        conversation.memory_updated_on = datetime.datetime.now()
+        conversation.save(only=[Conversation.summary, Conversation.recent_turns, Conversation.memory_updated_on])
+
+    return conversation
+
+
+async def update_conversation_memory(conversation_id, message_id, user_message, assistant_message):
+    """
+    Add the answered turn to the recent turns of the conversation, turns exceeding the recent turns token budget
+    are folded into the conversation summary.
+    """
+    lock = conversation_memory_locks.get(conversation_id)
+    if lock is None:
+        lock = conversation_memory_locks[conversation_id] = asyncio.Lock()
+
+    async with lock:
+        # store the turn right away so that it is in the chat history of the next query
+        conversation = await asyncio.to_thread(
+            append_conversation_turn, conversation_id, message_id, new_turn(user_message, assistant_message)
+        )
+        if conversation is None:
+            return
+
+        recent_turns = load_recent_turns(conversation)
+        await asyncio.to_thread(
+            cache_conversation_memory, conversation.user_id, conversation_id, conversation.summary, recent_turns
+        )
+
+        folded_turns, _ = split_recent_turns(recent_turns)
+        if not folded_turns:
+            return
+
+        summary = await summarize_turns(conversation.summary, folded_turns)
+        if summary is None:
+            # folded turns are kept & summarized with the next update
+            return
+
+        # the turns may have changed while summarizing (ex: a turn appended by another worker process)
+        folded_conversation = await asyncio.to_thread(
+            fold_conversation_turns, conversation_id, conversation.summary, folded_turns, summary
+        )
+        if folded_conversation is None:
+            increment_counter("conversation_summary_conflicts")
+            return
+
+        increment_counter("conversation_summary_updates")
+        await asyncio.to_thread(
+            cache_conversation_memory,
+            conversation.user_id,
+            conversation_id,
+            folded_conversation.summary,
+            load_recent_turns(folded_conversation),
+        )
+
+
+def schedule_conversation_memory_update(conversation_id, message_id, user_message, assistant_message):
+    """
+    Update the conversation memory in the background (after the answer is sent).
+    """
+    if not Config.CONVERSATION_MEMORY_ENABLED or not conversation_id or not user_message or not assistant_message:
+        return
+
+    async def run_update():
+        try:
+            await update_conversation_memory(conversation_id, message_id, user_message, assistant_message)
+        except Exception as error:
+            logger.error(error, exc_info=True)
+
+    memory_task = asyncio.create_task(run_update())
+    conversation_memory_tasks.add(memory_task)
+    memory_task.add_done_callback(conversation_memory_tasks.discard)
@@ -16,6 +16,10 @@ class Constants:
     LANGUAGE_BCP_CODE_NATIVE = Config.LANGUAGE_BCP_CODE_NATIVE
     LANGUAGE_SHORT_CODE_NATIVE = Config.LANGUAGE_SHORT_CODE_NATIVE
 
+    RERANK_MODE_SINGLE = "single"
+    RERANK_MODE_LIST = "list"
+    RERANK_MODE_EARLY_EXIT = "early_exit"
+
     GOOGLE_SPEECH_SYNTHESIS_MODEL = "GOOGLE_SPEECH_SYNTHESIS_MODEL"
     AZURE_SPEECH_SYNTHESIS_MODEL = "AZURE_SPEECH_SYNTHESIS_MODEL"
 
@@ -33,6 +37,45 @@ class Constants:
         "thought of stumping an AI",
     ]
 
+    # common english words used to detect plain english input locally (no overlap with swahili words)
+    ENGLISH_FUNCTION_WORDS = frozenset(
+        (
+            "a about after an and are at be before best by can could do does for from get good has have how i if in "
+            "is it many much my of on or should the their there this to use was what when where which who why will "
+            "with you your"
+        ).split()
+    )
+
+    # words referring back to the chat history, queries with them are rephrased with the chat history
+    REPHRASE_ANAPHORA_WORDS = frozenset(
+        (
+            "it its it's itself they them their theirs those these this that he him his she her hers there same "
+            "one ones former latter above previous earlier again also another other else more such"
+        ).split()
+    )
+    # opening words of follow-up queries (ex: "and for beans?", "what about the dosage?")
+    REPHRASE_FOLLOW_UP_OPENERS = ("and ", "but ", "so ", "then ", "also ", "what about ", "how about ", "why not ")
+
+    REPHRASE_DECISION_NO_CHAT_HISTORY = "no_chat_history"
+    REPHRASE_DECISION_SELF_CONTAINED = "self_contained"
+    REPHRASE_DECISION_ANAPHORA = "anaphora"
+    REPHRASE_DECISION_FOLLOW_UP = "follow_up"
+    REPHRASE_DECISION_SHORT_QUERY = "short_query"
+    REPHRASE_DECISION_CACHE_HIT = "cache_hit"
+    REPHRASE_DECISION_ALWAYS = "always_rephrase"
+
+    RESPONSE_SOURCE_RAG_PIPELINE = "rag_pipeline"
+    RESPONSE_SOURCE_SEMANTIC_CACHE = "semantic_cache"
+    RESPONSE_SOURCE_ANSWER_BANK = "answer_bank"
+    # stands for the user name in cached answers
+    USER_NAME_PLACEHOLDER = "<<user_name>>"
+
+    # number words written as digits in canonical queries (answer bank keys)
+    NUMBER_WORDS = {
+        word: str(number)
+        for number, word in enumerate("zero one two three four five six seven eight nine ten eleven twelve".split())
+    }
+
     HERE_ARE_FOLLOW_UP_QUESTIONS_TO_ASK_TEXT = "\n\nHere are the follow-up questions you can ask:\n"
 
     MP3 = "mp3"
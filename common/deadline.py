@@ -0,0 +1,58 @@
+import asyncio, time
+
+from common.metrics import increment_counter
+from django_core.config import Config
+
+
+class Deadline:
+    """
+    Time budget of a request, created in the API view & passed down to every stage & openAI request of the RAG
+    pipeline so that no stage (or retry) outlives the request.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self) -> float:
+        return max(0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def can_fit(self, seconds: float) -> bool:
+        return self.remaining() >= seconds
+
+
+def new_request_deadline(timeout=None):
+    """
+    Deadline of a new API request, None when request deadlines are disabled.
+    """
+    if not Config.REQUEST_DEADLINE_ENABLED:
+        return None
+    return Deadline(timeout or Config.REQUEST_DEADLINE)
+
+
+def get_stage_timeout(deadline: Deadline, stage_timeout=None):
+    """
+    Timeout (seconds) of a stage, its own timeout bounded by the remaining time of the request (None: no timeout).
+    """
+    if deadline is None:
+        return stage_timeout or None
+    if not stage_timeout:
+        return deadline.remaining()
+    return min(stage_timeout, deadline.remaining())
+
+
+async def run_stage(stage, awaitable, deadline: Deadline, stage_timeout=None):
+    """
+    Await the stage within its timeout, raises asyncio.TimeoutError (counted per stage) when it expires.
+    """
+    timeout = get_stage_timeout(deadline, stage_timeout)
+    if timeout is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError as error:
+        increment_counter(f"{stage}_stage_timeouts")
+        raise asyncio.TimeoutError(f"{stage} stage timed out after {timeout:.1f} seconds") from error
@@ -0,0 +1,47 @@
+import logging, threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# process wide (per gunicorn worker / celery process) counters & gauges
+metrics_lock = threading.Lock()
+counters = defaultdict(int)
+gauges = {}
+metrics_providers = {}
+
+
+def increment_counter(name: str, value: int = 1):
+    with metrics_lock:
+        counters[name] += value
+
+
+def get_counter(name: str) -> int:
+    with metrics_lock:
+        return counters.get(name, 0)
+
+
+def set_gauge(name: str, value):
+    with metrics_lock:
+        gauges[name] = value
+
+
+def register_metrics_provider(name: str, provider):
+    """
+    Register a callable returning a dict of metrics, evaluated lazily every time the metrics are read.
+    """
+    with metrics_lock:
+        metrics_providers[name] = provider
+
+
+def get_metrics() -> dict:
+    with metrics_lock:
+        metrics = {"counters": dict(counters), "gauges": dict(gauges)}
+        providers = dict(metrics_providers)
+
+    for name, provider in providers.items():
+        try:
+            metrics[name] = provider()
+        except Exception as error:
+            logger.error(error, exc_info=True)
+
+    return metrics
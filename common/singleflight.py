@@ -0,0 +1,39 @@
+import asyncio, threading, weakref
+
+from common.metrics import increment_counter
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key into one call: the first caller (the leader) starts the call as a
+    task & the callers arriving while it is in flight await the same task instead of making the call themselves.
+    The call is shielded, so a cancelled caller (ex: a closed stream) does not cancel it for the others.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        # in-flight calls keyed by the event loop they run on
+        self.calls = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    async def run(self, key, coroutine_function, *args, **kwargs):
+        """
+        Run (or join) the call of the key, returns the (result, is_leader) pair.
+        """
+        event_loop = asyncio.get_running_loop()
+        with self.lock:
+            calls = self.calls.setdefault(event_loop, {})
+            call_task = calls.get(key)
+            is_leader = call_task is None
+            if is_leader:
+                call_task = calls[key] = asyncio.create_task(coroutine_function(*args, **kwargs))
+                call_task.add_done_callback(lambda _: self.forget(event_loop, key, call_task))
+
+        increment_counter(f"{self.name}_leaders" if is_leader else f"{self.name}_followers")
+        return await asyncio.shield(call_task), is_leader
+
+    def forget(self, event_loop, key, call_task):
+        with self.lock:
+            calls = self.calls.get(event_loop, {})
+            if calls.get(key) is call_task:
+                del calls[key]
@@ -0,0 +1,74 @@
+import logging, math, threading
+import tiktoken
+
+from common.constants import Constants
+from django_core.config import Config
+from language_service.translation import split_into_sentences
+
+logger = logging.getLogger(__name__)
+
+token_encodings = {}
+token_encodings_lock = threading.Lock()
+
+
+def get_token_encoding(model=None):
+    """
+    tiktoken encoding of the model, loaded once per process. Returns None when the encoding can't be loaded
+    (the BPE files are downloaded on first use, set TIKTOKEN_CACHE_DIR to ship them with the image).
+    """
+    model = model or Config.GPT_4_TURBO_PREVIEW_LATEST
+    with token_encodings_lock:
+        if model not in token_encodings:
+            try:
+                try:
+                    token_encodings[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    token_encodings[model] = tiktoken.get_encoding(Config.TOKEN_ENCODING_DEFAULT)
+            except Exception as error:
+                logger.error(error, exc_info=True)
+                token_encodings[model] = None
+        return token_encodings[model]
+
+
+def warm_up_token_encodings(models=None):
+    """
+    Load the encodings of the models ahead of the first request, loading one reads (or downloads) its BPE file which
+    would otherwise block the event loop of the first request counting tokens. Meant to be called once per worker.
+    """
+    models = models or (Config.GPT_4_TURBO_PREVIEW_LATEST, Config.GPT_3_5_TURBO, Constants.EMBEDDING_MODEL)
+    for model in models:
+        get_token_encoding(model)
+    logger.info(f"Token encodings warmed up for the models {', '.join(models)}")
+
+
+def count_tokens(text, model=None) -> int:
+    """
+    Number of tokens of the text for the model, estimated by characters when the encoding is not available.
+    """
+    if not text:
+        return 0
+    encoding = get_token_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / Config.TOKEN_ESTIMATE_CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def trim_to_token_budget(text, max_tokens, model=None):
+    """
+    Trim the text at sentence boundaries to fit in max_tokens, returns the (trimmed text, tokens) pair.
+    Returns an empty text when not even the first sentence fits.
+    """
+    text_tokens = count_tokens(text, model)
+    if text_tokens <= max_tokens:
+        return text, text_tokens
+
+    trimmed_sentences = []
+    trimmed_tokens = 0
+    for sentence in split_into_sentences(text):
+        sentence_tokens = count_tokens(sentence, model)
+        if trimmed_tokens + sentence_tokens > max_tokens:
+            break
+        trimmed_sentences.append(sentence)
+        trimmed_tokens += sentence_tokens
+
+    return "".join(trimmed_sentences).strip(), trimmed_tokens
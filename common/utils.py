@@ -1,10 +1,13 @@
-import logging, json, certifi, re, uuid, base64, regex
+import asyncio, logging, json, certifi, os, re, threading, uuid, base64, regex, unicodedata
+from urllib.parse import urlsplit
 from peewee import DoesNotExist
 from requests import Request, Session
 from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
 
+from common.chat_history import format_chat_history, invalidate_user_chat_history, new_turn
 from common.constants import Constants
+from common.metrics import increment_counter, register_metrics_provider
 from database.db_operations import create_record, get_record_by_field, update_record
 from database.database_config import db_conn
 from database.models import Conversation, Messages, User, FollowUpQuestion, Language
@@ -14,6 +17,78 @@ from language_service.translation import *
 
 logger = logging.getLogger(__name__)
 
+# process wide pooled HTTP sessions keyed by (scheme://host, total_retry)
+http_sessions = {}
+http_adapters = {}
+http_sessions_lock = threading.Lock()
+http_sessions_pid = None
+
+
+def get_http_session(url, total_retry=10):
+    """
+    Return the process wide Session for the host of the url (and retry policy), so that keep-alive connections
+    to the host are pooled and reused across requests & threads instead of doing a fresh TLS handshake per call.
+    """
+    global http_sessions_pid
+    url_parts = urlsplit(url)
+    base_url = f"{url_parts.scheme}://{url_parts.netloc}"
+    session_key = (base_url, total_retry)
+
+    with http_sessions_lock:
+        if http_sessions_pid != os.getpid():
+            # pooled connections can not be shared with the parent of a forked worker process
+            http_sessions.clear()
+            http_adapters.clear()
+            http_sessions_pid = os.getpid()
+
+        session = http_sessions.get(session_key)
+        if not session:
+            retries = Retry(
+                total=total_retry,
+                backoff_factor=0.1,
+                status_forcelist=[403, 502, 503, 504],
+                allowed_methods={"GET", "POST", "PUT"},
+            )
+            adapter = HTTPAdapter(
+                pool_connections=Config.HTTP_POOL_CONNECTIONS,
+                pool_maxsize=Config.HTTP_POOL_MAXSIZE,
+                pool_block=Config.HTTP_POOL_BLOCK,
+                max_retries=retries,
+            )
+            session = Session()
+            session.mount(base_url, adapter)
+            http_sessions[session_key] = session
+            http_adapters[session_key] = adapter
+            increment_counter("http_sessions_created")
+
+    return session
+
+
+def get_http_connection_stats() -> dict:
+    """
+    Connection reuse counters of the pooled sessions, new_connections should stay flat at steady state.
+    """
+    connection_stats = {"requests": 0, "new_connections": 0, "reused_connections": 0, "hosts": {}}
+    with http_sessions_lock:
+        adapters = dict(http_adapters)
+
+    for (base_url, total_retry), adapter in adapters.items():
+        host_stats = connection_stats["hosts"].setdefault(base_url, {"requests": 0, "new_connections": 0})
+        pools = adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool:
+                host_stats["requests"] += pool.num_requests
+                host_stats["new_connections"] += pool.num_connections
+
+    for host_stats in connection_stats["hosts"].values():
+        host_stats["reused_connections"] = max(host_stats["requests"] - host_stats["new_connections"], 0)
+        connection_stats["requests"] += host_stats["requests"]
+        connection_stats["new_connections"] += host_stats["new_connections"]
+        connection_stats["reused_connections"] += host_stats["reused_connections"]
+
+    return connection_stats
+
 
 def send_request(
     url, headers={}, data=None, content_type="form-data", request_type="GET", total_retry=10, params=None
@@ -25,29 +100,16 @@ def send_request(
             data = json.dumps(data)
 
         request_obj = Request(request_type, url, data=data, headers=headers, params=params)
-        session = Session()
+        session = get_http_session(url, total_retry)
         request_prepped = session.prepare_request(request_obj)
-        retries = Retry(
-            total=total_retry,
-            backoff_factor=0.1,
-            status_forcelist=[403, 502, 503, 504],
-            allowed_methods={"GET", "POST", "PUT"},
-        )
-        session.mount(url, HTTPAdapter(max_retries=retries))
+        # the response body is read right away so that the connection goes back to the pool
         response = session.send(
             request_prepped,
-            stream=True,
             verify=certifi.where(),
             # verify=False,
         )
-
-        print(
-            {
-                "function": "send_request",
-                "response_status": response.status_code,
-                "url": url,
-            }
-        )
+        increment_counter("http_requests")
+        logger.debug(f"send_request {request_type} {url}: {response.status_code}")
 
     except Exception as error:
         logger.error(error, exc_info=True)
@@ -55,6 +117,9 @@ def send_request(
     return response
 
 
+register_metrics_provider("http_connections", get_http_connection_stats)
+
+
 def get_or_create_latest_conversation(conversation_data: dict) -> Conversation:
     conversation = None
     user_id = conversation_data.get("user_id", None)
@@ -70,6 +135,7 @@ def get_or_create_latest_conversation(conversation_data: dict) -> Conversation:
         conversation = conversation_qs.get() if len(conversation_qs) >= 1 else None
         if not conversation:
             conversation = create_record(Conversation, conversation_data)
+            invalidate_user_chat_history(user_id)
             logger.info(f"New conversation created for user_id:{user_id}")
 
     except Exception as error:
@@ -97,11 +163,10 @@ def get_user_chat_history(user_id, window=Config.CHAT_HISTORY_WINDOW):
             .order_by(Messages.created_on.desc())
             .limit(window)
         )
-        chat_history = ""
-        for message in reversed(messages):
-            chat_history = (
-                chat_history + f"\n\nUser : {message.translated_message}\nAI Assistant : {message.message_response}"
-            )
+        # latest messages within the recent turns token budget
+        chat_history = format_chat_history(
+            None, [new_turn(message.translated_message, message.message_response) for message in reversed(messages)]
+        )
         # history.append((message.translated_message, message.message_response))
 
     # logger.info(f"User chat history :\n {chat_history}")
@@ -164,98 +229,171 @@ def create_follow_up_questions(data) -> FollowUpQuestion:
     return inserted_objs
 
 
+async def translate_sentence(sentence, input_language, output_language):
+    if not sentence.strip() or input_language == Constants.LANGUAGE_SHORT_CODE_ENG:
+        return sentence
+
+    return await a_translate_to(sentence, output_language)
+
+
+async def translate_and_stream_response(text, input_language, output_language, stream_handler):
+    """
+    Translate the text sentence by sentence concurrently, handing every translated sentence over to the
+    stream handler in order as soon as it is ready.
+    """
+    translated_sentences = []
+    translation_tasks = [
+        asyncio.create_task(translate_sentence(sentence, input_language, output_language))
+        for sentence in split_into_sentences(text)
+    ]
+    for translation_task in translation_tasks:
+        translated_sentence = await translation_task
+        translated_sentences.append(translated_sentence)
+        await stream_handler("translation", translated_sentence)
+
+    return "".join(translated_sentences)
+
+
+def split_follow_up_questions(original_response):
+    """
+    Split the generated response into the answer & its (up to 3) english follow-up questions,
+    the questions are None when the response has no follow-up questions header.
+    """
+    split_string_list = [
+        "Example Questions:\n",
+        "Here are a few questions that may help:",
+        "Here are a few follow-up questions that may help:",
+        "**Example Questions:**",
+        "As follow-up questions, users can ask:",
+        "As follow-up questions, you can ask:",
+        "As follow-up questions, here are some examples based on the context provided:",
+    ]
+    if original_response:
+        for substring in split_string_list:
+            if substring in original_response:
+                (final_response, questions) = original_response.split(substring, 1)
+                return final_response.strip(), questions.strip().split("\n")[:3]
+
+    return original_response, None
+
+
+async def translate_response_and_follow_up_questions(
+    final_response,
+    follow_up_questions,
+    input_language,
+    message_id,
+    with_db_config=Config.WITH_DB_CONFIG,
+    stream_handler=None,
+):
+    """
+    Translate the answer followed by the follow-up questions block (localized header & questions) to the input
+    language & store the follow-up questions of the message. Returns the (translated response, final response,
+    follow-up question options, follow-up question rows) tuple, the final response is the english answer followed
+    by the questions.
+    """
+    follow_up_question_options = []
+    follow_up_question_data_to_insert = []
+    output_language = input_language.split("-")[0] if "-" in input_language else input_language
+
+    # the answer, the follow-up header & the questions are translated together in one batched request
+    follow_up_segments = [Constants.HERE_ARE_FOLLOW_UP_QUESTIONS_TO_ASK_TEXT] + [
+        f"{question}\n" for question in follow_up_questions
+    ]
+    if stream_handler:
+        translated_response, translated_follow_up_segments = await asyncio.gather(
+            translate_and_stream_response(final_response, input_language, output_language, stream_handler),
+            (
+                a_translate_batch(follow_up_segments, output_language)
+                if input_language != Constants.LANGUAGE_SHORT_CODE_ENG
+                else asyncio.sleep(0, result=follow_up_segments)
+            ),
+        )
+    elif input_language != Constants.LANGUAGE_SHORT_CODE_ENG:
+        translated_segments = await a_translate_batch([final_response] + follow_up_segments, output_language)
+        translated_response, translated_follow_up_segments = translated_segments[0], translated_segments[1:]
+    else:
+        translated_response, translated_follow_up_segments = final_response, follow_up_segments
+
+    translated_response += translated_follow_up_segments[0]
+
+    key = 0
+    for question, translated_question in zip(follow_up_questions, translated_follow_up_segments[1:]):
+        final_response += f"{question}\n"
+        translated_response += translated_question
+
+        key += 1
+        follow_up_question_id = uuid.uuid4()
+        follow_up_question_text = re.sub("[1-3]\.\s*", "", str(translated_question).strip(), count=1)
+        follow_up_question_options.append(
+            {
+                "id": str(follow_up_question_id),
+                "name": str(key),
+                "question": follow_up_question_text,
+            }
+        )
+
+        # append insertion data or saving of questions in FollowUpQuestion table
+        follow_up_question_data_to_insert.append(
+            {
+                "id": follow_up_question_id,
+                "message": follow_up_question_text,
+                "ref_id": message_id,
+                "follow_up_question_type": "message",
+                "sequence": key,
+            }
+        )
+
+    if stream_handler:
+        await stream_handler("follow_up_questions", follow_up_question_options)
+
+    # insert data in FollowUpQuestion table
+    if len(follow_up_question_data_to_insert) > 1 and with_db_config:
+        await asyncio.to_thread(create_follow_up_questions, follow_up_question_data_to_insert)
+
+    return (
+        translated_response,
+        final_response,
+        follow_up_question_options,
+        follow_up_question_data_to_insert,
+    )
+
+
 #### TBD: Move DB queries outside this module
 async def postprocess_and_translate_query_response(
-    original_response, input_language, message_id, with_db_config=Config.WITH_DB_CONFIG
+    original_response, input_language, message_id, with_db_config=Config.WITH_DB_CONFIG, stream_handler=None
 ):
     final_response = ""
-    questions = ""
-    resource_message_text = ""
-    resource_translation = ""
     translated_response = ""
     follow_up_question_options = []
     follow_up_question_data_to_insert = []
 
     try:
         output_language = input_language.split("-")[0] if "-" in input_language else input_language
-        split_string_list = [
-            "Example Questions:\n",
-            "Here are a few questions that may help:",
-            "Here are a few follow-up questions that may help:",
-            "**Example Questions:**",
-            "As follow-up questions, users can ask:",
-            "As follow-up questions, you can ask:",
-            "As follow-up questions, here are some examples based on the context provided:",
-        ]
-        index = -1
-        if original_response:
-            for substring in split_string_list:
-                index = original_response.find(substring)
-                if index != -1:
-                    string_index = split_string_list.index(substring)
-                    (final_response, questions) = original_response.split(split_string_list[string_index])
-                    final_response = final_response.strip()
-                    questions = questions.strip()
-                    break
-
-        if index != -1:
-            translated_response = (
-                await a_translate_to(final_response, output_language)
-                if input_language != Constants.LANGUAGE_SHORT_CODE_ENG
-                else final_response
-            )
-
-            translated_response += (
-                await a_translate_to(Constants.HERE_ARE_FOLLOW_UP_QUESTIONS_TO_ASK_TEXT, output_language)
-                if input_language != Constants.LANGUAGE_SHORT_CODE_ENG
-                else Constants.HERE_ARE_FOLLOW_UP_QUESTIONS_TO_ASK_TEXT
+        final_response, follow_up_questions = split_follow_up_questions(original_response)
+
+        if follow_up_questions is not None:
+            return await translate_response_and_follow_up_questions(
+                final_response,
+                follow_up_questions,
+                input_language,
+                message_id,
+                with_db_config=with_db_config,
+                stream_handler=stream_handler,
             )
 
-            key = 0
-            for question in questions.split("\n")[:3]:
-                final_response += f"{question}\n"
-                translated_question = (
-                    await a_translate_to(f"{question}\n", output_language)
-                    if input_language != Constants.LANGUAGE_SHORT_CODE_ENG
-                    else f"{question}\n"
-                )
-
-                translated_response += translated_question
-
-                key += 1
-                follow_up_question_id = uuid.uuid4()
-                follow_up_question_text = re.sub("[1-3]\.\s*", "", str(translated_question).strip(), count=1)
-                follow_up_question_options.append(
-                    {
-                        "id": str(follow_up_question_id),
-                        "name": str(key),
-                        "question": follow_up_question_text,
-                    }
-                )
-
-                # append insertion data or saving of questions in FollowUpQuestion table
-                follow_up_question_data_to_insert.append(
-                    {
-                        "id": follow_up_question_id,
-                        "message": follow_up_question_text,
-                        "ref_id": message_id,
-                        "follow_up_question_type": "message",
-                        "sequence": key,
-                    }
-                )
-
-            # insert data in FollowUpQuestion table
-            if len(follow_up_question_data_to_insert) > 1 and with_db_config:
-                create_follow_up_questions(follow_up_question_data_to_insert)
-
         else:
             # if original_response does not have "Example Questions:\n" translate original_response as it is
             final_response = original_response
-            translated_response = (
-                await a_translate_to(final_response, output_language)
-                if input_language != Constants.LANGUAGE_SHORT_CODE_ENG
-                else final_response
-            )
+            if stream_handler and final_response:
+                translated_response = await translate_and_stream_response(
+                    final_response, input_language, output_language, stream_handler
+                )
+            else:
+                translated_response = (
+                    await a_translate_to(final_response, output_language)
+                    if input_language != Constants.LANGUAGE_SHORT_CODE_ENG
+                    else final_response
+                )
 
     except Exception as error:
         logger.error(error, exc_info=True)
@@ -291,12 +429,38 @@ def clean_text(text):
     return text
 
 
-def encode_binary_to_base64(audio_file):
+def normalize_query(text):
+    """
+    Normalize a query for cache keys & comparisons, lowercase without punctuation & repeated whitespace.
+    """
+    text = regex.sub(r"[^\p{L}\p{M}\p{N}\s]", " ", text or "", flags=regex.UNICODE)
+    return " ".join(text.lower().split())
+
+
+def canonicalize_query(text):
+    """
+    Canonical form of a query for exact matching, normalize_query with the unicode digits (ex: full width or
+    arabic-indic) & the number words (zero to twelve) written as ascii digits.
+    """
+    text = unicodedata.normalize("NFKC", text or "")
+    text = "".join(str(unicodedata.decimal(char)) if char.isdecimal() else char for char in text)
+    return " ".join(Constants.NUMBER_WORDS.get(word, word) for word in normalize_query(text).split())
+
+
+def replace_user_name(text, user_name, replacement):
+    """
+    Replace the user name (whole words only) in the text, ex: by a placeholder in answers shared between users.
+    """
+    if not text or not user_name:
+        return text
+    name_pattern = rf"(?<![\p{{L}}\p{{N}}]){regex.escape(user_name)}(?![\p{{L}}\p{{N}}])"
+    return regex.sub(name_pattern, lambda _: replacement, text, flags=regex.UNICODE)
+
+
+def encode_binary_to_base64(audio_binary_data):
     base64_string = None
     try:
-        with open(audio_file, "rb") as audio_file_buffer:
-            audio_binary_data = audio_file_buffer.read()
-            base64_string = base64.b64encode(audio_binary_data).decode()
+        base64_string = base64.b64encode(audio_binary_data).decode() if audio_binary_data else None
 
     except Exception as error:
         logger.error(error, exc_info=True)
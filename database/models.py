@@ -105,6 +105,9 @@ class Conversation(BaseModel):
     user = ForeignKeyField(User, backref="user")
     title = CharField(max_length=255, null=True)
     language = ForeignKeyField(Language, backref="language", null=True)
+    summary = CharField(max_length=10000, null=True)
+    recent_turns = CharField(max_length=20000, null=True)
+    memory_updated_on = DateTimeField(null=True)
 
     class Meta:
         table_name = "conversation"
@@ -142,6 +145,8 @@ class Messages(BaseModel):
     retrieved_chunks = CharField(max_length=20000, null=True)
     condensed_question = CharField(max_length=20000, null=True)
     telegram_message_chat_id = CharField(max_length=50, null=True)
+    response_source = CharField(max_length=50, null=True)
+    generated_response = CharField(max_length=10000, null=True)
 
     class Meta:
         table_name = "messages"
@@ -286,6 +291,7 @@ class RerankMetrics(BaseModel):
     is_rerank_response_parsed = BooleanField(default=False)
     rerank_exception = CharField(null=True, max_length=20000)
     rerank_retries = CharField(null=True, max_length=4)
+    context_tokens = IntegerField(null=True)
 
     class Meta:
         table_name = "rerank_metrics"
@@ -317,6 +323,7 @@ class RephraseMetrics(BaseModel):
     is_rerank_response_parsed = BooleanField(default=False)
     rephrase_exception = CharField(null=True, max_length=20000)
     rephrase_retries = CharField(null=True, max_length=4)
+    rephrase_decision = CharField(null=True, max_length=50)
 
     class Meta:
         table_name = "rephrase_metrics"
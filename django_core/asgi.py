@@ -20,3 +20,15 @@ application = ProtocolTypeRouter(
         # Add other protocol routers here, like WebSockets if needed
     }
 )
+
+# gunicorn imports the application in every worker after forking, warm up the per worker Google Cloud clients
+# & the token encodings (counted on the event loop by every request)
+from common.tokens import warm_up_token_encodings
+from django_core.config import Config
+
+if Config.GOOGLE_CLIENTS_WARM_UP:
+    from language_service.clients import warm_up_google_clients
+
+    warm_up_google_clients()
+
+warm_up_token_encodings()
@@ -1,6 +1,7 @@
 import os
 from celery import Celery, signals
 from database.database_config import pooled_db_conn
+from django_core.config import Config
 
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "django_core.settings")
@@ -36,3 +37,16 @@ def task_prerun_handler(task_id, task, *args, **kwargs):
 def task_postrun_handler(task_id, task, *args, **kwargs):
     if not db_conn.is_closed():
         db_conn.close()
+
+
+@signals.worker_process_init.connect
+def worker_process_init_handler(*args, **kwargs):
+    # every prefork child creates its own Google Cloud clients & loads its token encodings, before the first task
+    if Config.GOOGLE_CLIENTS_WARM_UP:
+        from language_service.clients import warm_up_google_clients
+
+        warm_up_google_clients()
+
+    from common.tokens import warm_up_token_encodings
+
+    warm_up_token_encodings()
@@ -1,4 +1,4 @@
-import os
+import json, os, tempfile
 from dotenv import load_dotenv, dotenv_values
 
 # load_dotenv()
@@ -23,6 +23,34 @@ class Config:
     REPHRASE_QUESTION_PROMPT = ENV_CONFIG.get("REPHRASE_QUESTION_PROMPT")
     RERANKING_PROMPT_SINGLE_TEMPLATE = ENV_CONFIG.get("RERANKING_PROMPT_SINGLE_TEMPLATE")
     RERANK_SINGLE_JSON_EXAMPLE = ENV_CONFIG.get("RERANK_SINGLE_JSON_EXAMPLE")
+    RERANKING_PROMPT_LIST_TEMPLATE = ENV_CONFIG.get(
+        "RERANKING_PROMPT_LIST_TEMPLATE",
+        "You are given a question and a list of text chunks, each one tagged with an ID in square brackets.\n"
+        "For every text chunk classify whether it is relevant to answer the question (YES or NO) and give it a "
+        "relevance_score from 1 (least relevant) to 10 (most relevant).\n"
+        "Respond only with a JSON array holding one object per text chunk, in this format:\n{json_example}\n\n"
+        "Question: {question}\n\nText chunks:\n{chunks}",
+    )
+    RERANK_LIST_JSON_EXAMPLE = ENV_CONFIG.get(
+        "RERANK_LIST_JSON_EXAMPLE",
+        '[{"id": "c1", "classification": "YES", "relevance_score": 8}, '
+        '{"id": "c2", "classification": "NO", "relevance_score": 2}]',
+    )
+
+    # rerank mode: "single" (one openAI request per chunk), "list" (batches of chunks per request) or
+    # "early_exit" (one request per chunk, stops on enough relevant chunks or when the latency budget expires)
+    RERANK_MODE = ENV_CONFIG.get("RERANK_MODE", "single")
+    RERANK_LIST_BATCH_SIZE = int(ENV_CONFIG.get("RERANK_LIST_BATCH_SIZE", 10))
+    RERANK_LATENCY_BUDGET = float(ENV_CONFIG.get("RERANK_LATENCY_BUDGET", 8))
+    RERANK_CONTEXT_CHUNKS = int(ENV_CONFIG.get("RERANK_CONTEXT_CHUNKS", 6))
+    RERANK_CACHE_ENABLED = str(ENV_CONFIG.get("RERANK_CACHE_ENABLED", True)).lower() == "true"
+    RERANK_CACHE_MAXSIZE = int(ENV_CONFIG.get("RERANK_CACHE_MAXSIZE", 50000))
+    RERANK_CACHE_TTL = int(ENV_CONFIG.get("RERANK_CACHE_TTL", 7 * 24 * 60 * 60))
+
+    # generation context packing, reranked chunks are added by relevance until the token budget is filled
+    CONTEXT_TOKEN_BUDGET = int(ENV_CONFIG.get("CONTEXT_TOKEN_BUDGET", 3000))
+    TOKEN_ENCODING_DEFAULT = ENV_CONFIG.get("TOKEN_ENCODING_DEFAULT", "cl100k_base")
+    TOKEN_ESTIMATE_CHARS_PER_TOKEN = float(ENV_CONFIG.get("TOKEN_ESTIMATE_CHARS_PER_TOKEN", 4))
 
     # openAI config
     OPEN_AI_KEY = ENV_CONFIG.get("OPENAI_API_KEY")
@@ -35,14 +63,142 @@ class Config:
     MAX_TOKENS = ENV_CONFIG.get("MAX_TOKENS", 500)
     CHAT_HISTORY_WINDOW = ENV_CONFIG.get("CHAT_HISTORY_WINDOW", 4)
 
+    # rephrasing, self-contained queries (at least REPHRASE_SKIP_MIN_WORDS words, no reference to the chat history)
+    # skip the rephrase request, rephrased queries are cached by (query, chat history)
+    REPHRASE_SKIP_ENABLED = str(ENV_CONFIG.get("REPHRASE_SKIP_ENABLED", True)).lower() == "true"
+    REPHRASE_SKIP_MIN_WORDS = int(ENV_CONFIG.get("REPHRASE_SKIP_MIN_WORDS", 5))
+    REPHRASE_CACHE_ENABLED = str(ENV_CONFIG.get("REPHRASE_CACHE_ENABLED", True)).lower() == "true"
+    REPHRASE_CACHE_MAXSIZE = int(ENV_CONFIG.get("REPHRASE_CACHE_MAXSIZE", 10000))
+    REPHRASE_CACHE_TTL = int(ENV_CONFIG.get("REPHRASE_CACHE_TTL", 24 * 60 * 60))
+
+    # conversation memory (rolling summary + token bounded recent turns) used as the chat history
+    CONVERSATION_MEMORY_ENABLED = str(ENV_CONFIG.get("CONVERSATION_MEMORY_ENABLED", True)).lower() == "true"
+    CHAT_HISTORY_RECENT_TURNS_TOKENS = int(ENV_CONFIG.get("CHAT_HISTORY_RECENT_TURNS_TOKENS", 600))
+    CHAT_HISTORY_ANSWER_MAX_TOKENS = int(ENV_CONFIG.get("CHAT_HISTORY_ANSWER_MAX_TOKENS", 200))
+    CHAT_HISTORY_MAX_TURNS = int(ENV_CONFIG.get("CHAT_HISTORY_MAX_TURNS", 20))
+    # per user conversation memory cache, entries are served from the worker (in process) cache for at most
+    # CHAT_HISTORY_CACHE_LOCAL_TTL seconds, from the shared (redis) cache afterwards
+    CHAT_HISTORY_CACHE_ENABLED = str(ENV_CONFIG.get("CHAT_HISTORY_CACHE_ENABLED", True)).lower() == "true"
+    CHAT_HISTORY_CACHE_MAXSIZE = int(ENV_CONFIG.get("CHAT_HISTORY_CACHE_MAXSIZE", 10000))
+    CHAT_HISTORY_CACHE_TTL = int(ENV_CONFIG.get("CHAT_HISTORY_CACHE_TTL", 24 * 60 * 60))
+    CHAT_HISTORY_CACHE_LOCAL_TTL = float(ENV_CONFIG.get("CHAT_HISTORY_CACHE_LOCAL_TTL", 5))
+    CONVERSATION_SUMMARY_MAX_WORDS = int(ENV_CONFIG.get("CONVERSATION_SUMMARY_MAX_WORDS", 120))
+    CONVERSATION_SUMMARY_PROMPT = ENV_CONFIG.get(
+        "CONVERSATION_SUMMARY_PROMPT",
+        "Update the summary of a conversation between a farmer (User) and an agricultural AI assistant with the new "
+        "conversation turns. Keep the crops, livestock, problems, locations & advice discussed so that follow-up "
+        "questions can be understood. Respond only with the updated summary, in at most {max_words} words.\n\n"
+        "Current summary:\n{summary}\n\nNew conversation turns:\n{turns}",
+    )
+
+    # openAI client connection pool (shared per process & event loop)
+    OPENAI_MAX_CONNECTIONS = int(ENV_CONFIG.get("OPENAI_MAX_CONNECTIONS", 100))
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(ENV_CONFIG.get("OPENAI_MAX_KEEPALIVE_CONNECTIONS", 20))
+    OPENAI_KEEPALIVE_EXPIRY = float(ENV_CONFIG.get("OPENAI_KEEPALIVE_EXPIRY", 30))
+    OPENAI_REQUEST_TIMEOUT = float(ENV_CONFIG.get("OPENAI_REQUEST_TIMEOUT", 600))
+    OPENAI_HTTP2 = str(ENV_CONFIG.get("OPENAI_HTTP2", False)).lower() == "true"
+
+    # openAI rate limiter, requests & tokens per minute per model (JSON: {"<model>": {"rpm": .., "tpm": ..}},
+    # "default" applies to the other models), shared by the workers through redis (REDIS_URL), split evenly between
+    # OPENAI_RATE_LIMIT_FALLBACK_PROCESSES processes when redis is not available
+    OPENAI_RATE_LIMIT_ENABLED = str(ENV_CONFIG.get("OPENAI_RATE_LIMIT_ENABLED", True)).lower() == "true"
+    OPENAI_RATE_LIMITS = json.loads(ENV_CONFIG.get("OPENAI_RATE_LIMITS") or "{}") or {
+        GPT_4_TURBO_PREVIEW_LATEST: {"rpm": 500, "tpm": 300000},
+        GPT_3_5_TURBO: {"rpm": 3500, "tpm": 160000},
+    }
+    OPENAI_RATE_LIMIT_COMPLETION_TOKENS = int(ENV_CONFIG.get("OPENAI_RATE_LIMIT_COMPLETION_TOKENS", 300))
+    OPENAI_RATE_LIMIT_FALLBACK_PROCESSES = int(ENV_CONFIG.get("OPENAI_RATE_LIMIT_FALLBACK_PROCESSES", 4))
+    OPENAI_RATE_LIMIT_MAX_WAIT = float(ENV_CONFIG.get("OPENAI_RATE_LIMIT_MAX_WAIT", 60))
+
+    # adaptive (AIMD) limit of the in-flight openAI requests per model & event loop, grows while requests succeed
+    # within HEALTHY_LATENCY seconds & is multiplied by BACKOFF on rate limited or timed out requests
+    OPENAI_CONCURRENCY_LIMIT_ENABLED = str(ENV_CONFIG.get("OPENAI_CONCURRENCY_LIMIT_ENABLED", True)).lower() == "true"
+    OPENAI_CONCURRENCY_INITIAL_LIMIT = int(ENV_CONFIG.get("OPENAI_CONCURRENCY_INITIAL_LIMIT", 16))
+    OPENAI_CONCURRENCY_MIN_LIMIT = int(ENV_CONFIG.get("OPENAI_CONCURRENCY_MIN_LIMIT", 2))
+    OPENAI_CONCURRENCY_MAX_LIMIT = int(ENV_CONFIG.get("OPENAI_CONCURRENCY_MAX_LIMIT", 100))
+    OPENAI_CONCURRENCY_BACKOFF = float(ENV_CONFIG.get("OPENAI_CONCURRENCY_BACKOFF", 0.5))
+    OPENAI_CONCURRENCY_HEALTHY_LATENCY = float(ENV_CONFIG.get("OPENAI_CONCURRENCY_HEALTHY_LATENCY", 10))
+
+    # per request deadline (seconds) from the API view through every stage & openAI request of the RAG pipeline,
+    # a stage gets at most its own timeout of the remaining time & openAI requests are not (re)tried when less than
+    # OPENAI_MIN_ATTEMPT_TIME seconds are left
+    REQUEST_DEADLINE_ENABLED = str(ENV_CONFIG.get("REQUEST_DEADLINE_ENABLED", True)).lower() == "true"
+    REQUEST_DEADLINE = float(ENV_CONFIG.get("REQUEST_DEADLINE", 60))
+    REPHRASE_STAGE_TIMEOUT = float(ENV_CONFIG.get("REPHRASE_STAGE_TIMEOUT", 10))
+    RETRIEVAL_STAGE_TIMEOUT = float(ENV_CONFIG.get("RETRIEVAL_STAGE_TIMEOUT", 15))
+    RERANK_STAGE_TIMEOUT = float(ENV_CONFIG.get("RERANK_STAGE_TIMEOUT", 20))
+    GENERATION_STAGE_TIMEOUT = float(ENV_CONFIG.get("GENERATION_STAGE_TIMEOUT", 40))
+    OPENAI_MIN_ATTEMPT_TIME = float(ENV_CONFIG.get("OPENAI_MIN_ATTEMPT_TIME", 2))
+
+    # concurrent identical queries (same translated query, language & chat history) share one RAG pipeline run
+    REQUEST_COALESCING_ENABLED = str(ENV_CONFIG.get("REQUEST_COALESCING_ENABLED", True)).lower() == "true"
+
     # Content Retrieval APIs
     CONTENT_DOMAIN_URL = ENV_CONFIG.get("CONTENT_DOMAIN_URL")
     CONTENT_AUTHENTICATE_ENDPOINT = ENV_CONFIG.get("CONTENT_AUTHENTICATE_ENDPOINT")
     CONTENT_RETRIEVAL_ENDPOINT = ENV_CONFIG.get("CONTENT_RETRIEVAL_ENDPOINT")
 
+    # speculative retrieval of the original query while rephrasing, results are reused when the rephrased query is
+    # at least REUSE_SIMILARITY similar to the original query, merged at MERGE_SIMILARITY & replaced below it
+    SPECULATIVE_RETRIEVAL_ENABLED = str(ENV_CONFIG.get("SPECULATIVE_RETRIEVAL_ENABLED", True)).lower() == "true"
+    SPECULATIVE_RETRIEVAL_REUSE_SIMILARITY = float(ENV_CONFIG.get("SPECULATIVE_RETRIEVAL_REUSE_SIMILARITY", 0.9))
+    SPECULATIVE_RETRIEVAL_MERGE_SIMILARITY = float(ENV_CONFIG.get("SPECULATIVE_RETRIEVAL_MERGE_SIMILARITY", 0.6))
+
+    # near-duplicate retrieved chunk elimination (MinHash over word shingles)
+    DEDUP_ENABLED = str(ENV_CONFIG.get("DEDUP_ENABLED", True)).lower() == "true"
+    DEDUP_SHINGLE_SIZE = int(ENV_CONFIG.get("DEDUP_SHINGLE_SIZE", 3))
+    DEDUP_NUM_PERMUTATIONS = int(ENV_CONFIG.get("DEDUP_NUM_PERMUTATIONS", 128))
+    DEDUP_JACCARD_THRESHOLD = float(ENV_CONFIG.get("DEDUP_JACCARD_THRESHOLD", 0.7))
+
+    # semantic answer cache, answers generated for rephrased queries (embedded with Constants.EMBEDDING_MODEL) are
+    # reused for queries at least SEMANTIC_CACHE_THRESHOLD (cosine) similar, entries expire after SEMANTIC_CACHE_TTL
+    # seconds or when the content corpus version changes (CONTENT_CORPUS_VERSION or the invalidate_answer_cache command)
+    SEMANTIC_CACHE_ENABLED = str(ENV_CONFIG.get("SEMANTIC_CACHE_ENABLED", True)).lower() == "true"
+    SEMANTIC_CACHE_THRESHOLD = float(ENV_CONFIG.get("SEMANTIC_CACHE_THRESHOLD", 0.95))
+    SEMANTIC_CACHE_MAXSIZE = int(ENV_CONFIG.get("SEMANTIC_CACHE_MAXSIZE", 5000))
+    SEMANTIC_CACHE_TTL = int(ENV_CONFIG.get("SEMANTIC_CACHE_TTL", 7 * 24 * 60 * 60))
+    SEMANTIC_CACHE_STAGE_TIMEOUT = float(ENV_CONFIG.get("SEMANTIC_CACHE_STAGE_TIMEOUT", 3))
+    CONTENT_CORPUS_VERSION = ENV_CONFIG.get("CONTENT_CORPUS_VERSION", "1")
+    CONTENT_CORPUS_VERSION_CHECK_INTERVAL = float(ENV_CONFIG.get("CONTENT_CORPUS_VERSION_CHECK_INTERVAL", 60))
+
+    # exact-match answer bank built from the answered messages (python manage.py rebuild_answer_bank), self-contained
+    # questions asked at least ANSWER_BANK_MIN_OCCURRENCES times (in the same language) are answered with their latest
+    # answer, entries older than ANSWER_BANK_MAX_AGE days are not used, workers reload the rebuilt bank file
+    # every ANSWER_BANK_RELOAD_INTERVAL seconds
+    ANSWER_BANK_ENABLED = str(ENV_CONFIG.get("ANSWER_BANK_ENABLED", True)).lower() == "true"
+    ANSWER_BANK_PATH = ENV_CONFIG.get(
+        "ANSWER_BANK_PATH", os.path.join(tempfile.gettempdir(), "agridoc_answer_bank.json")
+    )
+    ANSWER_BANK_MIN_OCCURRENCES = int(ENV_CONFIG.get("ANSWER_BANK_MIN_OCCURRENCES", 2))
+    ANSWER_BANK_MAX_AGE = int(ENV_CONFIG.get("ANSWER_BANK_MAX_AGE", 30))
+    ANSWER_BANK_RELOAD_INTERVAL = float(ENV_CONFIG.get("ANSWER_BANK_RELOAD_INTERVAL", 60))
+
+    # Pooled HTTP sessions (common.utils.send_request)
+    HTTP_POOL_CONNECTIONS = int(ENV_CONFIG.get("HTTP_POOL_CONNECTIONS", 10))
+    HTTP_POOL_MAXSIZE = int(ENV_CONFIG.get("HTTP_POOL_MAXSIZE", 20))
+    HTTP_POOL_BLOCK = str(ENV_CONFIG.get("HTTP_POOL_BLOCK", False)).lower() == "true"
+
     # Language
     LANGUAGE_BCP_CODE_NATIVE = ENV_CONFIG.get("LANGUAGE_BCP_CODE_NATIVE", "en-US")
     LANGUAGE_SHORT_CODE_NATIVE = os.environ.get("LANGUAGE_SHORT_CODE_NATIVE", "en")
 
     # Translation
     GOOGLE_APPLICATION_CREDENTIALS = ENV_CONFIG.get("GOOGLE_APPLICATION_CREDENTIALS")
+    GOOGLE_CLIENTS_WARM_UP = str(ENV_CONFIG.get("GOOGLE_CLIENTS_WARM_UP", True)).lower() == "true"
+    GOOGLE_CLIENTS_WARM_UP_TIMEOUT = float(ENV_CONFIG.get("GOOGLE_CLIENTS_WARM_UP_TIMEOUT", 10))
+    ENGLISH_FAST_PATH_ENABLED = str(ENV_CONFIG.get("ENGLISH_FAST_PATH_ENABLED", True)).lower() == "true"
+    ENGLISH_FAST_PATH_MIN_WORDS = int(ENV_CONFIG.get("ENGLISH_FAST_PATH_MIN_WORDS", 3))
+    ENGLISH_FAST_PATH_MIN_RATIO = float(ENV_CONFIG.get("ENGLISH_FAST_PATH_MIN_RATIO", 0.25))
+    TRANSLATION_BATCH_SIZE = int(ENV_CONFIG.get("TRANSLATION_BATCH_SIZE", 100))
+    TRANSLATION_CACHE_ENABLED = str(ENV_CONFIG.get("TRANSLATION_CACHE_ENABLED", True)).lower() == "true"
+    TRANSLATION_CACHE_MAXSIZE = int(ENV_CONFIG.get("TRANSLATION_CACHE_MAXSIZE", 20000))
+    TRANSLATION_CACHE_TTL = int(ENV_CONFIG.get("TRANSLATION_CACHE_TTL", 30 * 24 * 60 * 60))
+
+    # Text to speech audio cache (disk)
+    TTS_CACHE_ENABLED = str(ENV_CONFIG.get("TTS_CACHE_ENABLED", True)).lower() == "true"
+    TTS_CACHE_DIR = ENV_CONFIG.get("TTS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "agridoc_tts_cache"))
+    TTS_CACHE_MAX_BYTES = int(ENV_CONFIG.get("TTS_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+    # Shared cache (redis), the shared tier of the caches is disabled when not configured
+    REDIS_URL = ENV_CONFIG.get("REDIS_URL")
+    REDIS_SOCKET_TIMEOUT = float(ENV_CONFIG.get("REDIS_SOCKET_TIMEOUT", 0.5))
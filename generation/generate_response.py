@@ -1,6 +1,11 @@
 """
-This module1-file1.py file
+Answer generation from the reranked context chunks, as one completion or streamed token by token.
 """
+import datetime
+
+from django_core.config import Config
+from rag_service.openai_service import make_openai_request, make_openai_stream_request
+
 
 def m1f1_func1():
     """
@@ -20,4 +25,109 @@ def m1f1_func2(param1:int, param2:int):
     return param1+param2
 
 
+def build_generation_prompt(original_query, user_name, context_chunks, rephrased_query):
+    """
+    Build the answer generation prompt from the reranked context chunks and the rephrased query.
+    """
+    return Config.GENERATION_PROMPT.format(
+        context="\n\n".join(context_chunks or []),
+        question=rephrased_query,
+        original_query=original_query,
+        user_name=user_name,
+    )
+
+
+async def generate_query_response(original_query, user_name, context_chunks, rephrased_query, deadline=None):
+    """
+    Generate the answer for the query from the reranked context chunks, with the same prompt as the streamed answer.
+
+    Parameters
+    ----------
+    deadline: Deadline
+        deadline of the request, bounds the request & its retries (default: None)
+
+    Returns
+    -------
+    generated_response: dict
+        return a dictionary containing the generated response and the generation metrics
+    """
+    generation_start_time = datetime.datetime.now()
+    generation_prompt = build_generation_prompt(original_query, user_name, context_chunks, rephrased_query)
+    response, generation_exception, generation_retries = await make_openai_request(
+        generation_prompt, model=Config.GPT_4_TURBO_PREVIEW_LATEST, temperature=Config.TEMPERATURE, deadline=deadline
+    )
+    generation_end_time = datetime.datetime.now()
+
+    usage = response.usage if response else None
+    return {
+        "response": response.choices[0].message.content if response else None,
+        "generation_start_time": generation_start_time,
+        "generation_end_time": generation_end_time,
+        "completion_tokens": usage.completion_tokens if usage else 0,
+        "prompt_tokens": usage.prompt_tokens if usage else 0,
+        "total_tokens": usage.total_tokens if usage else 0,
+        "response_gen_exception": generation_exception,
+        "response_gen_retries": generation_retries,
+    }
+
+
+async def generate_query_response_stream(
+    original_query, user_name, context_chunks, rephrased_query, stream_handler, deadline=None, generated_tokens=None
+):
+    """
+    Generate the answer for the query like generate_query_response, streaming the generated tokens from openAI
+    to the stream_handler as they arrive.
+
+    Parameters
+    ----------
+    stream_handler: coroutine function
+        called as stream_handler("token", token) for every generated token
+
+    deadline: Deadline
+        deadline of the request, bounds opening the stream & its retries (default: None)
+
+    generated_tokens: list
+        collects the generated tokens, holds the partially streamed answer when the generation is cancelled
+        (default: None)
+
+    Returns
+    -------
+    generated_response: dict
+        return a dictionary containing the generated response and the generation metrics
+    """
+    generated_tokens = [] if generated_tokens is None else generated_tokens
+    generation_exception = ""
+    generation_retries = 0
+
+    generation_start_time = datetime.datetime.now()
+    generation_prompt = build_generation_prompt(original_query, user_name, context_chunks, rephrased_query)
+    stream, generation_exception, generation_retries = await make_openai_stream_request(
+        generation_prompt, model=Config.GPT_4_TURBO_PREVIEW_LATEST, temperature=Config.TEMPERATURE, deadline=deadline
+    )
+
+    if stream:
+        try:
+            async for chunk in stream:
+                token = chunk.choices[0].delta.content if chunk.choices else None
+                if token:
+                    generated_tokens.append(token)
+                    await stream_handler("token", token)
+        except Exception as error:
+            generation_exception += str(error) + "\n"
+        finally:
+            # frees the in-flight slot of the request even when the generation is cancelled mid-stream
+            await stream.aclose()
+
+    generation_end_time = datetime.datetime.now()
 
+    # token usage is not reported for streamed completions
+    return {
+        "response": "".join(generated_tokens) if generated_tokens else None,
+        "generation_start_time": generation_start_time,
+        "generation_end_time": generation_end_time,
+        "completion_tokens": 0,
+        "prompt_tokens": 0,
+        "total_tokens": 0,
+        "response_gen_exception": generation_exception,
+        "response_gen_retries": generation_retries,
+    }
@@ -1,25 +1,20 @@
 import asyncio, logging
 from google.cloud import speech_v1p1beta1 as speech
-from google.cloud import translate_v2 as translate
-from google.oauth2 import service_account
 
 from django_core.config import Config
+from language_service.clients import get_speech_client, get_translate_client
 
 logger = logging.getLogger(__name__)
 
-credentials = service_account.Credentials.from_service_account_file(Config.GOOGLE_APPLICATION_CREDENTIALS)
-
 
 async def transcribe_and_translate(
-    file_name, language_code, encoding_format=speech.RecognitionConfig.AudioEncoding.MP3, sample_rate_hertz=16000
+    audio_content, language_code, encoding_format=speech.RecognitionConfig.AudioEncoding.MP3, sample_rate_hertz=16000
 ):
-    speech_client = speech.SpeechClient(credentials=credentials)
-    translate_client = translate.Client(credentials=credentials)
+    speech_client = get_speech_client()
+    translate_client = get_translate_client()
 
-    audio = None
-    with open(file_name, "rb") as audio_data:
-        audio_content = audio_data.read()
-        audio = speech.RecognitionAudio(content=audio_content)
+    # audio_content is the in memory audio (bytes) of the voice query
+    audio = speech.RecognitionAudio(content=audio_content)
 
     config = speech.RecognitionConfig(
         encoding=encoding_format,
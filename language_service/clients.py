@@ -0,0 +1,109 @@
+import logging, os, threading
+import grpc
+from google.auth.transport.requests import AuthorizedSession, Request
+from google.cloud import speech_v1p1beta1 as speech
+from google.cloud import texttospeech
+from google.cloud import translate_v2 as translate
+from google.oauth2 import service_account
+from requests.adapters import HTTPAdapter
+
+from common.metrics import increment_counter
+from django_core.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Google Cloud clients created once per worker process, gRPC channels & HTTP sessions are not fork safe
+google_clients = {}
+google_clients_lock = threading.Lock()
+google_clients_pid = None
+google_credentials = None
+
+
+def get_google_credentials():
+    global google_credentials
+    if not google_credentials:
+        google_credentials = service_account.Credentials.from_service_account_file(
+            Config.GOOGLE_APPLICATION_CREDENTIALS
+        )
+    return google_credentials
+
+
+def create_translate_client():
+    # translate v2 is a REST client, give it a keep-alive session sized for concurrent translations
+    authorized_session = AuthorizedSession(get_google_credentials())
+    authorized_session.mount(
+        "https://", HTTPAdapter(pool_connections=Config.HTTP_POOL_CONNECTIONS, pool_maxsize=Config.HTTP_POOL_MAXSIZE)
+    )
+    return translate.Client(credentials=get_google_credentials(), _http=authorized_session)
+
+
+def create_speech_client():
+    return speech.SpeechClient(credentials=get_google_credentials())
+
+
+def create_text_to_speech_client():
+    return texttospeech.TextToSpeechClient(credentials=get_google_credentials())
+
+
+GOOGLE_CLIENT_FACTORIES = {
+    "translate": create_translate_client,
+    "speech": create_speech_client,
+    "text_to_speech": create_text_to_speech_client,
+}
+
+
+def reset_google_clients():
+    global google_clients_pid
+    google_clients.clear()
+    google_clients_pid = os.getpid()
+
+
+def get_google_client(client_name):
+    """
+    Return the process wide Google Cloud client, every client (and its gRPC channel / HTTP session)
+    is created once per worker process and shared by all requests & threads of that process.
+    """
+    with google_clients_lock:
+        if google_clients_pid != os.getpid():
+            reset_google_clients()
+
+        client = google_clients.get(client_name)
+        if not client:
+            client = GOOGLE_CLIENT_FACTORIES[client_name]()
+            google_clients[client_name] = client
+            increment_counter(f"google_{client_name}_clients_created")
+
+    return client
+
+
+def get_translate_client() -> translate.Client:
+    return get_google_client("translate")
+
+
+def get_speech_client() -> speech.SpeechClient:
+    return get_google_client("speech")
+
+
+def get_text_to_speech_client() -> texttospeech.TextToSpeechClient:
+    return get_google_client("text_to_speech")
+
+
+def warm_up_google_clients(timeout=Config.GOOGLE_CLIENTS_WARM_UP_TIMEOUT):
+    """
+    Create the clients, fetch the access token and connect the gRPC channels ahead of the first request.
+    Meant to be called once per worker process after it is forked.
+    """
+    try:
+        get_google_credentials().refresh(Request())
+        get_translate_client()
+        for client in (get_speech_client(), get_text_to_speech_client()):
+            grpc.channel_ready_future(client.transport.grpc_channel).result(timeout=timeout)
+
+        logger.info(f"Google Cloud clients warmed up for the process {os.getpid()}")
+
+    except Exception as error:
+        logger.error(error, exc_info=True)
+
+
+# drop the clients inherited from the parent process as soon as a (gunicorn / celery prefork) worker is forked
+os.register_at_fork(after_in_child=reset_google_clients)
@@ -1,47 +1,179 @@
-import asyncio
-from google.cloud import translate_v2 as translate
-from google.cloud import texttospeech
-from google.oauth2 import service_account
-
+import asyncio, re
+from common.cache import TwoTierCache, make_cache_key
 from common.constants import Constants
+from common.metrics import increment_counter
 from django_core.config import Config
+from language_service.clients import get_translate_client
 
-credentials = service_account.Credentials.from_service_account_file(Config.GOOGLE_APPLICATION_CREDENTIALS)
+SENTENCE_REGEX = re.compile(r"\s*\S.*?(?:[.!?\u0964]+(?=\s|$)|(?=\n)|$)\s*")
+LIST_MARKER_REGEX = re.compile(r"^\s*\d+[.)]\s*$")
+WORD_REGEX = re.compile(r"[a-z']+")
 
+# sentence level translations keyed by (normalized sentence, source language, target language)
+translation_cache = TwoTierCache(
+    "translation", maxsize=Config.TRANSLATION_CACHE_MAXSIZE, ttl=Config.TRANSLATION_CACHE_TTL
+)
+# detected language & english translation of whole input messages
+language_detection_cache = TwoTierCache(
+    "language_detection", maxsize=Config.TRANSLATION_CACHE_MAXSIZE, ttl=Config.TRANSLATION_CACHE_TTL
+)
 
-async def a_translate_to_english(text: str) -> str:
-    translate_client = translate.Client(credentials=credentials)
-    translation = await asyncio.to_thread(
-        translate_client.translate,
-        text,
-        target_language=Constants.LANGUAGE_SHORT_CODE_ENG,
-        format_="text",
+
+def translate_texts(texts: list, target_language: str, source_language: str = None) -> list:
+    """
+    Translate the list of texts with batched requests to Google Translate, the texts already
+    translated before are served from the translation cache. Returns the translations in order.
+    """
+    cache_keys = [make_cache_key(" ".join(text.split()), source_language or "auto", target_language) for text in texts]
+    translations = translation_cache.get_many(cache_keys) if Config.TRANSLATION_CACHE_ENABLED else {}
+
+    texts_to_translate = {}
+    for cache_key, text in zip(cache_keys, texts):
+        if cache_key not in translations:
+            texts_to_translate[cache_key] = text
+
+    if texts_to_translate:
+        translate_client = get_translate_client()
+        missing_keys = list(texts_to_translate.keys())
+        new_translations = {}
+        for index in range(0, len(missing_keys), Config.TRANSLATION_BATCH_SIZE):
+            batch_keys = missing_keys[index : index + Config.TRANSLATION_BATCH_SIZE]
+            batch_translations = translate_client.translate(
+                [texts_to_translate[cache_key] for cache_key in batch_keys],
+                target_language=target_language,
+                source_language=source_language,
+                format_="text",
+            )
+            for cache_key, translation in zip(batch_keys, batch_translations):
+                new_translations[cache_key] = translation["translatedText"]
+
+        increment_counter("translation_requests")
+        increment_counter("translation_characters", sum(len(text) for text in texts_to_translate.values()))
+        translations.update(new_translations)
+        if Config.TRANSLATION_CACHE_ENABLED:
+            translation_cache.set_many(new_translations)
+
+    return [translations[cache_key] for cache_key in cache_keys]
+
+
+def translate_text_list(texts: list, target_language: str, source_language: str = None) -> list:
+    """
+    Translate the texts sentence by sentence (all of them in one batched request) so that partially repeated
+    texts still hit the translation cache, keeping the whitespace & new lines around every sentence as it is.
+    """
+    target_language = target_language.split("-")[0] if "-" in target_language else target_language
+    if not Config.TRANSLATION_CACHE_ENABLED:
+        return translate_texts(list(texts), target_language, source_language)
+
+    sentences_per_text = [split_into_sentences(text) for text in texts]
+    translated_sentences = iter(
+        translate_texts(
+            [sentence.strip() for sentences in sentences_per_text for sentence in sentences if sentence.strip()],
+            target_language,
+            source_language,
+        )
     )
-    return translation["translatedText"]
+
+    translated_texts = []
+    for sentences in sentences_per_text:
+        translated_text = ""
+        for sentence in sentences:
+            stripped_sentence = sentence.strip()
+            if stripped_sentence:
+                leading_space = sentence[: len(sentence) - len(sentence.lstrip())]
+                trailing_space = sentence[len(sentence.rstrip()) :]
+                sentence = f"{leading_space}{next(translated_sentences)}{trailing_space}"
+            translated_text += sentence
+        translated_texts.append(translated_text)
+
+    return translated_texts
+
+
+def translate_text(text: str, target_language: str, source_language: str = None) -> str:
+    return translate_text_list([text], target_language, source_language)[0]
+
+
+async def a_translate_to_english(text: str) -> str:
+    return await asyncio.to_thread(translate_text, text, Constants.LANGUAGE_SHORT_CODE_ENG)
 
 
 async def a_translate_to(text: str, lang_code: str) -> str:
-    translate_client = translate.Client(credentials=credentials)
-    lang_code = lang_code.split("-")[0] if "-" in lang_code else lang_code
-    translation = await asyncio.to_thread(
-        translate_client.translate,
-        text,
-        target_language=lang_code,
-        format_="text",
-    )
-    return translation["translatedText"]
+    return await asyncio.to_thread(translate_text, text, lang_code)
+
+
+async def a_translate_batch(texts: list, lang_code: str) -> list:
+    """
+    Translate the list of texts to the language in a single round trip, returning the translations in order.
+    """
+    return await asyncio.to_thread(translate_text_list, texts, lang_code)
+
+
+def is_plain_english(text: str) -> bool:
+    """
+    Cheap local check for plain English input: ASCII only text in which enough of the words are common
+    English function words (latin script languages like Swahili are also ASCII, so ASCII alone is not enough).
+    """
+    if not text or not text.isascii():
+        return False
+
+    words = WORD_REGEX.findall(text.lower())
+    if len(words) < Config.ENGLISH_FAST_PATH_MIN_WORDS:
+        return False
+
+    english_words = sum(1 for word in words if word in Constants.ENGLISH_FUNCTION_WORDS)
+    return english_words / len(words) >= Config.ENGLISH_FAST_PATH_MIN_RATIO
+
+
+def detect_and_translate_to_english(text: str):
+    """
+    Detect the language of the text and translate it to english with a single Google Translate request,
+    the translate response already carries the detected source language.
+    """
+    cache_key = make_cache_key(" ".join(text.split()), "detect", Constants.LANGUAGE_SHORT_CODE_ENG)
+    detection = language_detection_cache.get(cache_key) if Config.TRANSLATION_CACHE_ENABLED else None
+
+    if not detection:
+        translate_client = get_translate_client()
+        translation = translate_client.translate(
+            text, target_language=Constants.LANGUAGE_SHORT_CODE_ENG, format_="text"
+        )
+        increment_counter("translation_requests")
+        increment_counter("translation_characters", len(text))
+        detection = {
+            "language": translation.get("detectedSourceLanguage") or Constants.LANGUAGE_SHORT_CODE_ENG,
+            "translation": translation["translatedText"],
+        }
+        if Config.TRANSLATION_CACHE_ENABLED:
+            language_detection_cache.set(cache_key, detection)
+
+    translated_text = detection["translation"] if detection["language"] != Constants.LANGUAGE_SHORT_CODE_ENG else text
+    return translated_text, detection["language"]
 
 
 async def detect_language_and_translate_to_english(input_msg):
-    translate_client = translate.Client(credentials=credentials)
-    language_detection = await asyncio.to_thread(translate_client.detect_language, input_msg)
-    input_language_detected = language_detection["language"]
+    if Config.ENGLISH_FAST_PATH_ENABLED and is_plain_english(input_msg):
+        increment_counter("language_detection_fast_path")
+        translated_input_message, input_language_detected = input_msg, Constants.LANGUAGE_SHORT_CODE_ENG
+    else:
+        translated_input_message, input_language_detected = await asyncio.to_thread(
+            detect_and_translate_to_english, input_msg
+        )
+
     print("Detected input language: ", input_language_detected)
+    return translated_input_message, input_language_detected
 
-    translated_input_message = (
-        await a_translate_to_english(input_msg)
-        if input_language_detected != Constants.LANGUAGE_SHORT_CODE_ENG
-        else input_msg
-    )
 
-    return translated_input_message, input_language_detected
+def split_into_sentences(text: str) -> list:
+    """
+    Split the text into sentences, keeping the surrounding whitespace & new lines with each sentence
+    so that joining the returned list gives back the original text.
+    Numbered list markers (ex: "1. ") are kept with the sentence that follows them.
+    """
+    sentences = []
+    for sentence in SENTENCE_REGEX.findall(text or ""):
+        if sentences and LIST_MARKER_REGEX.match(sentences[-1]):
+            sentences[-1] += sentence
+        else:
+            sentences.append(sentence)
+
+    return sentences
@@ -1,15 +1,16 @@
-import asyncio, aiohttp, logging, uuid
+import asyncio, aiohttp, logging
 from google.cloud import texttospeech
-from google.oauth2 import service_account
 
+from common.cache import DiskLRUCache, make_cache_key
 from common.constants import Constants
 from common.utils import clean_text, get_language_by_code
 from django_core.config import Config
+from language_service.clients import get_text_to_speech_client
 
 logger = logging.getLogger(__name__)
 
-
-credentials = service_account.Credentials.from_service_account_file(Config.GOOGLE_APPLICATION_CREDENTIALS)
+# synthesized audio bytes keyed by hash of (cleaned text, bcp code, voice, encoding, sample rate)
+tts_audio_cache = DiskLRUCache("tts_audio", Config.TTS_CACHE_DIR, Config.TTS_CACHE_MAX_BYTES)
 
 
 async def synthesize_speech_azure(text_to_synthesize, language_code, aiohttp_session):
@@ -50,31 +51,30 @@ async def synthesize_speech_azure(text_to_synthesize, language_code, aiohttp_ses
     return audio_content
 
 
-async def synthesize_speech(
+async def synthesize_speech_audio(
     input_text: str,
     input_language: str,
-    id_string: str = None,
-    aiohttp_session=None,
     audio_encoding_format=texttospeech.AudioEncoding.OGG_OPUS,
     sample_rate_hertz=48000,
-) -> str:
-    id_string = uuid.uuid4() if not id_string else id_string
-    file_name = f"response_{id_string}.{Constants.OGG}"
+) -> bytes:
+    """
+    Synthesize the text with Google TTS and return the audio bytes, audio synthesized before for the same
+    (cleaned text, bcp code, voice, encoding, sample rate) is served from the disk cache.
+    """
     input_text = clean_text(input_text)
-    synthesis_input = texttospeech.SynthesisInput(text=input_text)
     language_code = "en-IN"
     input_language = input_language.split("-")[0] if "-" in input_language else input_language
 
     if audio_encoding_format and str(audio_encoding_format).lower() == Constants.MP3:
         audio_encoding_format = texttospeech.AudioEncoding.MP3
-        file_name = f"response_{id_string}.{Constants.MP3}"
     else:
         audio_encoding_format = texttospeech.AudioEncoding.OGG_OPUS
 
     sample_rate_hertz = sample_rate_hertz if sample_rate_hertz else 48000
+    audio_content = None
 
     try:
-        language = get_language_by_code(input_language)
+        language = await asyncio.to_thread(get_language_by_code, input_language)
         if language:
             language_code = language.bcp_code
 
@@ -87,12 +87,25 @@ async def synthesize_speech(
         audio_config = texttospeech.AudioConfig(
             audio_encoding=audio_encoding_format, sample_rate_hertz=sample_rate_hertz
         )
-        text_to_speech_client = texttospeech.TextToSpeechClient(credentials=credentials)
+
+        cache_key = make_cache_key(
+            input_text,
+            language_code,
+            texttospeech.SsmlVoiceGender.FEMALE.name,
+            texttospeech.AudioEncoding(audio_encoding_format).name,
+            sample_rate_hertz,
+        )
+        if Config.TTS_CACHE_ENABLED:
+            audio_content = await asyncio.to_thread(tts_audio_cache.get, cache_key)
+            if audio_content:
+                return audio_content
+
+        text_to_speech_client = get_text_to_speech_client()
 
         try:
             response = await asyncio.to_thread(
                 text_to_speech_client.synthesize_speech,
-                input=synthesis_input,
+                input=texttospeech.SynthesisInput(text=input_text),
                 voice=voice,
                 audio_config=audio_config,
             )
@@ -102,12 +115,11 @@ async def synthesize_speech(
             logger.error("Error while synthesizing speech: %s", str(e))
             return None
 
-        with open(file_name, "wb") as out:
-            out.write(audio_content)
-            logger.info("Successfully wrote voice response to file")
+        if Config.TTS_CACHE_ENABLED and audio_content:
+            await asyncio.to_thread(tts_audio_cache.set, cache_key, audio_content)
 
     except Exception as e:
         logger.error(e, exc_info=True)
         return None
 
-    return file_name
+    return audio_content
@@ -0,0 +1,134 @@
+import asyncio, collections, os, threading, time, weakref
+
+from common.metrics import increment_counter, register_metrics_provider
+from django_core.config import Config
+
+CONCURRENCY_OUTCOME_SUCCESS = "success"
+CONCURRENCY_OUTCOME_OVERLOAD = "overload"
+
+
+class AIMDConcurrencyLimiter:
+    """
+    Adaptive limit of the in-flight openAI requests of a model within an event loop. The limit grows additively
+    (by increase / limit per request, about one request per round of requests) while requests succeed within the
+    healthy latency & is cut by the backoff factor on rate limited or timed out requests. Requests over the limit
+    wait in FIFO order.
+    """
+
+    def __init__(self, initial_limit, min_limit, max_limit, increase=1, backoff=0.5, healthy_latency=None):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.backoff = backoff
+        self.healthy_latency = healthy_latency
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.last_decrease_time = 0
+
+    def has_capacity(self) -> bool:
+        return self.in_flight < max(1, int(self.limit))
+
+    async def acquire(self, timeout=None) -> bool:
+        """
+        Wait for an in-flight slot, returns False when no slot is free within timeout seconds.
+        """
+        if not self.waiters and self.has_capacity():
+            self.in_flight += 1
+            return True
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        increment_counter("openai_concurrency_waits")
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over while giving up
+                self.release(None)
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            if isinstance(error, asyncio.CancelledError):
+                raise
+            increment_counter("openai_concurrency_wait_timeouts")
+            return False
+
+    def release(self, outcome, latency=None, start_time=None):
+        """
+        Free the slot of a request & adapt the limit to its outcome (success, overload or None for other errors).
+        """
+        self.in_flight -= 1
+        if outcome == CONCURRENCY_OUTCOME_SUCCESS:
+            if self.healthy_latency is None or latency is None or latency <= self.healthy_latency:
+                self.limit = min(self.max_limit, self.limit + self.increase / max(1, self.limit))
+        elif outcome == CONCURRENCY_OUTCOME_OVERLOAD:
+            # requests started before the last decrease were sent at the higher limit, decrease once per round
+            if start_time is None or start_time >= self.last_decrease_time:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_decrease_time = time.monotonic()
+                increment_counter("openai_concurrency_decreases")
+
+        while self.waiters and self.has_capacity():
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(True)
+
+    def stats(self) -> dict:
+        return {"limit": round(self.limit, 2), "in_flight": self.in_flight, "queue_depth": len(self.waiters)}
+
+
+# concurrency limiters of the models keyed by the event loop they are bound to
+concurrency_limiters = weakref.WeakKeyDictionary()
+concurrency_limiters_lock = threading.Lock()
+concurrency_limiters_pid = None
+
+
+def get_concurrency_limiter(model) -> AIMDConcurrencyLimiter:
+    """
+    Return the concurrency limiter of the model for the running event loop, None when the limiter is disabled.
+    """
+    global concurrency_limiters_pid
+    if not Config.OPENAI_CONCURRENCY_LIMIT_ENABLED:
+        return None
+    event_loop = asyncio.get_running_loop()
+
+    with concurrency_limiters_lock:
+        if concurrency_limiters_pid != os.getpid():
+            concurrency_limiters.clear()
+            concurrency_limiters_pid = os.getpid()
+
+        model_limiters = concurrency_limiters.setdefault(event_loop, {})
+        if model not in model_limiters:
+            model_limiters[model] = AIMDConcurrencyLimiter(
+                Config.OPENAI_CONCURRENCY_INITIAL_LIMIT,
+                Config.OPENAI_CONCURRENCY_MIN_LIMIT,
+                Config.OPENAI_CONCURRENCY_MAX_LIMIT,
+                backoff=Config.OPENAI_CONCURRENCY_BACKOFF,
+                healthy_latency=Config.OPENAI_CONCURRENCY_HEALTHY_LATENCY,
+            )
+        return model_limiters[model]
+
+
+def get_concurrency_limiter_stats() -> dict:
+    """
+    Current limit, in-flight requests & queue depth per model, summed over the event loops of the process.
+    """
+    with concurrency_limiters_lock:
+        limiters = [
+            (model, limiter)
+            for model_limiters in list(concurrency_limiters.values())
+            for model, limiter in model_limiters.items()
+        ]
+
+    stats = {}
+    for model, limiter in limiters:
+        model_stats = stats.setdefault(model, {"limit": 0, "in_flight": 0, "queue_depth": 0})
+        for name, value in limiter.stats().items():
+            model_stats[name] += value
+    return stats
+
+
+register_metrics_provider("openai_concurrency", get_concurrency_limiter_stats)
@@ -1,18 +1,198 @@
 import asyncio
 import datetime
+import difflib
 import logging
 
-from generation.generate_response import generate_query_response
+from common.constants import Constants
+from common.deadline import run_stage
+from common.metrics import increment_counter
+from common.tokens import trim_to_token_budget
+from common.utils import normalize_query
+from django_core.config import Config
+from generation.generate_response import generate_query_response, generate_query_response_stream
+from rag_service.semantic_cache import cache_semantic_answer, get_semantic_cached_answer
 from rag_service.utils import post_process_rag_pipeline
 from rephrasing.rephrase import rephrase_query
 from reranking.rerank import rerank_query
 from retrieval.content_retrieval import content_retrieval
+from retrieval.deduplication import deduplicate_chunks
 
 logger = logging.getLogger(__name__)
 
 
-def execute_rag_pipeline(
-    original_query, input_language_detected, email_id, user_name=None, message_id=None, chat_history=None
+def get_query_similarity(first_query, second_query) -> float:
+    """
+    Similarity (0 - 1) of two queries from the edit distance of their normalized text.
+    """
+    return difflib.SequenceMatcher(None, normalize_query(first_query), normalize_query(second_query)).ratio()
+
+
+def merge_retrieved_chunks(first_chunks, second_chunks):
+    """
+    Union of two retrieval results (by document text), most similar first & limited to the larger result size.
+    """
+    merged_chunks = {}
+    for chunk in (first_chunks or []) + (second_chunks or []):
+        document = chunk.get("document")
+        if document not in merged_chunks or (chunk.get("similarity") or 0) > (
+            merged_chunks[document].get("similarity") or 0
+        ):
+            merged_chunks[document] = chunk
+
+    max_chunks = max(len(first_chunks or []), len(second_chunks or []))
+    return sorted(merged_chunks.values(), key=lambda chunk: chunk.get("similarity") or 0, reverse=True)[:max_chunks]
+
+
+def discard_speculative_retrieval(speculative_retrieval_task):
+    """
+    Drop the speculative retrieval of the original query: cancel it while it runs, consume its exception once done.
+    """
+    if speculative_retrieval_task is None:
+        return
+    if not speculative_retrieval_task.done():
+        speculative_retrieval_task.cancel()
+    elif not speculative_retrieval_task.cancelled() and speculative_retrieval_task.exception():
+        logger.error(speculative_retrieval_task.exception())
+
+
+async def retrieve_content(original_query, rephrased_query, email_id, speculative_retrieval_task=None):
+    """
+    Retrieve the content chunks for the rephrased query. Speculative retrieval results (of the original query,
+    started while rephrasing) are reused when the rephrased query is close enough to the original query,
+    merged with a retrieval of the rephrased query when they are similar or replaced by it otherwise.
+    """
+    if speculative_retrieval_task is None:
+        return await asyncio.to_thread(content_retrieval, rephrased_query, email_id)
+
+    query_similarity = get_query_similarity(original_query, rephrased_query)
+    if query_similarity >= Config.SPECULATIVE_RETRIEVAL_REUSE_SIMILARITY:
+        speculative_results = await speculative_retrieval_task
+        if speculative_results.get("retrieved_chunks") is not None:
+            increment_counter("speculative_retrieval_reused")
+            return speculative_results
+
+    retrieval_results = await asyncio.to_thread(content_retrieval, rephrased_query, email_id)
+    if query_similarity >= Config.SPECULATIVE_RETRIEVAL_MERGE_SIMILARITY:
+        speculative_results = await speculative_retrieval_task
+        increment_counter("speculative_retrieval_merged")
+        retrieval_results["retrieved_chunks"] = merge_retrieved_chunks(
+            retrieval_results.get("retrieved_chunks"), speculative_results.get("retrieved_chunks")
+        )
+        return retrieval_results
+
+    increment_counter("speculative_retrieval_replaced")
+    discard_speculative_retrieval(speculative_retrieval_task)
+    return retrieval_results
+
+
+def get_retrieval_context_chunks(retrieved_chunks):
+    """
+    Context chunks by retrieval similarity (within the context token budget), used when the rerank stage times out.
+    """
+    context_chunks = []
+    context_tokens = 0
+    for chunk in sorted(retrieved_chunks or [], key=lambda chunk: chunk.get("similarity") or 0, reverse=True):
+        if len(context_chunks) >= Config.RERANK_CONTEXT_CHUNKS:
+            break
+        chunk_text, chunk_tokens = trim_to_token_budget(
+            chunk.get("document", ""), Config.CONTEXT_TOKEN_BUDGET - context_tokens
+        )
+        if not chunk_text:
+            continue
+        context_chunks.append(chunk_text)
+        context_tokens += chunk_tokens
+
+    return context_chunks
+
+
+async def retrieve_and_generate_answer(
+    original_query,
+    rephrased_query,
+    email_id,
+    user_name=None,
+    speculative_retrieval_task=None,
+    stream_handler=None,
+    deadline=None,
+):
+    """
+    Retrieve, deduplicate & rerank the content chunks of the rephrased query and generate the answer from them,
+    returns the (context chunks, rerank response, generation response) triple.
+    """
+    # content retrieval
+    try:
+        retrieval_results = await run_stage(
+            "retrieval",
+            retrieve_content(original_query, rephrased_query, email_id, speculative_retrieval_task),
+            deadline,
+            Config.RETRIEVAL_STAGE_TIMEOUT,
+        )
+    except asyncio.TimeoutError as error:
+        logger.error(error)
+        discard_speculative_retrieval(speculative_retrieval_task)
+        retrieval_results = {"retrieved_chunks": []}
+
+    # collapse near-duplicate chunks before reranking & generation
+    retrieved_chunks = await asyncio.to_thread(deduplicate_chunks, retrieval_results.get("retrieved_chunks"))
+
+    # execute reranking, the chunks are used by retrieval similarity when the stage times out
+    try:
+        reranked_query_response = await run_stage(
+            "rerank",
+            rerank_query(original_query, rephrased_query, email_id, retrieved_chunks, deadline=deadline),
+            deadline,
+            Config.RERANK_STAGE_TIMEOUT,
+        )
+    except asyncio.TimeoutError as error:
+        reranked_query_response = {
+            "original_query": original_query,
+            "context_chunks": get_retrieval_context_chunks(retrieved_chunks),
+            "rerank_exception": str(error),
+        }
+    context_chunks = reranked_query_response.get("context_chunks")
+
+    # generate final response / answer for the query, the tokens streamed before a stage timeout are kept
+    generated_tokens = []
+    try:
+        if stream_handler:
+            generated_response = await run_stage(
+                "generation",
+                generate_query_response_stream(
+                    original_query,
+                    user_name,
+                    context_chunks,
+                    rephrased_query,
+                    stream_handler,
+                    deadline=deadline,
+                    generated_tokens=generated_tokens,
+                ),
+                deadline,
+                Config.GENERATION_STAGE_TIMEOUT,
+            )
+        else:
+            generated_response = await run_stage(
+                "generation",
+                generate_query_response(original_query, user_name, context_chunks, rephrased_query, deadline=deadline),
+                deadline,
+                Config.GENERATION_STAGE_TIMEOUT,
+            )
+    except asyncio.TimeoutError as error:
+        generated_response = {
+            "response": "".join(generated_tokens) if generated_tokens else None,
+            "response_gen_exception": f"{error} (response truncated)" if generated_tokens else str(error),
+        }
+
+    return context_chunks, reranked_query_response, generated_response
+
+
+async def execute_rag_pipeline(
+    original_query,
+    input_language_detected,
+    email_id,
+    user_name=None,
+    message_id=None,
+    chat_history=None,
+    stream_handler=None,
+    deadline=None,
 ):
     generated_final_response = None
     response_map = {"message_id": message_id}
@@ -21,32 +201,78 @@ def execute_rag_pipeline(
     try:
         message_data_to_insert_or_update["main_bot_logic_start_time"] = datetime.datetime.now()
 
-        # execute rephrasing
-        rephrased_query_response = asyncio.run(rephrase_query(original_query, chat_history))
+        # speculative content retrieval of the original query while the query is rephrased with the chat history
+        speculative_retrieval_task = None
+        if Config.SPECULATIVE_RETRIEVAL_ENABLED and chat_history:
+            speculative_retrieval_task = asyncio.create_task(
+                asyncio.to_thread(content_retrieval, original_query, email_id)
+            )
+
+        # execute rephrasing, the original query is used when the stage times out
+        try:
+            rephrased_query_response = await run_stage(
+                "rephrase",
+                rephrase_query(original_query, chat_history, deadline=deadline),
+                deadline,
+                Config.REPHRASE_STAGE_TIMEOUT,
+            )
+        except asyncio.TimeoutError as error:
+            rephrased_query_response = {
+                "original_query": original_query,
+                "rephrased_query": original_query,
+                "rephrase_exception": str(error),
+            }
         rephrased_query = rephrased_query_response.get("rephrased_query")
+        if stream_handler:
+            await stream_handler("rephrased_query", rephrased_query)
 
-        # content retrieval
-        retrieval_results = content_retrieval(rephrased_query, email_id)
+        # semantic answer cache, the answer cached for a similar query skips retrieval, reranking & generation
+        try:
+            cached_answer, query_embedding = await run_stage(
+                "semantic_cache",
+                get_semantic_cached_answer(rephrased_query, user_name, deadline),
+                deadline,
+                Config.SEMANTIC_CACHE_STAGE_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            cached_answer, query_embedding = None, None
 
-        # execute reranking
-        reranked_query_response = asyncio.run(
-            rerank_query(original_query, rephrased_query, email_id, retrieval_results.get("retrieved_chunks"))
-        )
-        context_chunks = reranked_query_response.get("context_chunks")
-
-        # generate final response / answer for the query
-        generated_response = asyncio.run(
-            generate_query_response(original_query, user_name, context_chunks, rephrased_query)
-        )
-        generated_final_response = generated_response.get("response")
+        if cached_answer:
+            discard_speculative_retrieval(speculative_retrieval_task)
+            if stream_handler:
+                await stream_handler("token", cached_answer)
+            context_chunks, reranked_query_response, generated_response = None, None, None
+            generated_final_response = cached_answer
+            response_source = Constants.RESPONSE_SOURCE_SEMANTIC_CACHE
+        else:
+            context_chunks, reranked_query_response, generated_response = await retrieve_and_generate_answer(
+                original_query,
+                rephrased_query,
+                email_id,
+                user_name=user_name,
+                speculative_retrieval_task=speculative_retrieval_task,
+                stream_handler=stream_handler,
+                deadline=deadline,
+            )
+            generated_final_response = generated_response.get("response")
+            response_source = Constants.RESPONSE_SOURCE_RAG_PIPELINE
+            if context_chunks:
+                await asyncio.to_thread(
+                    cache_semantic_answer, rephrased_query, query_embedding, generated_final_response, user_name
+                )
 
         message_data_to_insert_or_update["main_bot_logic_end_time"] = datetime.datetime.now()
         message_data_to_insert_or_update["message_response_time"] = datetime.datetime.now()
-        message_data_to_insert_or_update["retrieved_chunks"] = str(context_chunks)
+        message_data_to_insert_or_update["retrieved_chunks"] = (
+            str(context_chunks) if context_chunks is not None else None
+        )
         message_data_to_insert_or_update["condensed_question"] = rephrased_query
+        message_data_to_insert_or_update["response_source"] = response_source
 
         # post process RAG pipeline (insert data into db for RAG pipeline data logging)
-        post_process_rag_pipeline(message_id, rephrased_query_response, reranked_query_response, generated_response)
+        await asyncio.to_thread(
+            post_process_rag_pipeline, message_id, rephrased_query_response, reranked_query_response, generated_response
+        )
 
         response_map.update(
             {
@@ -2,10 +2,14 @@ import os, re
 import asyncio
 import datetime
 import random
+import threading
+import weakref
+import httpx
 import openai
 import time
 from openai import (
     RateLimitError,
+    APIConnectionError,
     APITimeoutError,
     InternalServerError,
 )
@@ -15,6 +19,162 @@ from openai import OpenAI, AsyncOpenAI
 from qdrant_client import QdrantClient
 from qdrant_client.http.models import Filter, FieldCondition, MatchValue
 from common.constants import Constants
+from common.deadline import Deadline
+from common.metrics import increment_counter
+from common.tokens import count_tokens
+from rag_service.concurrency_limiter import (
+    CONCURRENCY_OUTCOME_OVERLOAD,
+    CONCURRENCY_OUTCOME_SUCCESS,
+    get_concurrency_limiter,
+)
+from rag_service.rate_limiter import (
+    acquire_openai_capacity,
+    block_openai_requests,
+    estimate_request_tokens,
+    get_retry_after,
+    settle_openai_usage,
+)
+
+# AsyncOpenAI clients (& their httpx connection pools) keyed by the event loop they are bound to
+async_clients = weakref.WeakKeyDictionary()
+async_clients_lock = threading.Lock()
+async_clients_pid = None
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """
+    Return the AsyncOpenAI client of the running event loop, created lazily once per process & event loop
+    so that concurrent requests (ex: the rerank fan-out) reuse the warm connections of a single pool.
+    """
+    global async_clients_pid
+    event_loop = asyncio.get_running_loop()
+
+    with async_clients_lock:
+        if async_clients_pid != os.getpid():
+            # connections can not be shared with the parent of a forked worker process
+            async_clients.clear()
+            async_clients_pid = os.getpid()
+
+        async_client = async_clients.get(event_loop)
+        if not async_client:
+            async_client = AsyncOpenAI(
+                api_key=Config.OPEN_AI_KEY,
+                timeout=Config.OPENAI_REQUEST_TIMEOUT,
+                # retries are made by make_openai_request, within the deadline of the request
+                max_retries=0,
+                http_client=httpx.AsyncClient(
+                    http2=Config.OPENAI_HTTP2,
+                    limits=httpx.Limits(
+                        max_connections=Config.OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=Config.OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=Config.OPENAI_KEEPALIVE_EXPIRY,
+                    ),
+                ),
+            )
+            async_clients[event_loop] = async_client
+            increment_counter("openai_clients_created")
+
+    return async_client
+
+
+def get_attempt_timeout(deadline: Deadline = None) -> float:
+    """
+    Timeout of an openAI request attempt, bounded by the remaining time of the request deadline.
+    """
+    if deadline is None:
+        return Config.OPENAI_REQUEST_TIMEOUT
+    return min(Config.OPENAI_REQUEST_TIMEOUT, deadline.remaining())
+
+
+def get_attempt_max_wait(deadline: Deadline = None):
+    """
+    Longest rate limiter wait that still leaves time for the request attempt, None without a deadline.
+    """
+    if deadline is None:
+        return None
+    return max(0, deadline.remaining() - Config.OPENAI_MIN_ATTEMPT_TIME)
+
+
+def can_fit_attempt(deadline: Deadline = None, retry_delay: float = 0) -> bool:
+    """
+    Whether another request attempt (after the retry delay) fits in the remaining time of the request deadline.
+    """
+    return deadline is None or deadline.can_fit(retry_delay + Config.OPENAI_MIN_ATTEMPT_TIME)
+
+
+def get_deadline_exceeded_message(deadline: Deadline, retries) -> str:
+    increment_counter("openai_deadline_exceeded")
+    return (
+        f"\nRequest deadline exceeded ({deadline.remaining():.1f} of {deadline.timeout} seconds left after "
+        f"{retries} retries). Request failed."
+    )
+
+
+class ConcurrencySlotStream:
+    """
+    Stream of chunks of a streamed openAI request, holding the in-flight slot of the request (if any) until the stream
+    is consumed, fails or is closed. Close it (aclose) once done with it, even when it was not iterated.
+    """
+
+    def __init__(self, stream, limiter=None, latency=None, start_time=None):
+        self.stream = stream
+        self.limiter = limiter
+        self.latency = latency
+        self.start_time = start_time
+
+    def release(self, outcome):
+        if self.limiter is not None:
+            limiter, self.limiter = self.limiter, None
+            limiter.release(outcome, self.latency, self.start_time)
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.stream:
+                yield chunk
+            self.release(CONCURRENCY_OUTCOME_SUCCESS)
+        finally:
+            self.release(None)
+
+    async def aclose(self):
+        self.release(None)
+        await self.stream.response.aclose()
+
+
+async def run_in_concurrency_slot(limiter, create_request, **kwargs):
+    """
+    Make the openAI request in the in-flight slot acquired from the concurrency limiter (if any), the slot is
+    released with the outcome of the request. A streamed request (stream=True) returns a ConcurrencySlotStream
+    holding the slot until the stream is consumed or closed.
+    """
+    if limiter is None:
+        response = await create_request(**kwargs)
+        return ConcurrencySlotStream(response) if kwargs.get("stream") else response
+
+    start_time = time.monotonic()
+    outcome = None
+    slot_held_by_stream = False
+    try:
+        response = await create_request(**kwargs)
+        if kwargs.get("stream"):
+            response = ConcurrencySlotStream(response, limiter, time.monotonic() - start_time, start_time)
+            slot_held_by_stream = True
+        outcome = CONCURRENCY_OUTCOME_SUCCESS
+        return response
+    except RateLimitError:
+        outcome = CONCURRENCY_OUTCOME_OVERLOAD
+        raise
+    except APITimeoutError:
+        # attempts shortened by the request deadline time out without openAI being overloaded
+        if kwargs.get("timeout", Config.OPENAI_REQUEST_TIMEOUT) >= Config.OPENAI_REQUEST_TIMEOUT:
+            outcome = CONCURRENCY_OUTCOME_OVERLOAD
+        raise
+    finally:
+        if not slot_held_by_stream:
+            limiter.release(outcome, time.monotonic() - start_time, start_time)
+
+
+async def create_chat_completion(async_client, limiter, **kwargs):
+    return await run_in_concurrency_slot(limiter, async_client.chat.completions.create, **kwargs)
 
 
 async def make_openai_request(
@@ -25,41 +185,78 @@ async def make_openai_request(
     exponential_base: float = 2,
     jitter: bool = True,
     max_retries: int = 10,
+    deadline: Deadline = None,
 ):
-    async_client = AsyncOpenAI(api_key=Config.OPEN_AI_KEY)
-    openai.api_key = Config.OPEN_AI_KEY
+    """
+    Make a chat completion request for the prompt, retrying rate limited, timed out & failed requests with an
+    exponential backoff. With a deadline every attempt is bounded by the remaining time of the request, retries
+    stop when another attempt (after its backoff delay) can not fit in it.
+    """
+    async_client = get_async_openai_client()
 
     exception_string = ""
     retries = 0
     # base_delay = 5
     # max_retries = 5
     delay = initial_delay
+    estimated_tokens = estimate_request_tokens(prompt_message, model)
     while retries < max_retries:
+        if not can_fit_attempt(deadline):
+            return None, exception_string + get_deadline_exceeded_message(deadline, retries), retries
+        capacity_reserved = False
         try:
+            # wait for the capacity of the model in the shared rate limiter
+            if not await acquire_openai_capacity(model, estimated_tokens, get_attempt_max_wait(deadline)):
+                return None, exception_string + get_deadline_exceeded_message(deadline, retries), retries
+            capacity_reserved = True
+            # wait for an in-flight slot of the model in the adaptive concurrency limiter
+            limiter = get_concurrency_limiter(model)
+            if limiter and not await limiter.acquire(get_attempt_max_wait(deadline)):
+                # give back the request & tokens reserved in the rate limiter, the request is not made
+                await settle_openai_usage(model, estimated_tokens, 0, unused_requests=1)
+                return None, exception_string + get_deadline_exceeded_message(deadline, retries), retries
             # response = await openai.ChatCompletion.acreate(
             attempt_time = datetime.datetime.now()
-            response = await async_client.chat.completions.create(
+            response = await create_chat_completion(
+                async_client,
+                limiter,
                 model=model,
                 messages=[{"role": "user", "content": prompt_message}],
                 temperature=temperature,
+                timeout=get_attempt_timeout(deadline),
             )
+            await settle_openai_usage(model, estimated_tokens, response.usage.total_tokens if response.usage else None)
             return response, exception_string, retries
-        except (RateLimitError, APITimeoutError, InternalServerError) as e:
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
             e_time = datetime.datetime.now()
             exception_string += str(e) + f"\t{str((e_time-attempt_time).total_seconds())} seconds\n"
+            if capacity_reserved:
+                # the failed attempt used no tokens
+                await settle_openai_usage(model, estimated_tokens, 0)
 
             print(f"Request failed (Retry {retries + 1}/{max_retries}): {e}")
 
             # delay = base_delay * (2**retries)
             delay *= exponential_base * (1 + jitter * random.random())
+            retry_delay = delay
+            if isinstance(e, RateLimitError):
+                # wait as long as openAI asks for (all the workers are held back by the rate limiter)
+                retry_after = get_retry_after(e)
+                await block_openai_requests(model, retry_after)
+                retry_delay = retry_after if retry_after is not None else delay
+
+            if not can_fit_attempt(deadline, retry_delay):
+                return None, exception_string + get_deadline_exceeded_message(deadline, retries + 1), retries + 1
 
-            print(f"Retrying in {delay} seconds...")
-            await asyncio.sleep(delay)
+            print(f"Retrying in {retry_delay} seconds...")
+            await asyncio.sleep(retry_delay)
             # time.sleep(delay)
             retries += 1
         except Exception as e:
             e_time = datetime.datetime.now()
             exception_string += str(e) + f" \t{str((e_time-attempt_time).total_seconds())} seconds\n"
+            if capacity_reserved:
+                await settle_openai_usage(model, estimated_tokens, 0)
             return None, exception_string, retries
 
     print(f"Max retries reached ({max_retries}). Request failed.")
@@ -70,6 +267,115 @@ async def make_openai_request(
     )
 
 
+async def make_openai_stream_request(
+    prompt_message,
+    model=Config.GPT_3_5_TURBO,
+    temperature=0,
+    initial_delay: float = 1,
+    exponential_base: float = 2,
+    jitter: bool = True,
+    max_retries: int = 3,
+    deadline: Deadline = None,
+):
+    """
+    Open a streamed chat completion for the prompt and return the stream of chunks as it arrives.
+    Retries are only made while opening the stream, a partially streamed answer can not be replayed to the client.
+    The stream (ConcurrencySlotStream) holds an in-flight slot of the model until it is consumed, close it once done.
+    """
+    async_client = get_async_openai_client()
+
+    exception_string = ""
+    retries = 0
+    delay = initial_delay
+    estimated_tokens = estimate_request_tokens(prompt_message, model)
+    while retries < max_retries:
+        if not can_fit_attempt(deadline):
+            return None, exception_string + get_deadline_exceeded_message(deadline, retries), retries
+        capacity_reserved = False
+        try:
+            if not await acquire_openai_capacity(model, estimated_tokens, get_attempt_max_wait(deadline)):
+                return None, exception_string + get_deadline_exceeded_message(deadline, retries), retries
+            capacity_reserved = True
+            limiter = get_concurrency_limiter(model)
+            if limiter and not await limiter.acquire(get_attempt_max_wait(deadline)):
+                # give back the request & tokens reserved in the rate limiter, the request is not made
+                await settle_openai_usage(model, estimated_tokens, 0, unused_requests=1)
+                return None, exception_string + get_deadline_exceeded_message(deadline, retries), retries
+            attempt_time = datetime.datetime.now()
+            stream = await create_chat_completion(
+                async_client,
+                limiter,
+                model=model,
+                messages=[{"role": "user", "content": prompt_message}],
+                temperature=temperature,
+                stream=True,
+                timeout=get_attempt_timeout(deadline),
+            )
+            return stream, exception_string, retries
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            e_time = datetime.datetime.now()
+            exception_string += str(e) + f"\t{str((e_time-attempt_time).total_seconds())} seconds\n"
+            if capacity_reserved:
+                # the failed attempt used no tokens
+                await settle_openai_usage(model, estimated_tokens, 0)
+
+            print(f"Stream request failed (Retry {retries + 1}/{max_retries}): {e}")
+            delay *= exponential_base * (1 + jitter * random.random())
+            retry_delay = delay
+            if isinstance(e, RateLimitError):
+                retry_after = get_retry_after(e)
+                await block_openai_requests(model, retry_after)
+                retry_delay = retry_after if retry_after is not None else delay
+            if not can_fit_attempt(deadline, retry_delay):
+                return None, exception_string + get_deadline_exceeded_message(deadline, retries + 1), retries + 1
+            await asyncio.sleep(retry_delay)
+            retries += 1
+        except Exception as e:
+            e_time = datetime.datetime.now()
+            exception_string += str(e) + f" \t{str((e_time-attempt_time).total_seconds())} seconds\n"
+            if capacity_reserved:
+                await settle_openai_usage(model, estimated_tokens, 0)
+            return None, exception_string, retries
+
+    print(f"Max retries reached ({max_retries}). Stream request failed.")
+    return (
+        None,
+        exception_string + f"\nMax retries reached ({max_retries}). Stream request failed.",
+        retries,
+    )
+
+
+async def make_openai_embedding_request(text, model=Constants.EMBEDDING_MODEL, deadline: Deadline = None):
+    """
+    Embed the text with the shared openAI client (no retries) within the rate & concurrency limits of the model,
+    returns the (embedding, exception string) pair.
+    """
+    async_client = get_async_openai_client()
+    if not can_fit_attempt(deadline):
+        return None, get_deadline_exceeded_message(deadline, 0)
+
+    estimated_tokens = count_tokens(text, model)
+    if not await acquire_openai_capacity(model, estimated_tokens, get_attempt_max_wait(deadline)):
+        return None, get_deadline_exceeded_message(deadline, 0)
+    limiter = get_concurrency_limiter(model)
+    if limiter and not await limiter.acquire(get_attempt_max_wait(deadline)):
+        await settle_openai_usage(model, estimated_tokens, 0, unused_requests=1)
+        return None, get_deadline_exceeded_message(deadline, 0)
+
+    try:
+        response = await run_in_concurrency_slot(
+            limiter, async_client.embeddings.create, input=[text], model=model, timeout=get_attempt_timeout(deadline)
+        )
+    except Exception as e:
+        await settle_openai_usage(model, estimated_tokens, 0)
+        if isinstance(e, RateLimitError):
+            await block_openai_requests(model, get_retry_after(e))
+        return None, str(e)
+
+    await settle_openai_usage(model, estimated_tokens, response.usage.total_tokens if response.usage else None)
+    return response.data[0].embedding, ""
+
+
 ####### TEMP FUNC ###############
 def query_qdrant_collection(query, crop, k, search_type):
     client = QdrantClient(
@@ -0,0 +1,248 @@
+import asyncio, logging, re, threading, time
+
+from common.cache import get_shared_cache_client
+from common.metrics import increment_counter
+from common.tokens import count_tokens
+from django_core.config import Config
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_DURATION_REGEX = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+RATE_LIMIT_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+# Reserve one request & the estimated tokens from the requests-per-minute & tokens-per-minute buckets of a model.
+# Buckets may go negative, the caller waits for the returned time (ms) until its reservation is refilled, so requests
+# are served in arrival order across all the worker processes sharing the redis store.
+RESERVE_SCRIPT = """
+local now_time = redis.call('TIME')
+local now = tonumber(now_time[1]) * 1000 + tonumber(now_time[2]) / 1000
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'updated', 'blocked_until')
+local requests = tonumber(state[1]) or rpm
+local tokens = tonumber(state[2]) or tpm
+local updated = tonumber(state[3]) or now
+local blocked_until = tonumber(state[4]) or 0
+local elapsed = math.max(0, now - updated)
+requests = math.min(rpm, requests + elapsed * rpm / 60000) - 1
+tokens = math.min(tpm, tokens + elapsed * tpm / 60000) - cost
+local wait = math.max(0, blocked_until - now)
+if requests < 0 then wait = math.max(wait, -requests * 60000 / rpm) end
+if tokens < 0 then wait = math.max(wait, -tokens * 60000 / tpm) end
+redis.call('HSET', KEYS[1], 'requests', requests, 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.max(120000, math.ceil(blocked_until - now)))
+return tostring(wait)
+"""
+
+# Give back the difference between the estimated & the used tokens of a request (& the request when it was not made)
+SETTLE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBYFLOAT', KEYS[1], 'tokens', ARGV[1])
+    redis.call('HINCRBYFLOAT', KEYS[1], 'requests', ARGV[2])
+end
+return 1
+"""
+
+# Hold back all the requests of a model (after a 429 response) for the given time (ms)
+BLOCK_SCRIPT = """
+local now_time = redis.call('TIME')
+local now = tonumber(now_time[1]) * 1000 + tonumber(now_time[2]) / 1000
+local blocked_until = now + tonumber(ARGV[1])
+local current = tonumber(redis.call('HGET', KEYS[1], 'blocked_until')) or 0
+if blocked_until > current then
+    redis.call('HSET', KEYS[1], 'blocked_until', blocked_until)
+    redis.call('PEXPIRE', KEYS[1], math.max(120000, tonumber(ARGV[1])))
+end
+return 1
+"""
+
+
+class LocalRateLimitBucket:
+    """
+    In-process requests & tokens per minute bucket, used when the shared redis store is not available.
+    """
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm
+        self.tokens = tpm
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, cost: float) -> float:
+        with self.lock:
+            now = time.monotonic()
+            elapsed = max(0, now - self.updated)
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60) - 1
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60) - cost
+            self.updated = now
+
+            wait = max(0, self.blocked_until - now)
+            if self.requests < 0:
+                wait = max(wait, -self.requests * 60 / self.rpm)
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens * 60 / self.tpm)
+            return wait
+
+    def settle(self, unused_tokens: float, unused_requests: float = 0):
+        with self.lock:
+            self.tokens += unused_tokens
+            self.requests += unused_requests
+
+    def block(self, seconds: float):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+local_buckets = {}
+local_buckets_lock = threading.Lock()
+redis_scripts = {}
+
+
+def get_rate_limits(model) -> dict:
+    """
+    Requests & tokens per minute limits of the model ({"rpm", "tpm"}), None when the model is not limited.
+    """
+    return Config.OPENAI_RATE_LIMITS.get(model) or Config.OPENAI_RATE_LIMITS.get("default")
+
+
+def get_local_bucket(model, rate_limits) -> LocalRateLimitBucket:
+    with local_buckets_lock:
+        if model not in local_buckets:
+            # the quota is shared with the other worker processes
+            processes = max(1, Config.OPENAI_RATE_LIMIT_FALLBACK_PROCESSES)
+            local_buckets[model] = LocalRateLimitBucket(rate_limits["rpm"] / processes, rate_limits["tpm"] / processes)
+        return local_buckets[model]
+
+
+def run_redis_script(name, script, model, *args):
+    """
+    Run the rate limit script on the shared redis store, returns None when the store is not available.
+    """
+    shared_cache = get_shared_cache_client()
+    if not shared_cache:
+        return None
+    try:
+        if name not in redis_scripts:
+            redis_scripts[name] = shared_cache.register_script(script)
+        return redis_scripts[name](keys=[f"agridoc:openai_rate_limit:{model}"], args=list(args))
+    except Exception as error:
+        logger.error(error, exc_info=True)
+        return None
+
+
+def estimate_request_tokens(prompt_message, model) -> int:
+    """
+    Estimated tokens a request counts against the tokens per minute limit (prompt + expected completion tokens).
+    """
+    return count_tokens(prompt_message, model) + Config.OPENAI_RATE_LIMIT_COMPLETION_TOKENS
+
+
+def reserve_capacity(model, estimated_tokens) -> float:
+    rate_limits = get_rate_limits(model)
+    if not rate_limits:
+        return 0
+    cost = min(estimated_tokens, rate_limits["tpm"])
+    wait = run_redis_script("reserve", RESERVE_SCRIPT, model, rate_limits["rpm"], rate_limits["tpm"], cost)
+    if wait is not None:
+        return float(wait) / 1000
+    return get_local_bucket(model, rate_limits).reserve(cost)
+
+
+async def acquire_openai_capacity(model, estimated_tokens, max_wait=None) -> bool:
+    """
+    Wait until the model has capacity for the request (one request & the estimated tokens). Returns False without
+    waiting when the capacity is not available within max_wait seconds (ex: the remaining time of the request).
+    """
+    if not Config.OPENAI_RATE_LIMIT_ENABLED:
+        return True
+    wait = await asyncio.to_thread(reserve_capacity, model, estimated_tokens)
+    if max_wait is not None and wait > max_wait:
+        increment_counter("openai_rate_limit_wait_exceeded")
+        # give back the reserved request & tokens, the request is not made
+        await asyncio.to_thread(settle_capacity, model, estimated_tokens, 0, 1)
+        return False
+    if wait > 0:
+        increment_counter("openai_rate_limit_waits")
+        increment_counter("openai_rate_limit_wait_ms", int(wait * 1000))
+        try:
+            await asyncio.sleep(min(wait, Config.OPENAI_RATE_LIMIT_MAX_WAIT))
+        except asyncio.CancelledError:
+            # give back the reserved request & tokens, the request is not made (ex: a cancelled rerank or stage timeout)
+            await asyncio.shield(asyncio.to_thread(settle_capacity, model, estimated_tokens, 0, 1))
+            raise
+    return True
+
+
+def settle_capacity(model, estimated_tokens, used_tokens, unused_requests=0):
+    rate_limits = get_rate_limits(model)
+    if not rate_limits:
+        return
+    unused_tokens = estimated_tokens - used_tokens
+    if run_redis_script("settle", SETTLE_SCRIPT, model, unused_tokens, unused_requests) is None:
+        get_local_bucket(model, rate_limits).settle(unused_tokens, unused_requests)
+
+
+async def settle_openai_usage(model, estimated_tokens, used_tokens, unused_requests=0):
+    """
+    Correct the tokens reserved for a request with the tokens it used (0 for failed requests), the reserved request
+    is given back with unused_requests=1 when the request was not made.
+    """
+    if Config.OPENAI_RATE_LIMIT_ENABLED and used_tokens is not None:
+        await asyncio.to_thread(settle_capacity, model, estimated_tokens, used_tokens, unused_requests)
+
+
+def block_capacity(model, seconds):
+    rate_limits = get_rate_limits(model)
+    if run_redis_script("block", BLOCK_SCRIPT, model, int(seconds * 1000)) is None and rate_limits:
+        get_local_bucket(model, rate_limits).block(seconds)
+
+
+async def block_openai_requests(model, seconds):
+    """
+    Hold back the requests of the model in all the workers (after a rate limited response).
+    """
+    increment_counter("openai_rate_limited_responses")
+    if Config.OPENAI_RATE_LIMIT_ENABLED and seconds:
+        await asyncio.to_thread(block_capacity, model, seconds)
+
+
+def parse_rate_limit_duration(value):
+    """
+    Seconds of a rate limit header value, ex: "20", "1.5", "6m0s", "120ms".
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    durations = RATE_LIMIT_DURATION_REGEX.findall(value or "")
+    if not durations:
+        return None
+    return sum(float(amount) * RATE_LIMIT_DURATION_UNITS[unit] for amount, unit in durations)
+
+
+def get_retry_after(error):
+    """
+    Seconds to wait before retrying a rate limited request, from the retry-after & rate limit reset headers.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    retry_after_ms = parse_rate_limit_duration(headers.get("retry-after-ms"))
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    retry_after = parse_rate_limit_duration(headers.get("retry-after"))
+    if retry_after is not None:
+        return retry_after
+
+    resets = []
+    if headers.get("x-ratelimit-remaining-requests") == "0":
+        resets.append(parse_rate_limit_duration(headers.get("x-ratelimit-reset-requests")))
+    if headers.get("x-ratelimit-remaining-tokens") == "0" or not resets:
+        resets.append(parse_rate_limit_duration(headers.get("x-ratelimit-reset-tokens")))
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
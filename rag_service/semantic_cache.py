@@ -0,0 +1,189 @@
+import asyncio, logging, threading, time
+import numpy as np
+
+from common.cache import get_shared_cache_client
+from common.constants import Constants
+from common.metrics import increment_counter, register_metrics_provider
+from common.utils import replace_user_name
+from django_core.config import Config
+from rag_service.openai_service import make_openai_embedding_request
+
+logger = logging.getLogger(__name__)
+
+CONTENT_CORPUS_VERSION_KEY = "agridoc:content_corpus_version"
+
+
+class SemanticAnswerIndex:
+    """
+    In-process vector index of the answers generated for the (rephrased) queries, searched by cosine similarity.
+    Entries expire after ttl seconds, the oldest entries are evicted past maxsize & the whole index is cleared
+    when the version of the content corpus changes.
+
+    The embeddings are rows [start, end) of a preallocated buffer, new rows are written after end & expired rows
+    are dropped by moving start. When the buffer is full the live rows are copied to a new buffer (twice as large
+    when more than half of the rows are live), the rows of a buffer are never overwritten so that searches read
+    them outside of the lock.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, initial_capacity: int = 64):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.initial_capacity = initial_capacity
+        self.embeddings = None
+        self.entries = []
+        self.start = 0
+        self.end = 0
+        self.corpus_version = None
+        self.lock = threading.Lock()
+        register_metrics_provider("semantic_answer_cache", self.stats)
+
+    def reset(self, corpus_version=None):
+        with self.lock:
+            self.clear(corpus_version)
+
+    def clear(self, corpus_version=None):
+        self.embeddings = None
+        self.entries = []
+        self.start = 0
+        self.end = 0
+        self.corpus_version = corpus_version
+
+    def prune(self):
+        # entries are added in time order, the expired & the evicted entries are a prefix of the live rows
+        now = time.time()
+        self.start = max(self.start, self.end - self.maxsize)
+        while self.start < self.end and now - self.entries[self.start].get("created_at") >= self.ttl:
+            self.start += 1
+
+    def reallocate(self, dimensions):
+        live_rows = self.end - self.start
+        capacity = len(self.embeddings) if self.embeddings is not None else self.initial_capacity
+        if live_rows > capacity // 2:
+            capacity *= 2
+        embeddings = np.empty((capacity, dimensions), dtype=np.float32)
+        if live_rows:
+            embeddings[:live_rows] = self.embeddings[self.start : self.end]
+        self.embeddings = embeddings
+        self.entries = self.entries[self.start : self.end]
+        self.start, self.end = 0, live_rows
+
+    def search(self, embedding, corpus_version):
+        """
+        Most similar entry to the embedding, returns the (entry, similarity) pair ((None, 0) for an empty index).
+        """
+        with self.lock:
+            if corpus_version != self.corpus_version:
+                self.clear(corpus_version)
+            self.prune()
+            if self.start == self.end:
+                return None, 0
+            embeddings, entries, start, end = self.embeddings, self.entries, self.start, self.end
+
+        similarities = embeddings[start:end] @ normalize_embedding(embedding)
+        best_index = int(np.argmax(similarities))
+        return entries[start + best_index], float(similarities[best_index])
+
+    def add(self, embedding, entry: dict, corpus_version):
+        embedding = normalize_embedding(embedding)
+        entry = {**entry, "created_at": time.time()}
+        with self.lock:
+            if corpus_version != self.corpus_version:
+                self.clear(corpus_version)
+            if self.embeddings is None or self.end == len(self.embeddings):
+                self.prune()
+                self.reallocate(len(embedding))
+            self.embeddings[self.end] = embedding
+            self.entries.append(entry)
+            self.end += 1
+            self.prune()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": self.end - self.start, "maxsize": self.maxsize, "corpus_version": self.corpus_version}
+
+
+semantic_answer_index = SemanticAnswerIndex(maxsize=Config.SEMANTIC_CACHE_MAXSIZE, ttl=Config.SEMANTIC_CACHE_TTL)
+corpus_version_state = {"version": None, "checked_at": 0}
+
+
+def normalize_embedding(embedding):
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm else embedding
+
+
+def get_content_corpus_version() -> str:
+    """
+    Version of the content corpus: CONTENT_CORPUS_VERSION combined with the version bumped in the shared cache on
+    content updates (read at most every CONTENT_CORPUS_VERSION_CHECK_INTERVAL seconds).
+    """
+    now = time.monotonic()
+    if (
+        corpus_version_state["version"] is None
+        or now - corpus_version_state["checked_at"] >= Config.CONTENT_CORPUS_VERSION_CHECK_INTERVAL
+    ):
+        shared_version = 0
+        shared_cache = get_shared_cache_client()
+        if shared_cache:
+            try:
+                shared_version = int(shared_cache.get(CONTENT_CORPUS_VERSION_KEY) or 0)
+            except Exception as error:
+                logger.error(error, exc_info=True)
+                if corpus_version_state["version"] is not None:
+                    return corpus_version_state["version"]
+        corpus_version_state.update({"version": f"{Config.CONTENT_CORPUS_VERSION}:{shared_version}", "checked_at": now})
+
+    return corpus_version_state["version"]
+
+
+def bump_content_corpus_version() -> bool:
+    """
+    Invalidate the semantic answer caches of all the workers, ex: after the content corpus is updated.
+    Returns False when no shared cache is configured, only the cache of this process is invalidated then.
+    """
+    shared_cache = get_shared_cache_client()
+    if shared_cache:
+        shared_cache.incr(CONTENT_CORPUS_VERSION_KEY)
+    corpus_version_state.update({"version": None, "checked_at": 0})
+    semantic_answer_index.reset()
+    return shared_cache is not None
+
+
+def is_unanswered_response(response) -> bool:
+    response = (response or "").lower()
+    return any(phrase.lower() in response for phrase in Constants.UNANSWERED_PHRASES)
+
+
+async def get_semantic_cached_answer(rephrased_query, user_name=None, deadline=None):
+    """
+    Answer cached for a query similar (at least SEMANTIC_CACHE_THRESHOLD) to the rephrased query.
+    Returns the (answer or None, query embedding) pair, the embedding is reused to cache the generated answer.
+    """
+    if not Config.SEMANTIC_CACHE_ENABLED or not rephrased_query:
+        return None, None
+
+    embedding, embedding_exception = await make_openai_embedding_request(rephrased_query, deadline=deadline)
+    if embedding is None:
+        logger.error(f"Semantic answer cache embedding failed: {embedding_exception}")
+        return None, None
+
+    corpus_version = await asyncio.to_thread(get_content_corpus_version)
+    entry, similarity = semantic_answer_index.search(embedding, corpus_version)
+    if entry is None or similarity < Config.SEMANTIC_CACHE_THRESHOLD:
+        increment_counter("semantic_answer_cache_misses")
+        return None, embedding
+
+    increment_counter("semantic_answer_cache_hits")
+    logger.info(f"Semantic answer cache hit ({similarity:.3f}): {rephrased_query} ~ {entry.get('query')}")
+    return replace_user_name(entry.get("response"), Constants.USER_NAME_PLACEHOLDER, user_name or ""), embedding
+
+
+def cache_semantic_answer(rephrased_query, embedding, response, user_name=None):
+    """
+    Add the generated answer to the semantic answer cache, the user name is replaced by a placeholder.
+    Reads the content corpus version from the shared cache, called in a thread from the event loop.
+    """
+    if not Config.SEMANTIC_CACHE_ENABLED or embedding is None or not response or is_unanswered_response(response):
+        return
+    response = replace_user_name(response, user_name, Constants.USER_NAME_PLACEHOLDER)
+    semantic_answer_index.add(embedding, {"query": rephrased_query, "response": response}, get_content_corpus_version())
@@ -13,10 +13,12 @@ def post_process_rag_pipeline(
 ):
     data_saved = False
     if with_db_config:
-        # insert data logs to db
+        # insert data logs to db (stages skipped for cached answers are None)
         insert_rephrase_data(rephrased_query_response, message_id)
-        insert_rerank_data(reranked_query_response, message_id)
-        insert_generation_data(generated_response, message_id)
+        if reranked_query_response is not None:
+            insert_rerank_data(reranked_query_response, message_id)
+        if generated_response is not None:
+            insert_generation_data(generated_response, message_id)
         data_saved = True
 
     return data_saved
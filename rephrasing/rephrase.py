@@ -1,9 +1,54 @@
 import datetime
 import asyncio
+import re
 
+from common.cache import TwoTierCache, make_cache_key
+from common.constants import Constants
+from common.metrics import increment_counter
+from common.utils import normalize_query
 from django_core.config import Config
 from rag_service.openai_service import make_openai_request
 
+QUERY_WORD_REGEX = re.compile(r"[a-z0-9']+")
+
+rephrase_cache = TwoTierCache("rephrase", maxsize=Config.REPHRASE_CACHE_MAXSIZE, ttl=Config.REPHRASE_CACHE_TTL)
+
+
+def get_rephrase_decision(original_query):
+    """
+    Decide locally whether the query needs to be rephrased with the chat history.
+
+    Parameters
+    ----------
+    original_query: str
+        original query (in english) from the client
+
+    Returns
+    -------
+    rephrase_decision: tuple
+        return a tuple of (needs rephrase: bool, decision reason: str)
+
+    """
+    normalized_query = normalize_query(original_query)
+    query_words = QUERY_WORD_REGEX.findall(normalized_query)
+
+    if any(word in Constants.REPHRASE_ANAPHORA_WORDS for word in query_words):
+        return True, Constants.REPHRASE_DECISION_ANAPHORA
+    if f"{normalized_query} ".startswith(Constants.REPHRASE_FOLLOW_UP_OPENERS):
+        return True, Constants.REPHRASE_DECISION_FOLLOW_UP
+    if len(query_words) < Config.REPHRASE_SKIP_MIN_WORDS:
+        return True, Constants.REPHRASE_DECISION_SHORT_QUERY
+
+    return False, Constants.REPHRASE_DECISION_SELF_CONTAINED
+
+
+def is_self_contained_query(original_query):
+    """
+    Return True when the query can be answered without the chat history (no rephrasing required).
+    """
+    needs_rephrase, _ = get_rephrase_decision(original_query)
+    return not needs_rephrase
+
 
 async def condense_query_prompt(original_query, chat_history):
     """
@@ -31,7 +76,7 @@ async def condense_query_prompt(original_query, chat_history):
     return condense_prompt
 
 
-async def rephrase_query(original_query, chat_history=None):
+async def rephrase_query(original_query, chat_history=None, deadline=None):
     """
     Rephrase the input message / query with chat history (if available) from openAI and return it.
 
@@ -43,6 +88,9 @@ async def rephrase_query(original_query, chat_history=None):
     chat_history: str
         previous chat history of the client (default: None)
 
+    deadline: Deadline
+        deadline of the request, bounds the rephrase request & its retries (default: None)
+
     Returns
     -------
     rephrased_response: dict
@@ -60,6 +108,7 @@ async def rephrase_query(original_query, chat_history=None):
     rephrase_total_tokens = 0
     rephrase_exception = None
     rephrase_retries = 0
+    rephrase_decision = None
 
     rephrased_response.update(
         {
@@ -72,24 +121,44 @@ async def rephrase_query(original_query, chat_history=None):
             "total_tokens": rephrase_total_tokens,
             "rephrase_exception": rephrase_exception,
             "rephrase_retries": rephrase_retries,
+            "rephrase_decision": rephrase_decision,
         }
     )
 
     rephrase_start_time = datetime.datetime.now()
 
+    needs_rephrase, rephrase_decision = True, Constants.REPHRASE_DECISION_ALWAYS
+    if not chat_history:
+        needs_rephrase, rephrase_decision = False, Constants.REPHRASE_DECISION_NO_CHAT_HISTORY
+    elif Config.REPHRASE_SKIP_ENABLED:
+        needs_rephrase, rephrase_decision = get_rephrase_decision(original_query)
+
+    cache_key = make_cache_key(normalize_query(original_query), make_cache_key(chat_history))
+    cached_rephrased_query = None
+    if needs_rephrase and Config.REPHRASE_CACHE_ENABLED:
+        cached_rephrased_query = await asyncio.to_thread(rephrase_cache.get, cache_key)
+
     # if len(chat_history) >= 1:
-    if chat_history:
+    if not needs_rephrase:
+        rephrased_query = original_query
+    elif cached_rephrased_query:
+        rephrased_query = cached_rephrased_query
+        rephrase_decision = Constants.REPHRASE_DECISION_CACHE_HIT
+    else:
         condense_prompt = await condense_query_prompt(original_query, chat_history)
-        rephrased_question_response, rephrase_exception, rephrase_retries = await make_openai_request(condense_prompt)
+        rephrased_question_response, rephrase_exception, rephrase_retries = await make_openai_request(
+            condense_prompt, deadline=deadline
+        )
         if rephrased_question_response:
             rephrased_query = rephrased_question_response.choices[0].message.content
             rephrase_completion_tokens = rephrased_question_response.usage.completion_tokens
             rephrase_prompt_tokens = rephrased_question_response.usage.prompt_tokens
             rephrase_total_tokens = rephrased_question_response.usage.total_tokens
+            if Config.REPHRASE_CACHE_ENABLED:
+                await asyncio.to_thread(rephrase_cache.set, cache_key, rephrased_query)
         else:
             rephrased_query = original_query
-    else:
-        rephrased_query = original_query
+    increment_counter(f"rephrase_decision_{rephrase_decision}")
 
     rephrase_end_time = datetime.datetime.now()
 
@@ -107,6 +176,7 @@ async def rephrase_query(original_query, chat_history=None):
             "total_tokens": rephrase_total_tokens,
             "rephrase_exception": rephrase_exception,
             "rephrase_retries": rephrase_retries,
+            "rephrase_decision": rephrase_decision,
         }
     )
 
@@ -0,0 +1,109 @@
+"""
+Compare the token use & latency of the rerank modes (per chunk "single" vs batched "list").
+
+Usage:
+    python -m reranking.benchmark samples.json --runs 3 --batch-size 10
+
+samples.json holds a list of {"query": "...", "retrieved_chunks": [...]} objects, where retrieved_chunks is in the
+format returned by the content retrieval API. Samples without retrieved_chunks are retrieved with the given --email.
+"""
+
+import argparse, asyncio, datetime, json, logging, math
+import statistics
+
+from common.constants import Constants
+from django_core.config import Config
+from reranking.rerank import rerank_query
+from retrieval.content_retrieval import content_retrieval
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    sorted_values = sorted(values)
+    index = min(len(sorted_values) - 1, max(0, math.ceil(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def benchmark_rerank_mode(samples, rerank_mode, runs, email_id):
+    latencies = []
+    total_tokens = []
+    prompt_tokens = []
+    retries = 0
+    unparsed = 0
+    for _ in range(runs):
+        for sample in samples:
+            start_time = datetime.datetime.now()
+            rerank_results = await rerank_query(
+                sample.get("query"),
+                sample.get("query"),
+                email_id,
+                sample.get("retrieved_chunks"),
+                rerank_mode=rerank_mode,
+            )
+            latencies.append((datetime.datetime.now() - start_time).total_seconds())
+            total_tokens.append(rerank_results.get("total_tokens", 0))
+            prompt_tokens.append(rerank_results.get("prompt_tokens", 0))
+            retries += rerank_results.get("rerank_retries", 0)
+            unparsed += 0 if rerank_results.get("is_rerank_response_parsed") else 1
+
+    return {
+        "mode": rerank_mode,
+        "calls": len(latencies),
+        "mean_total_tokens": statistics.mean(total_tokens) if total_tokens else 0,
+        "mean_prompt_tokens": statistics.mean(prompt_tokens) if prompt_tokens else 0,
+        "p50_latency": percentile(latencies, 50),
+        "p95_latency": percentile(latencies, 95),
+        "retries": retries,
+        "unparsed_responses": unparsed,
+    }
+
+
+async def run_benchmark(samples, runs, email_id):
+    # the verdicts cached by a run would be served to the later runs & modes, every run reranks all the chunks
+    rerank_cache_enabled = Config.RERANK_CACHE_ENABLED
+    Config.RERANK_CACHE_ENABLED = False
+    try:
+        results = []
+        for rerank_mode in (Constants.RERANK_MODE_SINGLE, Constants.RERANK_MODE_LIST):
+            results.append(await benchmark_rerank_mode(samples, rerank_mode, runs, email_id))
+        return results
+    finally:
+        Config.RERANK_CACHE_ENABLED = rerank_cache_enabled
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the single & list rerank modes")
+    parser.add_argument("samples", help="JSON file with the benchmark queries (& retrieved chunks)")
+    parser.add_argument("--runs", type=int, default=1, help="number of runs over the samples per mode")
+    parser.add_argument("--email", default=None, help="email used for content retrieval of samples without chunks")
+    parser.add_argument("--batch-size", type=int, default=None, help="override RERANK_LIST_BATCH_SIZE")
+    args = parser.parse_args()
+
+    if args.batch_size:
+        Config.RERANK_LIST_BATCH_SIZE = args.batch_size
+
+    with open(args.samples, encoding="utf-8") as samples_file:
+        samples = json.load(samples_file)
+
+    for sample in samples:
+        if sample.get("retrieved_chunks") is None:
+            sample["retrieved_chunks"] = (
+                content_retrieval(sample.get("query"), args.email).get("retrieved_chunks") or []
+            )
+
+    results = asyncio.run(run_benchmark(samples, args.runs, args.email))
+
+    print(f"{'mode':<8}{'calls':>7}{'tokens':>10}{'prompt':>10}{'p50 s':>9}{'p95 s':>9}{'retries':>9}{'unparsed':>10}")
+    for result in results:
+        print(
+            f"{result['mode']:<8}{result['calls']:>7}{result['mean_total_tokens']:>10.0f}"
+            f"{result['mean_prompt_tokens']:>10.0f}{result['p50_latency']:>9.2f}{result['p95_latency']:>9.2f}"
+            f"{result['retries']:>9}{result['unparsed_responses']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,48 @@
-import datetime, uuid, logging, json, random
+import datetime, uuid, logging, json
 import asyncio
 
+from common.cache import TwoTierCache, make_cache_key
+from common.constants import Constants
+from common.metrics import increment_counter
+from common.tokens import trim_to_token_budget
+from common.utils import normalize_query
 from django_core.config import Config
 from rag_service.openai_service import make_openai_request, query_qdrant_collection
 
 logger = logging.getLogger(__name__)
 
+rerank_verdict_cache = TwoTierCache("rerank_verdict", maxsize=Config.RERANK_CACHE_MAXSIZE, ttl=Config.RERANK_CACHE_TTL)
+
+
+def get_chunk_id(text, metadata) -> str:
+    """
+    Stable chunk ID from the hash of the chunk text & metadata, same chunk gets the same ID across requests.
+    """
+    return make_cache_key(text, json.dumps(metadata, sort_keys=True, default=str))[:16]
+
+
+def rerank_verdict_cache_key(rephrased_query, chunk_id) -> str:
+    return make_cache_key(normalize_query(rephrased_query), chunk_id, Config.GPT_4_TURBO_PREVIEW_LATEST)
+
+
+def get_cached_rerank_verdicts(rephrased_query, docs_for_reranking) -> dict:
+    if not Config.RERANK_CACHE_ENABLED or not docs_for_reranking:
+        return {}
+    cache_keys = {
+        rerank_verdict_cache_key(rephrased_query, rerank_doc.get("id")): rerank_doc.get("id")
+        for rerank_doc in docs_for_reranking
+    }
+    cached_verdicts = rerank_verdict_cache.get_many(list(cache_keys))
+    return {cache_keys[cache_key]: verdict for cache_key, verdict in cached_verdicts.items()}
+
+
+def cache_rerank_verdicts(rephrased_query, verdicts: dict):
+    if not Config.RERANK_CACHE_ENABLED or not verdicts:
+        return
+    rerank_verdict_cache.set_many(
+        {rerank_verdict_cache_key(rephrased_query, chunk_id): verdict for chunk_id, verdict in verdicts.items()}
+    )
+
 
 def parse_single_rerank_json(json_string: str):
     start_index = json_string.find("{")
@@ -15,7 +52,232 @@ def parse_single_rerank_json(json_string: str):
     return json.loads(json_content)
 
 
-async def rerank_query(original_query, rephrased_query, email_id, retrieval_results=[]):
+def parse_list_rerank_json(json_string: str):
+    start_index = json_string.find("[")
+    end_index = json_string.rfind("]") + 1
+
+    json_content = json_string[start_index:end_index].strip()
+    return json.loads(json_content)
+
+
+def new_rerank_results():
+    return {
+        "reranked_list": [],
+        "completion_tokens": 0,
+        "prompt_tokens": 0,
+        "total_tokens": 0,
+        "rerank_exception": "",
+        "rerank_retries": 0,
+        "is_rerank_response_parsed": True,
+        # parsed classification & relevance score of every reranked chunk (by chunk ID), for the verdict cache
+        "verdicts": {},
+    }
+
+
+def parse_relevance_score(relevance_score) -> float:
+    """
+    Relevance score of a rerank verdict as a number, 0 for missing or non-numeric scores (ex: "high", "N/A").
+    """
+    try:
+        return float(relevance_score or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def add_rerank_verdict(rerank_results, chunk_id, response_obj):
+    relevance_score = parse_relevance_score(response_obj.get("relevance_score"))
+    rerank_results["verdicts"][chunk_id] = {
+        "classification": response_obj.get("classification"),
+        "relevance_score": relevance_score,
+    }
+    if response_obj.get("classification") == "YES":
+        rerank_results["reranked_list"].append({**response_obj, "id": chunk_id, "relevance_score": relevance_score})
+
+
+def add_rerank_request_usage(rerank_results, response, exception, retries):
+    if response:
+        rerank_results["completion_tokens"] += response.usage.completion_tokens
+        rerank_results["prompt_tokens"] += response.usage.prompt_tokens
+        rerank_results["total_tokens"] += response.usage.total_tokens
+    else:
+        rerank_results["is_rerank_response_parsed"] = False
+    rerank_results["rerank_retries"] += retries
+    rerank_results["rerank_exception"] += exception + "\n"
+
+
+async def rerank_chunks_single(rephrased_query, docs_for_reranking, deadline=None):
+    """
+    Classify every chunk with its own openAI request (one prompt per chunk), requests are made concurrently.
+    """
+    rerank_results = new_rerank_results()
+    rerank_prompt_list = [
+        Config.RERANKING_PROMPT_SINGLE_TEMPLATE.format(
+            # crop=crop,
+            json_example=Config.RERANK_SINGLE_JSON_EXAMPLE,
+            text=rerank_doc,
+            question=rephrased_query,
+        )
+        for rerank_doc in docs_for_reranking
+    ]
+
+    reranking_results = await asyncio.gather(
+        *(
+            make_openai_request(prompt, model=Config.GPT_4_TURBO_PREVIEW_LATEST, deadline=deadline)
+            for prompt in rerank_prompt_list
+        )
+    )
+
+    for rerank_doc, (response, exception, retries) in zip(docs_for_reranking, reranking_results):
+        add_rerank_request_usage(rerank_results, response, exception, retries)
+        if response:
+            try:
+                response_obj = parse_single_rerank_json(response.choices[0].message.content)
+            except Exception as error:
+                logger.error(error, exc_info=True)
+                rerank_results["is_rerank_response_parsed"] = False
+                continue
+            add_rerank_verdict(rerank_results, rerank_doc.get("id"), response_obj)
+
+    return rerank_results
+
+
+async def rerank_chunks_early_exit(
+    rephrased_query, docs_for_reranking, doc_map, latency_budget=None, required_chunks=None, deadline=None
+):
+    """
+    Classify every chunk with its own openAI request and consume the results as they complete. Stops once
+    required_chunks are classified as relevant or when the latency budget (in seconds) expires, the pending requests
+    are cancelled & the remaining context slots are filled with the unclassified chunks by retrieval similarity.
+    """
+    rerank_results = new_rerank_results()
+    rerank_results["fallback_list"] = []
+    latency_budget = latency_budget or Config.RERANK_LATENCY_BUDGET
+    if deadline:
+        latency_budget = min(latency_budget, deadline.remaining())
+    required_chunks = required_chunks or Config.RERANK_CONTEXT_CHUNKS
+
+    async def rerank_chunk(rerank_doc):
+        prompt = Config.RERANKING_PROMPT_SINGLE_TEMPLATE.format(
+            json_example=Config.RERANK_SINGLE_JSON_EXAMPLE,
+            text=rerank_doc,
+            question=rephrased_query,
+        )
+        return rerank_doc.get("id"), await make_openai_request(
+            prompt, model=Config.GPT_4_TURBO_PREVIEW_LATEST, deadline=deadline
+        )
+
+    rerank_tasks = [asyncio.create_task(rerank_chunk(rerank_doc)) for rerank_doc in docs_for_reranking]
+    classified_chunk_ids = set()
+    try:
+        for next_result in asyncio.as_completed(rerank_tasks, timeout=latency_budget):
+            chunk_id, (response, exception, retries) = await next_result
+            classified_chunk_ids.add(chunk_id)
+            add_rerank_request_usage(rerank_results, response, exception, retries)
+            if response:
+                try:
+                    response_obj = parse_single_rerank_json(response.choices[0].message.content)
+                except Exception as error:
+                    logger.error(error, exc_info=True)
+                    rerank_results["is_rerank_response_parsed"] = False
+                    continue
+                add_rerank_verdict(rerank_results, chunk_id, response_obj)
+            if len(rerank_results["reranked_list"]) >= required_chunks:
+                increment_counter("rerank_early_exits")
+                break
+    except asyncio.TimeoutError:
+        increment_counter("rerank_latency_budget_expired")
+        rerank_results["rerank_exception"] += f"rerank latency budget of {latency_budget}s expired\n"
+    finally:
+        for rerank_task in rerank_tasks:
+            rerank_task.cancel()
+
+    missing_chunks = required_chunks - len(rerank_results["reranked_list"])
+    if missing_chunks > 0:
+        unclassified_chunk_ids = sorted(
+            (
+                rerank_doc.get("id")
+                for rerank_doc in docs_for_reranking
+                if rerank_doc.get("id") not in classified_chunk_ids
+            ),
+            key=lambda chunk_id: doc_map.get(chunk_id).get("score") or 0,
+            reverse=True,
+        )
+        rerank_results["fallback_list"] = [
+            {"id": chunk_id, "classification": "UNCLASSIFIED", "relevance_score": None}
+            for chunk_id in unclassified_chunk_ids[:missing_chunks]
+        ]
+
+    return rerank_results
+
+
+async def rerank_chunks_listwise(rephrased_query, docs_for_reranking, batch_size=None, deadline=None):
+    """
+    Classify the chunks listwise, every openAI request holds a batch of (up to batch_size) chunks tagged with
+    short IDs (c1, c2, ...) and returns a JSON array with the classification & relevance score of each chunk.
+    """
+    rerank_results = new_rerank_results()
+    batch_size = batch_size or Config.RERANK_LIST_BATCH_SIZE
+    batches = [
+        docs_for_reranking[index : index + batch_size] for index in range(0, len(docs_for_reranking), batch_size)
+    ]
+
+    rerank_prompt_list = []
+    for batch in batches:
+        chunks_text = "\n\n".join(
+            f"[c{position}]\n{rerank_doc.get('text_chunk')}" for position, rerank_doc in enumerate(batch, start=1)
+        )
+        rerank_prompt_list.append(
+            Config.RERANKING_PROMPT_LIST_TEMPLATE.format(
+                json_example=Config.RERANK_LIST_JSON_EXAMPLE,
+                chunks=chunks_text,
+                question=rephrased_query,
+            )
+        )
+
+    reranking_results = await asyncio.gather(
+        *(
+            make_openai_request(prompt, model=Config.GPT_4_TURBO_PREVIEW_LATEST, deadline=deadline)
+            for prompt in rerank_prompt_list
+        )
+    )
+
+    for batch, (response, exception, retries) in zip(batches, reranking_results):
+        add_rerank_request_usage(rerank_results, response, exception, retries)
+        if response:
+            short_id_map = {f"c{position}": rerank_doc.get("id") for position, rerank_doc in enumerate(batch, start=1)}
+            try:
+                response_list = parse_list_rerank_json(response.choices[0].message.content)
+            except Exception as error:
+                logger.error(error, exc_info=True)
+                rerank_results["is_rerank_response_parsed"] = False
+                continue
+            for response_obj in response_list:
+                chunk_id = short_id_map.get(str(response_obj.get("id", "")).strip("[]"))
+                if chunk_id is None:
+                    rerank_results["is_rerank_response_parsed"] = False
+                    continue
+                add_rerank_verdict(rerank_results, chunk_id, response_obj)
+
+    return rerank_results
+
+
+async def rerank_chunks(rephrased_query, docs_for_reranking, doc_map, rerank_mode, required_chunks, deadline=None):
+    if not docs_for_reranking:
+        return new_rerank_results()
+    if rerank_mode == Constants.RERANK_MODE_LIST:
+        return await rerank_chunks_listwise(rephrased_query, docs_for_reranking, deadline=deadline)
+    if rerank_mode == Constants.RERANK_MODE_EARLY_EXIT:
+        if required_chunks <= 0:
+            return new_rerank_results()
+        return await rerank_chunks_early_exit(
+            rephrased_query, docs_for_reranking, doc_map, required_chunks=required_chunks, deadline=deadline
+        )
+    return await rerank_chunks_single(rephrased_query, docs_for_reranking, deadline=deadline)
+
+
+async def rerank_query(
+    original_query, rephrased_query, email_id, retrieval_results=[], rerank_mode=Config.RERANK_MODE, deadline=None
+):
     response_map = {}
     doc_map = None
     reranked_chunk_map = None
@@ -62,7 +324,9 @@ async def rerank_query(original_query, rephrased_query, email_id, retrieval_resu
         return response_map
     for data in retrieval_results:
         # import pdb; pdb.set_trace()
-        chunk_id = random.randint(1, 1000)
+        chunk_id = get_chunk_id(data.get("document", ""), data.get("cmetadata", {}))
+        if chunk_id in doc_map:
+            continue
         doc_map.update(
             {
                 # data.id: {
@@ -86,60 +350,68 @@ async def rerank_query(original_query, rephrased_query, email_id, retrieval_resu
             }
         )
 
-    sorted_reranked_list = []
-    rerank_prompt_list = [
-        Config.RERANKING_PROMPT_SINGLE_TEMPLATE.format(
-            # crop=crop,
-            json_example=Config.RERANK_SINGLE_JSON_EXAMPLE,
-            text=rerank_doc,
-            question=rephrased_query,
-        )
-        for rerank_doc in docs_for_reranking
+    # chunks already reranked for the same (normalized) question are served from the verdict cache
+    cached_verdicts = get_cached_rerank_verdicts(rephrased_query, docs_for_reranking)
+    cached_reranked_list = [
+        {**verdict, "id": chunk_id, "relevance_score": parse_relevance_score(verdict.get("relevance_score"))}
+        for chunk_id, verdict in cached_verdicts.items()
+        if verdict.get("classification") == "YES"
     ]
+    docs_to_rerank = [rerank_doc for rerank_doc in docs_for_reranking if rerank_doc.get("id") not in cached_verdicts]
 
     rerank_request_start_time = datetime.datetime.now()
-    reranking_results = await asyncio.gather(
-        *(make_openai_request(prompt, model=Config.GPT_4_TURBO_PREVIEW_LATEST) for prompt in rerank_prompt_list)
+    rerank_results = await rerank_chunks(
+        rephrased_query,
+        docs_to_rerank,
+        doc_map,
+        rerank_mode,
+        required_chunks=Config.RERANK_CONTEXT_CHUNKS - len(cached_reranked_list),
+        deadline=deadline,
     )
     rerank_request_end_time = datetime.datetime.now()
+    cache_rerank_verdicts(rephrased_query, rerank_results.get("verdicts"))
 
-    is_rerank_response_parsed = True
-    reranked_list = []
-    for response, exception, retries in reranking_results:
-        if response:
-            rerank_completion_tokens += response.usage.completion_tokens
-            rerank_prompt_tokens += response.usage.prompt_tokens
-            rerank_total_tokens += response.usage.total_tokens
-            try:
-                response_obj = parse_single_rerank_json(response.choices[0].message.content)
-            except Exception as error:
-                logger.error(error, exc_info=True)
-                is_rerank_response_parsed = False
-                continue
-            if response_obj.get("classification") == "YES":
-                reranked_list.append(response_obj)
-        else:
-            is_rerank_response_parsed = False
-        rerank_retries += retries
-        rerank_exception += exception + "\n"
+    reranked_list = cached_reranked_list + rerank_results.get("reranked_list")
+    rerank_completion_tokens = rerank_results.get("completion_tokens")
+    rerank_prompt_tokens = rerank_results.get("prompt_tokens")
+    rerank_total_tokens = rerank_results.get("total_tokens")
+    rerank_exception = rerank_results.get("rerank_exception")
+    rerank_retries = rerank_results.get("rerank_retries")
+    is_rerank_response_parsed = rerank_results.get("is_rerank_response_parsed")
 
-    sorted_reranked_list = sorted(reranked_list, key=lambda x: x["relevance_score"])
+    # most relevant first, ties broken by the retrieval similarity
+    sorted_reranked_list = sorted(
+        reranked_list,
+        key=lambda x: (x.get("relevance_score"), doc_map.get(x.get("id")).get("score") or 0),
+        reverse=True,
+    )
+    # chunks not classified within the rerank latency budget, ordered by retrieval similarity
+    sorted_reranked_list += rerank_results.get("fallback_list", [])
 
     rerank_end_time = datetime.datetime.now()
 
+    # pack the context chunks by relevance until the token budget is filled, over-long chunks are trimmed
     reranked_chunk_map = {}
     context_chunks = []
+    context_tokens = 0
     for item in sorted_reranked_list:
-        if len(context_chunks) < 6:
-            context_chunks.append(doc_map.get(int(item.get("id"))).get("text"))
-            reranked_chunk_map.update(
-                {
-                    item.get("id"): {
-                        "chunk": doc_map.get(int(item.get("id"))),
-                        "rank": item.get("relevance_score"),
-                    }
+        if len(context_chunks) >= Config.RERANK_CONTEXT_CHUNKS:
+            break
+        chunk_text, chunk_tokens = trim_to_token_budget(
+            doc_map.get(item.get("id")).get("text"), Config.CONTEXT_TOKEN_BUDGET - context_tokens
+        )
+        if not chunk_text:
+            continue
+        context_chunks.append(chunk_text)
+        context_tokens += chunk_tokens
+        reranked_chunk_map.update(
+            {
+                item.get("id"): {
+                    "chunk": doc_map.get(item.get("id")),
+                    "rank": item.get("relevance_score"),
                 }
-            )
+            }
+        )
 
     response_map.update(
         {
@@ -153,10 +425,11 @@ async def rerank_query(original_query, rephrased_query, email_id, retrieval_resu
             "completion_tokens": rerank_completion_tokens,
             "prompt_tokens": rerank_prompt_tokens,
             "total_tokens": rerank_total_tokens,
-            "is_rerank_response_parsed": False,
+            "is_rerank_response_parsed": is_rerank_response_parsed,
             "rerank_exception": rerank_exception,
             "rerank_retries": rerank_retries,
             "context_chunks": context_chunks,
+            "context_tokens": context_tokens,
         }
     )
 
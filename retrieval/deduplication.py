@@ -0,0 +1,77 @@
+import hashlib, logging
+import numpy as np
+
+from common.metrics import increment_counter
+from django_core.config import Config
+
+logger = logging.getLogger(__name__)
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+# fixed random permutations (a * hash + b) % prime, same signatures across processes
+permutation_generator = np.random.RandomState(seed=1)
+PERMUTATIONS_A = permutation_generator.randint(1, MERSENNE_PRIME, size=Config.DEDUP_NUM_PERMUTATIONS, dtype=np.uint64)
+PERMUTATIONS_B = permutation_generator.randint(0, MERSENNE_PRIME, size=Config.DEDUP_NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+def get_shingles(text: str, shingle_size: int) -> set:
+    words = text.lower().split()
+    if len(words) <= shingle_size:
+        return {" ".join(words)}
+    return {" ".join(words[index : index + shingle_size]) for index in range(len(words) - shingle_size + 1)}
+
+
+def get_minhash_signature(text: str, shingle_size: int = None):
+    """
+    MinHash signature of the word shingles of a text, the share of equal signature values between two texts
+    estimates the jaccard similarity of their shingle sets.
+    """
+    shingle_size = shingle_size or Config.DEDUP_SHINGLE_SIZE
+    shingle_hashes = np.array(
+        [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "big")
+            for shingle in get_shingles(text, shingle_size)
+        ],
+        dtype=np.uint64,
+    )
+    permuted_hashes = (np.outer(shingle_hashes, PERMUTATIONS_A) + PERMUTATIONS_B) % MERSENNE_PRIME & MAX_HASH
+    return permuted_hashes.min(axis=0)
+
+
+def estimate_jaccard_similarity(first_signature, second_signature) -> float:
+    return float(np.mean(first_signature == second_signature))
+
+
+def deduplicate_chunks(retrieved_chunks, threshold=None):
+    """
+    Collapse near-duplicate retrieved chunks (estimated jaccard similarity of their document text >= threshold),
+    keeping the representative with the highest retrieval similarity of each group. Order of kept chunks is kept.
+    """
+    if not retrieved_chunks or not Config.DEDUP_ENABLED:
+        return retrieved_chunks
+
+    threshold = threshold or Config.DEDUP_JACCARD_THRESHOLD
+    try:
+        signatures = [get_minhash_signature(chunk.get("document") or "") for chunk in retrieved_chunks]
+        by_similarity = sorted(
+            range(len(retrieved_chunks)),
+            key=lambda index: retrieved_chunks[index].get("similarity") or 0,
+            reverse=True,
+        )
+
+        kept_indexes = []
+        for index in by_similarity:
+            if all(
+                estimate_jaccard_similarity(signatures[index], signatures[kept]) < threshold for kept in kept_indexes
+            ):
+                kept_indexes.append(index)
+    except Exception as error:
+        logger.error(error, exc_info=True)
+        return retrieved_chunks
+
+    duplicate_count = len(retrieved_chunks) - len(kept_indexes)
+    if duplicate_count:
+        increment_counter("retrieval_duplicate_chunks", duplicate_count)
+
+    return [retrieved_chunks[index] for index in sorted(kept_indexes)]